@@ -0,0 +1,43 @@
+"""
+Compares the datetime based departure handling with the epoch second arrays from
+tramtrix.departures: timestamp parsing and the colour calculation.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/bench_departures.py
+"""
+import timeit
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from tramtrix.departures import parse_iso8601
+from tramtrix.traffic_light import calculate_traffic_light_colour
+
+NUMBER = 20000
+
+
+def report(name, seconds, number):
+    print(f"{name:>40} {seconds / number * 1e6:>8.2f}us")
+
+
+def main():
+    text = "2026-01-06T12:00:00+01:00"
+    report("datetime.fromisoformat", timeit.timeit(
+        lambda: datetime.fromisoformat(text.replace("Z", "+00:00")), number=NUMBER), NUMBER)
+    report("parse_iso8601", timeit.timeit(lambda: parse_iso8601(text), number=NUMBER), NUMBER)
+    start = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+    texts = [(start + timedelta(seconds=i)).isoformat() for i in range(NUMBER)]
+    report("parse_iso8601, all different", timeit.timeit(lambda: [parse_iso8601(t) for t in texts], number=1), NUMBER)
+
+    now = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+    for count in (10, 100, 1000):
+        times = [now + timedelta(seconds=37 * i) for i in range(count)]
+        datetime_set = set(times)
+        epochs = array("q", sorted(int(t.timestamp()) for t in times))
+        report(f"colour, set of {count} datetimes", timeit.timeit(
+            lambda: calculate_traffic_light_colour(datetime_set, now=now), number=NUMBER // 10), NUMBER // 10)
+        report(f"colour, array of {count} epochs", timeit.timeit(
+            lambda: calculate_traffic_light_colour(epochs, now=now.timestamp()), number=NUMBER // 10), NUMBER // 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares fetching departures with an OJPTripRequest (all of them, or only the next few
+trips as trip_incremental does on most fetches) against an OJPStopEventRequest
+(the origin's departure board): response size and parse time on synthetic responses
+for the same departures, and optionally request latency against the real API.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/bench_fetch_modes.py
+    PYTHONPATH=src python3 benchmarks/bench_fetch_modes.py --live 8591190 8591381
+"""
+import argparse
+import statistics
+import time
+import timeit
+
+from tramtrix.config import TRIP_REFRESH_RESULTS
+from tramtrix.ojp_parser import parse_trip_results, parse_stop_events
+from ojp_documents import trip_delivery, stop_event_delivery
+
+# The trips the client asks for (NumberOfResults) and the size of the departure board,
+# which holds both directions
+TRIP_RESULTS = 10
+STOP_EVENTS = 20
+
+
+def synthetic(repeat):
+    print(f"{'mode':>26} {'size':>9} {'parse':>10} {'departures':>11}")
+    for name, document, parse in (
+        ("trip", trip_delivery(TRIP_RESULTS), parse_trip_results),
+        # Most fetches of trip_incremental only refresh the next few trips
+        ("trip_incremental, refresh", trip_delivery(TRIP_REFRESH_RESULTS), parse_trip_results),
+        # With onward calls to keep only the trams towards the destination
+        ("stop_event", stop_event_delivery(STOP_EVENTS),
+         lambda document: parse_stop_events(document, destination="8591196")),
+        # Without, all departures from the stop
+        ("stop_event, no onward calls", stop_event_delivery(STOP_EVENTS, onward_stops=0), parse_stop_events),
+    ):
+        seconds = min(timeit.repeat(lambda: parse(document), number=1, repeat=repeat))
+        departures = sum(len(times) for times in parse(document).values())
+        print(f"{name:>26} {len(document) / 1024:>7.1f}kB {seconds * 1000:>8.2f}ms {departures:>11}")
+
+
+def live(origin, destination, repeat):
+    from tramtrix.ojp import OJPApiClient
+    from tramtrix.ojp_requests import trip_request, stop_event_request
+
+    print(f"{'mode':>26} {'size':>9} {'median':>10} {'min':>10}")
+    with OJPApiClient() as client:
+        for name, build in (
+            ("trip", lambda: trip_request(origin, destination)[0]),
+            ("trip_incremental, refresh", lambda: trip_request(origin, destination, results=TRIP_REFRESH_RESULTS)[0]),
+            ("stop_event", lambda: stop_event_request(origin)[0]),
+            ("stop_event, no onward calls", lambda: stop_event_request(origin, onward_calls=False)[0]),
+        ):
+            latencies = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = client._post(build())
+                latencies.append(time.perf_counter() - started)
+                response.raise_for_status()
+            print(f"{name:>26} {len(response.content) / 1024:>7.1f}kB "
+                  f"{statistics.median(latencies) * 1000:>8.0f}ms {min(latencies) * 1000:>8.0f}ms")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--live", nargs=2, metavar=("ORIGIN", "DESTINATION"),
+                            help="Also time both requests against the API (needs OJP_API_KEY), e.g. 8591190 8591381")
+    args = arg_parser.parse_args()
+
+    synthetic(args.repeat)
+    if args.live:
+        print()
+        live(*args.live, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares the tree based TripDelivery parser the client used to have with the
+streaming parser in tramtrix.ojp_parser, on synthetic documents of increasing size.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/bench_parse.py
+"""
+import argparse
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from tramtrix.ojp_parser import lxml_etree, parse_trip_results
+from ojp_documents import trip_delivery
+
+NAMESPACES = {
+    "ojp": "http://www.vdv.de/ojp",
+    "siri": "http://www.siri.org.uk/siri",
+}
+
+
+def parse_tree(xml_text):
+    """
+    The original OJPApiClient._parse_response, kept as the baseline.
+    """
+    root = ET.fromstring(xml_text)
+    trip_results = {}
+    for trip_result in root.findall(".//ojp:TripResult", NAMESPACES):
+        for leg in trip_result.findall(".//ojp:Leg", NAMESPACES):
+            published_service_name_element = leg.find(".//ojp:PublishedServiceName", NAMESPACES)
+            published_service_name = None
+            if published_service_name_element is not None:
+                published_service_name = published_service_name_element.findtext("ojp:Text", namespaces=NAMESPACES)
+            estimated_time_text = leg.findtext(".//ojp:EstimatedTime", namespaces=NAMESPACES)
+            estimated_time = datetime.fromisoformat(estimated_time_text.replace("Z", "+00:00")) if estimated_time_text else None
+            if published_service_name and estimated_time:
+                trip_results.setdefault(published_service_name, set()).add(estimated_time)
+    return trip_results
+
+
+PARSERS = {
+    "tree": parse_tree,
+    "stream-etree": lambda document: parse_trip_results(document, use_lxml=False),
+}
+if lxml_etree is not None:
+    PARSERS["stream-lxml"] = lambda document: parse_trip_results(document, use_lxml=True)
+
+
+def as_epochs(results):
+    """
+    Normalizes either parser's output to sorted epoch seconds by line.
+    """
+    return {
+        line: sorted(int(t.timestamp()) if hasattr(t, "timestamp") else t for t in times)
+        for line, times in results.items()
+    }
+
+
+def measure(parser, document, repeat):
+    seconds = min(timeit.repeat(lambda: parser(document), number=1, repeat=repeat))
+    tracemalloc.start()
+    parser(document)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--sizes", default="10,100,500,2000", help="Comma separated TripResult counts")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f"{'TripResults':>11} {'size':>9} {'parser':>13} {'time':>10} {'peak mem':>10}")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        document = trip_delivery(size)
+        expected = as_epochs(parse_tree(document))
+        for name, parser in PARSERS.items():
+            assert as_epochs(parser(document)) == expected, f"{name} disagrees with the tree parser"
+            seconds, peak = measure(parser, document, args.repeat)
+            print(f"{size:>11} {len(document) / 1024:>7.0f}kB {name:>13} {seconds * 1000:>8.2f}ms {peak / 1024:>8.0f}kB")
+    if lxml_etree is not None:
+        print("Note: tracemalloc only sees Python allocations, libxml2's own memory is not included for lxml.")
+
+
+if __name__ == "__main__":
+    main()
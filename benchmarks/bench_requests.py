@@ -0,0 +1,66 @@
+"""
+Compares building OJP request bodies from unescaped f-strings, as the client used to,
+with the escaped f-strings of tramtrix.ojp_requests.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/bench_requests.py
+"""
+import timeit
+from datetime import datetime, timezone
+
+from tramtrix.ojp_requests import trip_request, location_information_request
+
+NUMBER = 20000
+
+
+def trip_request_fstring(stop_ref_origin, stop_ref_destination):
+    """
+    The body the original OJPApiClient.get_trip_results built, kept as the baseline.
+    """
+    now_iso = datetime.now(timezone.utc).isoformat()
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.vdv.de/ojp OJP_changes_for_v1.1/OJP.xsd">
+    <OJPRequest>
+        <siri:ServiceRequest>
+            <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
+            <siri:RequestorRef>MENTZRegTest</siri:RequestorRef>
+            <OJPTripRequest>
+                <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
+                <siri:MessageIdentifier>TR-1h2</siri:MessageIdentifier>
+                <Origin>
+                    <PlaceRef>
+                        <siri:StopPointRef>{stop_ref_origin}</siri:StopPointRef>
+                    </PlaceRef>
+                </Origin>
+                <Destination>
+                    <PlaceRef>
+                        <siri:StopPointRef>{stop_ref_destination}</siri:StopPointRef>
+                    </PlaceRef>
+                </Destination>
+                <Params>
+                    <ModeAndModeOfOperationFilter>
+                        <Exclude>false</Exclude>
+                        <PtMode>tram</PtMode>
+                    </ModeAndModeOfOperationFilter>
+                    <NumberOfResults>10</NumberOfResults>
+                </Params>
+            </OJPTripRequest>
+        </siri:ServiceRequest>
+    </OJPRequest>
+</OJP>
+""".encode("utf-8")
+
+
+def report(name, function):
+    seconds = min(timeit.repeat(function, number=NUMBER, repeat=5))
+    print(f"{name:>40} {seconds / NUMBER * 1e6:>8.2f}us")
+
+
+def main():
+    report("trip request, f-string", lambda: trip_request_fstring("8591341", "8591381"))
+    report("trip request, escaped", lambda: trip_request("8591341", "8591381"))
+    report("location request, escaped", lambda: location_information_request("Zürich, Stauffacher"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures the offline stop index on a synthetic stop list the size of the Swiss one:
+building it, opening it, and resolving and searching hundreds of names.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/bench_stop_index.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from tramtrix.stop_index import StopIndex, build_stop_index
+
+TOWNS = 2500
+STOPS_PER_TOWN = 12
+NAMES = 500
+
+SYLLABLES = ["ber", "zu", "rich", "gen", "lau", "sanne", "hof", "platz", "matt", "wil", "dorf", "bach", "egg", "stadt", "feld", "au"]
+
+
+def word(rng, syllables):
+    return "".join(rng.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+
+def stop_list(rng):
+    stops = []
+    for _ in range(TOWNS):
+        town = word(rng, 3)
+        for stop_number in range(STOPS_PER_TOWN):
+            stops.append((f"{town}, {word(rng, 2)}{'ü' if stop_number % 3 == 0 else ''}", str(8500000 + len(stops))))
+    return stops
+
+
+def main():
+    rng = random.Random(42)
+    stops = stop_list(rng)
+    names = [name for name, _ in rng.sample(stops, NAMES)]
+    queries = [name.split(", ")[1][:5] for name in names]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "stops.idx")
+        start = time.perf_counter()
+        count = build_stop_index(stops, path)
+        built = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = StopIndex(path)
+        opened = time.perf_counter() - start
+
+        with index:
+            start = time.perf_counter()
+            refs = [index.lookup(name.upper()) for name in names]
+            resolved = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for query in queries:
+                index.search(query, limit=5)
+            searched = time.perf_counter() - start
+
+        print(f"{count} stops, index file {os.path.getsize(path) / 1024:.0f} KiB, built in {built:.2f}s, opened in {opened * 1000:.2f}ms")
+        print(f"Resolved {sum(ref is not None for ref in refs)} of {NAMES} names in {resolved * 1000:.1f}ms")
+        print(f"Searched {NAMES} prefixes in {searched * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Load test for the server mode: hundreds of clients polling a handful of routes at once,
+against an in-process server whose OJP client is simulated with a fixed latency. Shows
+the throughput, the response times and how few upstream calls the shared cache and
+request coalescing let through.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/load_server.py
+    PYTHONPATH=src python3 benchmarks/load_server.py --clients 500 --routes 20 --ttl 2
+"""
+import argparse
+import http.client
+import statistics
+import threading
+import time
+
+from tramtrix.departures import Departure, Departures
+from tramtrix.server import DepartureService, TramtrixServer
+
+
+class SimulatedOJPClient:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_departures(self, stop_ref_origin, stop_ref_destination, mode="trip", allow_stale=True):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        now = int(time.time())
+        return Departures(Departure(line, now + minutes * 60) for line in ("9", "14") for minutes in range(2, 30, 4))
+
+
+def poll(address, paths, deadline, latencies, errors):
+    connection = http.client.HTTPConnection(*address, timeout=30)
+    i = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            connection.request("GET", paths[i % len(paths)])
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(*address, timeout=30)
+        latencies.append(time.perf_counter() - started)
+        i += 1
+    connection.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--clients", type=int, default=200, help="Concurrent polling clients")
+    arg_parser.add_argument("--routes", type=int, default=5, help="Distinct routes the clients ask for")
+    arg_parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+    arg_parser.add_argument("--latency", type=float, default=0.5, help="Simulated OJP latency in seconds")
+    arg_parser.add_argument("--ttl", type=int, default=30, help="Server cache TTL in seconds")
+    args = arg_parser.parse_args()
+
+    client = SimulatedOJPClient(args.latency)
+    server = TramtrixServer(DepartureService(client, ttl=args.ttl), address=("127.0.0.1", 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    deadline = time.perf_counter() + args.duration
+    latencies, errors = [], []
+    threads = []
+    for i in range(args.clients):
+        # Each client polls one route, the routes spread evenly over the clients
+        paths = [f"/departures?origin_ref=O{i % args.routes}&destination_ref=D&lines=9,14"]
+        threads.append(threading.Thread(target=poll, args=(server.server_address[:2], paths, deadline, latencies, errors)))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    print(f"clients: {args.clients}, routes: {args.routes}, OJP latency: {args.latency * 1000:.0f}ms, TTL: {args.ttl}s")
+    print(f"requests: {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.0f}/s), errors: {len(errors)}")
+    if latencies:
+        print(f"latency: median {statistics.median(latencies) * 1000:.1f}ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+    print(f"upstream OJP calls: {client.calls} "
+          f"(at most {args.routes * (int(args.duration // args.ttl) + 1)} expected with coalescing)")
+
+
+if __name__ == "__main__":
+    main()
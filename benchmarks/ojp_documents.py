@@ -0,0 +1,225 @@
+"""
+Synthetic OJP responses shaped like the real opentransportdata.swiss ones,
+for benchmarking the parser on documents far bigger than the unit test snippets.
+"""
+from datetime import datetime, timedelta, timezone
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+            <siri:ProducerRef>EFAController10.6.21.14-OJP-EFA01-P</siri:ProducerRef>
+            <OJPTripDelivery>
+                <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+                <siri:Status>true</siri:Status>
+                <CalcTime>187</CalcTime>
+"""
+
+FOOTER = """            </OJPTripDelivery>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+CALL = """                                <{kind}>
+                                    <siri:StopPointRef>ch:1:sloid:{stop}:0:{platform}</siri:StopPointRef>
+                                    <StopPointName>
+                                        <Text xml:lang="de">Zürich, Stop {stop}</Text>
+                                    </StopPointName>
+                                    <PlannedQuay>
+                                        <Text xml:lang="de">{platform}</Text>
+                                    </PlannedQuay>
+                                    <Service{direction}>
+                                        <TimetabledTime>{timetabled}</TimetabledTime>
+                                        <EstimatedTime>{estimated}</EstimatedTime>
+                                    </Service{direction}>
+                                    <Order>{order}</Order>
+                                </{kind}>
+"""
+
+TRIP_RESULT = """                <TripResult>
+                    <Id>ID-{id}</Id>
+                    <Trip>
+                        <Id>ID-{id}</Id>
+                        <Duration>PT{duration}M</Duration>
+                        <StartTime>{start}</StartTime>
+                        <EndTime>{end}</EndTime>
+                        <Transfers>0</Transfers>
+                        <Leg>
+                            <Id>1</Id>
+                            <Duration>PT{duration}M</Duration>
+                            <TimedLeg>
+{calls}                                <Service>
+                                    <OperatingDayRef>2026-01-06</OperatingDayRef>
+                                    <JourneyRef>ch:1:sjyid:100001:{line}-{id}</JourneyRef>
+                                    <PublicCode>{line}</PublicCode>
+                                    <siri:LineRef>ojp:91{line:0>3}:A</siri:LineRef>
+                                    <siri:DirectionRef>R</siri:DirectionRef>
+                                    <Mode>
+                                        <PtMode>tram</PtMode>
+                                        <siri:TramSubmode>cityTram</siri:TramSubmode>
+                                        <Name>
+                                            <Text xml:lang="de">Tram</Text>
+                                        </Name>
+                                    </Mode>
+                                    <PublishedServiceName>
+                                        <Text xml:lang="de">{line}</Text>
+                                    </PublishedServiceName>
+                                    <TrainNumber>{id}</TrainNumber>
+                                    <OriginText>
+                                        <Text xml:lang="de">Zürich, Triemli</Text>
+                                    </OriginText>
+                                    <siri:OperatorRef>ojp:3849</siri:OperatorRef>
+                                    <DestinationStopPointRef>8591435</DestinationStopPointRef>
+                                    <DestinationText>
+                                        <Text xml:lang="de">Zürich, Hirzenbach</Text>
+                                    </DestinationText>
+                                </Service>
+                                <LegTrack>
+                                    <TrackSection>
+                                        <Duration>PT{duration}M</Duration>
+                                        <Length>{length}</Length>
+                                    </TrackSection>
+                                </LegTrack>
+                            </TimedLeg>
+                        </Leg>
+                    </Trip>
+                </TripResult>
+"""
+
+
+def _iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def trip_result(index, start, line, intermediate_stops=6):
+    """
+    A single TripResult with one tram leg from the origin via the intermediate stops.
+    """
+    delay = timedelta(seconds=(index * 17) % 90)
+    calls = []
+    for order in range(intermediate_stops + 2):
+        if order == 0:
+            kind, direction = "LegBoard", "Departure"
+        elif order == intermediate_stops + 1:
+            kind, direction = "LegAlight", "Arrival"
+        else:
+            kind, direction = "LegIntermediate", "Departure"
+        timetabled = start + timedelta(minutes=order)
+        calls.append(CALL.format(
+            kind=kind, direction=direction, stop=91190 + order, platform=1 + order % 2,
+            timetabled=_iso(timetabled), estimated=_iso(timetabled + delay), order=order + 1,
+        ))
+    end = start + timedelta(minutes=intermediate_stops + 1)
+    return TRIP_RESULT.format(
+        id=index, line=line, calls="".join(calls), start=_iso(start), end=_iso(end),
+        duration=intermediate_stops + 1, length=(intermediate_stops + 1) * 420,
+    )
+
+
+def trip_delivery(trip_results, lines=("9", "14"), now=None, headway_minutes=4):
+    """
+    A TripDelivery document with the given number of TripResults, alternating between lines.
+    """
+    now = now or datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+    parts = [HEADER.format(now=_iso(now))]
+    for index in range(trip_results):
+        start = now + timedelta(minutes=index * headway_minutes // len(lines))
+        parts.append(trip_result(index, start, lines[index % len(lines)]))
+    parts.append(FOOTER)
+    return "".join(parts).encode("utf-8")
+
+
+STOP_EVENT_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+            <siri:ProducerRef>EFAController10.6.21.14-OJP-EFA01-P</siri:ProducerRef>
+            <OJPStopEventDelivery>
+                <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+                <siri:Status>true</siri:Status>
+                <CalcTime>41</CalcTime>
+"""
+
+STOP_EVENT_FOOTER = """            </OJPStopEventDelivery>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+STOP_EVENT_CALL = """                        <{kind}>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:{stop}:0:{platform}</siri:StopPointRef>
+                                <StopPointName>
+                                    <Text xml:lang="de">Zürich, Stop {stop}</Text>
+                                </StopPointName>
+                                <PlannedQuay>
+                                    <Text xml:lang="de">{platform}</Text>
+                                </PlannedQuay>
+                                <ServiceDeparture>
+                                    <TimetabledTime>{timetabled}</TimetabledTime>
+                                    <EstimatedTime>{estimated}</EstimatedTime>
+                                </ServiceDeparture>
+                                <Order>{order}</Order>
+                            </CallAtStop>
+                        </{kind}>
+"""
+
+STOP_EVENT_RESULT = """                <StopEventResult>
+                    <Id>ID-{id}</Id>
+                    <StopEvent>
+{calls}                        <Service>
+                            <OperatingDayRef>2026-01-06</OperatingDayRef>
+                            <JourneyRef>ch:1:sjyid:100001:{line}-{id}</JourneyRef>
+                            <PublicCode>{line}</PublicCode>
+                            <siri:LineRef>ojp:91{line:0>3}:A</siri:LineRef>
+                            <siri:DirectionRef>{direction}</siri:DirectionRef>
+                            <Mode>
+                                <PtMode>tram</PtMode>
+                                <siri:TramSubmode>cityTram</siri:TramSubmode>
+                            </Mode>
+                            <PublishedServiceName>
+                                <Text xml:lang="de">{line}</Text>
+                            </PublishedServiceName>
+                            <DestinationText>
+                                <Text xml:lang="de">Zürich, Hirzenbach</Text>
+                            </DestinationText>
+                        </Service>
+                    </StopEvent>
+                </StopEventResult>
+"""
+
+
+def stop_event_result(index, start, line, outbound, onward_stops=6):
+    """
+    A single StopEventResult departing from the origin, with its onward calls. Outbound
+    trams call at the stops trip_result uses, the others head the opposite way.
+    """
+    delay = timedelta(seconds=(index * 17) % 90)
+    calls = []
+    for order in range(onward_stops + 1):
+        stop = 91190 + order if outbound else 91190 - order
+        timetabled = start + timedelta(minutes=order)
+        calls.append(STOP_EVENT_CALL.format(
+            kind="ThisCall" if order == 0 else "OnwardCall", stop=stop, platform=1 if outbound else 2,
+            timetabled=_iso(timetabled), estimated=_iso(timetabled + delay), order=order + 1,
+        ))
+    return STOP_EVENT_RESULT.format(id=index, line=line, calls="".join(calls), direction="R" if outbound else "H")
+
+
+def stop_event_delivery(stop_events, lines=("9", "14"), now=None, headway_minutes=4, onward_stops=6):
+    """
+    A StopEventDelivery (departure board) with the given number of StopEventResults,
+    alternating between lines and directions. The outbound half matches trip_delivery.
+    """
+    now = now or datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+    parts = [STOP_EVENT_HEADER.format(now=_iso(now))]
+    for index in range(stop_events):
+        start = now + timedelta(minutes=index // 2 * headway_minutes // len(lines))
+        parts.append(stop_event_result(
+            index, start, lines[index // 2 % len(lines)], outbound=index % 2 == 0, onward_stops=onward_stops
+        ))
+    parts.append(STOP_EVENT_FOOTER)
+    return "".join(parts).encode("utf-8")
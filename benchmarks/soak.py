@@ -0,0 +1,191 @@
+"""
+Soak test: runs the main loop for as long as asked against the local OJP and Awtrix
+stand-ins, with injected latency and faults, and reports the throughput, the request
+latency percentiles and how the process memory grows.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/soak.py --minutes 5
+    PYTHONPATH=src python3 benchmarks/soak.py --minutes 240 --routes 20 --clocks 40 \\
+        --ojp-latency lognormal:0.4:0.8 --ojp-error-rate 0.05 --ojp-drop-rate 0.01 --ojp-rate-limit 5
+"""
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.log import configure_logging
+from tramtrix.main import run
+from tramtrix.ojp import OJPApiClient, TokenBucket, FETCH_MODES
+from tramtrix.routes import Clock, Route, RoutesConfig
+from tramtrix.scheduler import FetchPolicy
+from tramtrix.standins import AwtrixStandIn, Faults, OJPStandIn
+
+
+class SoakFinished(BaseException):
+    pass
+
+
+class Latencies:
+    """
+    Collects the latency of every response a session receives.
+    """
+
+    def __init__(self):
+        self.all = []
+        self._lock = threading.Lock()
+        self._reported = 0
+
+    def hook(self, response, *args, **kwargs):
+        with self._lock:
+            self.all.append(response.elapsed.total_seconds())
+
+    def since_last_report(self):
+        with self._lock:
+            window, self._reported = self.all[self._reported:], len(self.all)
+        return window
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {p: float("nan") for p in points}
+    ordered = sorted(values)
+    return {p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def rss_mb():
+    """
+    The resident memory of the process, or its peak where the current one can't be read.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def format_ms(values):
+    return " ".join(f"p{p}={seconds * 1000:.0f}ms" for p, seconds in percentiles(values).items())
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--minutes", type=float, default=5, help="How long to run")
+    arg_parser.add_argument("--routes", type=int, default=5)
+    arg_parser.add_argument("--clocks", type=int, default=10, help="Clocks, spread over the routes")
+    arg_parser.add_argument("--mode", choices=FETCH_MODES, default="trip")
+    arg_parser.add_argument("--interval", type=float, default=10, help="Seconds between fetches of a route")
+    arg_parser.add_argument("--min-interval", type=float, default=5)
+    arg_parser.add_argument("--max-interval", type=float, default=30)
+    arg_parser.add_argument("--quota", type=float, default=0, help="OJP requests a second the client allows itself, 0 for no limit")
+    arg_parser.add_argument("--report", type=float, default=60, help="Seconds between reports")
+    arg_parser.add_argument("--seed", type=int, default=0, help="Seeds the injected latencies and faults")
+    arg_parser.add_argument("--tracemalloc", action="store_true", help="Show where the Python heap grew (slower)")
+    for service, latency in (("ojp", "lognormal:0.3:0.5"), ("awtrix", "uniform:0.01:0.05")):
+        arg_parser.add_argument(f"--{service}-latency", default=latency)
+        arg_parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+        arg_parser.add_argument(f"--{service}-drop-rate", type=float, default=0.0)
+        arg_parser.add_argument(f"--{service}-rate-limit", type=float, default=0)
+    args = arg_parser.parse_args()
+
+    def faults(service):
+        return Faults(
+            latency=getattr(args, f"{service}_latency"), error_rate=getattr(args, f"{service}_error_rate"),
+            drop_rate=getattr(args, f"{service}_drop_rate"), rate_limit=getattr(args, f"{service}_rate_limit"),
+            seed=args.seed,
+        )
+
+    out = sys.stdout
+    stop = threading.Event()
+    ojp_latencies, awtrix_latencies = Latencies(), Latencies()
+
+    def sleep(seconds):
+        if stop.wait(seconds):
+            raise SoakFinished()
+
+    with ExitStack() as stack:
+        ojp = stack.enter_context(OJPStandIn(faults=faults("ojp")))
+        awtrix = stack.enter_context(AwtrixStandIn(faults=faults("awtrix")))
+        rate_limiter = TokenBucket(args.quota, max(args.quota, 1)) if args.quota else TokenBucket(1e6, 1e6)
+        client = stack.enter_context(OJPApiClient(api_key="soak", url=ojp.url, rate_limiter=rate_limiter))
+        client.session.hooks["response"].append(ojp_latencies.hook)
+
+        routes = [Route(f"route{i}", f"Origin {i}", f"Destination {i}", mode=args.mode) for i in range(args.routes)]
+        clock_configs = [
+            Clock(f"clock{i}", awtrix.clock_url(f"clock{i}"), routes[i % len(routes)].name, ojp.lines)
+            for i in range(args.clocks)
+        ]
+        clocks = {}
+        for clock_config in clock_configs:
+            clocks[clock_config.name] = stack.enter_context(AwtrixClient(clock_config.url))
+            clocks[clock_config.name].session.hooks["response"].append(awtrix_latencies.hook)
+        config = RoutesConfig(routes, clock_configs)
+        queries = config.queries({name: client.resolve_stop_ref(name) for name in config.stop_names()})
+        policy = FetchPolicy(interval=args.interval, min_interval=args.min_interval, max_interval=args.max_interval)
+
+        def loop():
+            try:
+                run(client, clocks, queries, policy, sleep=sleep)
+            except SoakFinished:
+                pass
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        print(f"Soaking {args.routes} routes and {args.clocks} clocks for {args.minutes:g} minutes "
+              f"(OJP {ojp.url}, Awtrix {awtrix.url})", file=out)
+        # The injected faults would fill the report with warnings
+        configure_logging("ERROR")
+        thread = threading.Thread(target=loop, name="soak")
+        started = time.perf_counter()
+        rss_start = rss_mb()
+        snapshot_start = tracemalloc.take_snapshot() if args.tracemalloc else None
+        thread.start()
+
+        deadline = started + args.minutes * 60
+        last_report, last_ojp, last_awtrix = started, ojp.stats(), awtrix.stats()
+        # Memory at the first report, once connections, caches and imports are warm
+        rss_warm = warm_at = None
+        print(f"{'minute':>7} {'OJP/s':>7} {'clock/s':>8} {'OJP fail':>9} {'OJP latency':>34} {'RSS':>8}", file=out)
+        while time.perf_counter() < deadline:
+            time.sleep(min(args.report, max(deadline - time.perf_counter(), 0)))
+            now = time.perf_counter()
+            ojp_stats, awtrix_stats = ojp.stats(), awtrix.stats()
+            elapsed = now - last_report
+            failed = ojp_stats["requests"] - ojp_stats["statuses"].get(200, 0) - (
+                last_ojp["requests"] - last_ojp["statuses"].get(200, 0))
+            print(f"{(now - started) / 60:>7.1f} {(ojp_stats['requests'] - last_ojp['requests']) / elapsed:>7.2f} "
+                  f"{(awtrix_stats['requests'] - last_awtrix['requests']) / elapsed:>8.2f} {failed:>9} "
+                  f"{format_ms(ojp_latencies.since_last_report()):>34} {rss_mb():>6.1f}MB", file=out)
+            last_report, last_ojp, last_awtrix = now, ojp_stats, awtrix_stats
+            if rss_warm is None:
+                rss_warm, warm_at = rss_mb(), now
+
+        stop.set()
+        thread.join()
+        elapsed = time.perf_counter() - started
+        ojp_stats, awtrix_stats = ojp.stats(), awtrix.stats()
+        rss_end = rss_mb()
+
+    print(f"\nRan {elapsed / 60:.1f} minutes", file=out)
+    print(f"OJP:    {ojp_stats['requests']} requests ({ojp_stats['requests'] / elapsed:.2f}/s), "
+          f"statuses {ojp_stats['statuses']}, {ojp_stats['dropped']} dropped, {format_ms(ojp_latencies.all)}", file=out)
+    print(f"Awtrix: {awtrix_stats['requests']} updates ({awtrix_stats['requests'] / elapsed:.2f}/s), "
+          f"statuses {awtrix_stats['statuses']}, {awtrix_stats['dropped']} dropped, {format_ms(awtrix_latencies.all)}",
+          file=out)
+    print(f"Memory: {rss_start:.1f}MB -> {rss_end:.1f}MB RSS ({rss_end - rss_start:+.1f}MB)", file=out)
+    if rss_warm is not None and started + elapsed - warm_at > 0:
+        print(f"        {(rss_end - rss_warm) / ((started + elapsed - warm_at) / 3600):+.1f}MB/h after the first report",
+              file=out)
+    if snapshot_start is not None:
+        print("Python heap growth by line:", file=out)
+        for stat in tracemalloc.take_snapshot().compare_to(snapshot_start, "lineno")[:10]:
+            print(f"  {stat}", file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Benchmarks the hot paths: parsing OJP responses, the colour calculation, building the
+clock payloads, and twenty simulated minutes of the main loop against a synthetic
+recording. Results are saved as JSON, and can be compared with an earlier run to
+catch a hot path getting slower.
+
+Run from the repository root:
+    PYTHONPATH=src python3 benchmarks/suite.py
+    PYTHONPATH=src python3 benchmarks/suite.py --compare benchmarks/results/abc1234.json
+    PYTHONPATH=src python3 benchmarks/suite.py --filter parse --quick
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from array import array
+from datetime import datetime, timezone
+
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.log import configure_logging
+from tramtrix.ojp import OJPApiClient
+from tramtrix.ojp_requests import location_information_request, trip_request
+from tramtrix.replay import Recorder, replay
+from tramtrix.routes import Clock, Route, RoutesConfig
+from tramtrix.traffic_light import calculate_traffic_light_colour, compute_line_colors
+from ojp_documents import trip_delivery
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+T0 = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+
+# How much slower than the baseline a benchmark may get before --compare fails. The
+# microsecond benchmarks jitter by up to a third between runs on a busy machine, the
+# simulated main loop runs long enough to be held to less
+DEFAULT_THRESHOLD = 1.5
+THRESHOLDS = {
+    "main_cycle": 1.3,
+}
+
+# Routes, clocks and minutes of the simulated main loop
+CYCLE_ROUTES = 4
+CYCLE_MINUTES = 20
+
+
+def bench_parse(trip_results):
+    client = OJPApiClient(api_key="benchmark", url="http://ojp/")
+    document = trip_delivery(trip_results, now=T0)
+    return lambda: client._parse_response(document)
+
+
+def bench_colour(lines, departures):
+    now = T0.timestamp()
+    results = {
+        str(line): array("q", (int(now) + 23 * i + line for i in range(departures)))
+        for line in range(lines)
+    }
+
+    def colours():
+        for times in results.values():
+            calculate_traffic_light_colour(times, now=now)
+    return colours
+
+
+def bench_line_colors(lines, departures):
+    now = T0.timestamp()
+    results = {
+        str(line): array("q", (int(now) + 23 * i + line for i in range(departures)))
+        for line in range(lines)
+    }
+    shown = list(results)
+    return lambda: compute_line_colors(results, shown, now=now, verbose=False)
+
+
+def bench_payload(lines):
+    client = AwtrixClient("http://clock/api/custom?name=tram", session=object())
+    line_colors = {str(line): ("03fc14", "fcca03", "a83632")[line % 3] for line in range(lines)}
+    return lambda: client.build_payload(line_colors)
+
+
+def _location_response(stop_ref):
+    return (
+        '<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">'
+        f"<ojp:PlaceResult><ojp:Place><ojp:StopPoint><ojp:StopPointRef>{stop_ref}</ojp:StopPointRef>"
+        "</ojp:StopPoint></ojp:Place></ojp:PlaceResult></OJP>"
+    )
+
+
+def _entry(t, body, response):
+    return {"service": "ojp", "t": t, "latency": 0.3, "method": "POST", "url": "http://ojp/",
+            "request": body.decode("utf-8"), "status": 200, "headers": {"Content-Type": "application/xml"},
+            "response": response}
+
+
+def cycle_recording(path):
+    """
+    Records CYCLE_MINUTES of synthetic responses, one per route and minute, and the
+    stop lookups. Returns the routes to replay them with.
+    """
+    start = T0.timestamp()
+    routes, clocks = [], []
+    with Recorder(path) as recorder:
+        for number in range(CYCLE_ROUTES):
+            origin, destination = f"Origin {number}", f"Destination {number}"
+            origin_ref, destination_ref = str(8591000 + number), str(8592000 + number)
+            for name, ref in ((origin, origin_ref), (destination, destination_ref)):
+                recorder.write(_entry(start, location_information_request(name, now=start)[0], _location_response(ref)))
+            for minute in range(CYCLE_MINUTES):
+                t = start + minute * 60
+                document = trip_delivery(10, now=datetime.fromtimestamp(t, timezone.utc))
+                recorder.write(_entry(t, trip_request(origin_ref, destination_ref, now=t)[0], document.decode("utf-8")))
+            routes.append(Route(f"route{number}", origin, destination, mode="trip"))
+            clocks.append(Clock(f"clock{number}", f"http://clock{number}/api/custom?name=tram", f"route{number}", ["9", "14"]))
+    return RoutesConfig(routes, clocks)
+
+
+def bench_main_cycle():
+    tmp_dir = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp_dir.name, "cycle.jsonl.gz")
+    routes = cycle_recording(path)
+
+    def cycle():
+        summary = replay(path, routes=routes, latency_scale=0)
+        assert summary["ojp_missed"] == 0, summary
+    cycle.tmp_dir = tmp_dir
+    return cycle
+
+
+BENCHMARKS = {
+    "parse_small": lambda: bench_parse(10),
+    "parse_large": lambda: bench_parse(500),
+    "colour_many_lines": lambda: bench_colour(50, 100),
+    "colour_many_departures": lambda: bench_colour(5, 5000),
+    "line_colors": lambda: bench_line_colors(20, 50),
+    "payload_build": lambda: bench_payload(8),
+    "main_cycle": bench_main_cycle,
+}
+
+# Each timing calls the benchmark often enough to take at least this long, short
+# timings are mostly noise
+MIN_TIMING = 0.2
+
+
+def measure(function, repeat):
+    """
+    The best of repeat timings, in seconds per call.
+    :return: (seconds per call, calls per timing)
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_TIMING:
+            break
+        number = max(number * 2, int(number * MIN_TIMING / max(elapsed, 1e-9) * 1.1))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number) / number)
+    return best, number
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        seconds, number = measure(BENCHMARKS[name](), repeat)
+        results[name] = {"seconds": seconds, "number": number, "repeat": repeat}
+        print(f"{name:>24} {seconds * 1e6:>12.1f}us")
+    return {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(run_results, baseline, threshold=None):
+    """
+    Compares a run with a baseline run.
+    :param threshold: Overrides the allowed slowdown of every benchmark.
+    :return: The names of the benchmarks that got slower than allowed.
+    """
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit', '?')} ({baseline.get('created', '?')}):")
+    for name, result in run_results["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            print(f"{name:>24} {'new':>12}")
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        allowed = threshold if threshold is not None else THRESHOLDS.get(name, DEFAULT_THRESHOLD)
+        slower = ratio > allowed
+        if slower:
+            regressions.append(name)
+        print(f"{name:>24} {ratio:>11.2f}x {'REGRESSION (allowed ' + format(allowed, '.2f') + 'x)' if slower else ''}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--filter", default="", help="Only run the benchmarks whose name contains this")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Timings per benchmark, the best one counts")
+    arg_parser.add_argument("--quick", action="store_true", help="Time each benchmark once")
+    arg_parser.add_argument("--output", help="Where to save the results, by default results/<commit>.json")
+    arg_parser.add_argument("--compare", metavar="BASELINE", help="Results of an earlier run to compare with")
+    arg_parser.add_argument("--threshold", type=float,
+                            help=f"Allowed slowdown against the baseline (default {DEFAULT_THRESHOLD}, per benchmark)")
+    args = arg_parser.parse_args()
+    # main_cycle runs into the request quota on purpose, its warnings aren't results
+    configure_logging("ERROR")
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    if not names:
+        arg_parser.error(f"No benchmark matches '{args.filter}', there are: {', '.join(BENCHMARKS)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    run_results = run(names, 1 if args.quick else args.repeat)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{run_results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(run_results, f, indent=2)
+    print(f"Saved to {output}")
+
+    if baseline is not None:
+        regressions = compare(run_results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) got slower: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
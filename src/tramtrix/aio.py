@@ -0,0 +1,308 @@
+import asyncio
+import functools
+import logging
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from .awtrix import AwtrixClient, batch_updates
+from .ojp import OJPApiClient, MODE_TRIP
+from .main import render
+from .routes import configured_routes
+from .stop_cache import StopRefCache
+from .stop_index import load_stop_index
+from .replay import Recorder
+from .scheduler import QuerySchedule
+from .departure_cache import DepartureCache, report_fetched, report_fetch_failed
+from .log import configure_logging
+from .metrics import serve_metrics
+from .config import (
+    OJP_API_KEY, STOP_CACHE_FILE, STOP_CACHE_TTL, RECORD_FILE, HTTP_POOL_SIZE,
+    FETCH_INTERVAL_MIN, FETCH_INTERVAL_MAX, RENDER_INTERVAL, METRICS_PORT, METRICS_HOST
+)
+
+log = logging.getLogger(__name__)
+
+
+class _AsyncClient:
+    """
+    Runs the blocking calls of a client on its own thread pool, so many requests
+    can be in flight at once without blocking the event loop. The pool is sized to
+    the client's HTTP connection pool.
+    """
+
+    def __init__(self, client, max_workers):
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=type(client).__name__)
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncOJPApiClient(_AsyncClient):
+    def __init__(self, client=None, max_workers=HTTP_POOL_SIZE, **kwargs):
+        """
+        :param client: The OJPApiClient to wrap, by default one is created from kwargs.
+        :param max_workers: Maximum number of concurrent requests.
+        """
+        super().__init__(client if client is not None else OJPApiClient(**kwargs), max_workers)
+
+    async def get_trip_results(self, stop_ref_origin, stop_ref_destination):
+        return await self._call(self.client.get_trip_results, stop_ref_origin, stop_ref_destination)
+
+    async def get_stop_events(self, stop_ref_origin, stop_ref_destination=None):
+        return await self._call(self.client.get_stop_events, stop_ref_origin, stop_ref_destination)
+
+    async def get_departures(self, stop_ref_origin, stop_ref_destination, mode=MODE_TRIP):
+        return await self._call(self.client.get_departures, stop_ref_origin, stop_ref_destination, mode=mode)
+
+    async def resolve_stop_ref(self, stop_name, use_cache=True):
+        return await self._call(self.client.resolve_stop_ref, stop_name, use_cache=use_cache)
+
+
+class AsyncAwtrixClient(_AsyncClient):
+    def __init__(self, client=None, max_workers=1, **kwargs):
+        """
+        :param client: The AwtrixClient to wrap, by default one is created from kwargs.
+        :param max_workers: Maximum number of concurrent pushes to the clock.
+        """
+        super().__init__(client if client is not None else AwtrixClient(**kwargs), max_workers)
+
+    async def update_clock(self, line_colors):
+        return await self._call(self.client.update_clock, line_colors)
+
+    async def flush(self):
+        return await self._call(self.client.flush)
+
+    def next_deadline(self):
+        return self.client.next_deadline()
+
+
+class ClockPusher:
+    """
+    Pushes colours to clocks in the background. Only the latest colours of each clock
+    are kept, so a slow clock skips superseded updates instead of building up a queue,
+    and never holds up fetching. In between, the clocks' coalesced changes, retries and
+    heartbeats are flushed when due. The clocks' updates of one pass are sent together,
+    see clock_pushers.
+    """
+
+    def __init__(self, clocks):
+        """
+        :param clocks: Dictionary of clock name to AsyncAwtrixClient, usually one HTTP
+                       clock or all the clocks on one MQTT broker.
+        """
+        self.clocks = clocks
+        self._latest = {}
+        self._pending = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+
+    def start(self):
+        self._pending = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, name, line_colors):
+        self._latest[name] = line_colors
+        self._pending.set()
+
+    def next_deadline(self):
+        deadlines = [deadline for deadline in (clock.next_deadline() for clock in self.clocks.values())
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline = self.next_deadline()
+            await _wait(self._pending, None if deadline is None else deadline - time.time())
+            self._pending.clear()
+            latest, self._latest = self._latest, {}
+            await loop.run_in_executor(self._executor, self._push, latest)
+
+    def _push(self, latest):
+        # Clocks on the same MQTT broker are updated in one write
+        with batch_updates(clock.client for clock in self.clocks.values()):
+            for name, clock in self.clocks.items():
+                try:
+                    if name in latest:
+                        clock.client.update_clock(latest[name])
+                    else:
+                        clock.client.flush()
+                except Exception as e:
+                    log.warning("Could not update clock %s: %s", name, e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+
+def clock_pushers(clocks):
+    """
+    One ClockPusher per HTTP clock and one per MQTT broker, pushing all of the broker's
+    clocks together.
+    :param clocks: Dictionary of clock name to AsyncAwtrixClient.
+    :return: Dictionary of clock name to the ClockPusher pushing it.
+    """
+    groups, brokers = [], []
+    for name, clock in clocks.items():
+        connection = getattr(clock.client, "mqtt", None)
+        for broker, group in brokers:
+            if connection is not None and broker is connection:
+                group[name] = clock
+                break
+        else:
+            groups.append({name: clock})
+            if connection is not None:
+                brokers.append((connection, groups[-1]))
+    pushers = [ClockPusher(group) for group in groups]
+    return {name: pusher for pusher in pushers for name in pusher.clocks}
+
+
+async def _wait(stop, timeout):
+    """
+    Sleeps for up to timeout seconds (forever if None), returning early once stop is set.
+    """
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=None if timeout is None else max(timeout, 0))
+    except asyncio.TimeoutError:
+        pass
+
+
+async def fetch_query(client, query, cache, stop, policy=None):
+    """
+    Fetches the departures of a query into the cache whenever its schedule says so, at
+    the latest when the cached ones turn stale, until stop is set.
+    """
+    schedule = QuerySchedule(query, policy)
+    while not stop.is_set():
+        now = time.time()
+        if schedule.fetch_due(now):
+            started = time.perf_counter()
+            try:
+                log.debug("Fetching tram data (%s -> %s)...", query.stop_ref_origin, query.stop_ref_destination)
+                results = await client.get_departures(query.stop_ref_origin, query.stop_ref_destination, query.mode)
+                schedule.fetched(results, now)
+                cache.put(query, results, schedule.timelines, now)
+                schedule.next_fetch_at = min(schedule.next_fetch_at, cache.revalidate_at(query))
+                report_fetched(query, results, time.perf_counter() - started, schedule.next_fetch_at - now)
+            except Exception as e:
+                delay = schedule.fetch_failed(now, getattr(e, "retry_after", None))
+                report_fetch_failed(query, e, delay)
+        await _wait(stop, schedule.next_fetch_at - time.time())
+
+
+async def render_clocks(queries, pushers, cache, stop, interval=RENDER_INTERVAL):
+    """
+    Recalculates each clock's colours from the cached departures every interval seconds
+    and hands them to its pusher whenever they change, until stop is set.
+    :param pushers: Dictionary of clock name to ClockPusher, see clock_pushers.
+    """
+    states, colours = {}, {}
+    while not stop.is_set():
+        now = time.time()
+        for clock, line_colors, changed in render(cache, queries, states, colours, now):
+            if changed:
+                pushers[clock.name].submit(clock.name, line_colors)
+        await _wait(stop, interval - (time.time() - now))
+
+
+async def run(client, clocks, queries, stop, policy=None, render_interval=RENDER_INTERVAL, cache=None):
+    """
+    Fetches all queries concurrently in the background and renders the clocks from the
+    cached departures, until stop is set.
+    :param client: An AsyncOJPApiClient.
+    :param clocks: Dictionary of clock name to AsyncAwtrixClient.
+    :param queries: The Queries to fetch, see RoutesConfig.queries.
+    :param stop: asyncio.Event that ends the loop when set.
+    :param policy: The FetchPolicy deciding how often to fetch.
+    :param cache: The DepartureCache to use, by default a new one.
+    """
+    cache = cache if cache is not None else DepartureCache()
+    pushers = clock_pushers(clocks)
+    for pusher in dict.fromkeys(pushers.values()):
+        pusher.start()
+    try:
+        await asyncio.gather(
+            render_clocks(queries, pushers, cache, stop, render_interval),
+            *(fetch_query(client, query, cache, stop, policy) for query in queries)
+        )
+    finally:
+        for pusher in dict.fromkeys(pushers.values()):
+            await pusher.stop()
+
+
+def _install_signal_handlers(stop):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Not supported on this platform (e.g. Windows), fall back to KeyboardInterrupt
+            pass
+
+
+async def async_main():
+    stop = asyncio.Event()
+    _install_signal_handlers(stop)
+
+    routes = configured_routes()
+    stop_cache = StopRefCache(STOP_CACHE_FILE, ttl=STOP_CACHE_TTL) if STOP_CACHE_FILE else None
+    async with AsyncExitStack() as stack:
+        if METRICS_PORT:
+            stack.enter_context(serve_metrics(METRICS_PORT, METRICS_HOST))
+        recorder = stack.enter_context(Recorder(RECORD_FILE)) if RECORD_FILE else None
+        client = await stack.enter_async_context(
+            AsyncOJPApiClient(stop_cache=stop_cache, stop_index=load_stop_index(), recorder=recorder)
+        )
+        clocks = {}
+        for clock in routes.clocks:
+            clocks[clock.name] = await stack.enter_async_context(AsyncAwtrixClient(url=clock.url, recorder=recorder))
+
+        stop_names = routes.stop_names()
+        log.info("Resolving StopPointRefs for %s...", ", ".join(repr(name) for name in stop_names))
+        stop_refs = dict(zip(stop_names, await asyncio.gather(*(client.resolve_stop_ref(name) for name in stop_names))))
+        log.info("Found: %s", ", ".join(stop_refs.values()))
+        queries = routes.queries(stop_refs)
+
+        log.info("Starting Tramtrix async loop (Interval: %s-%ss, %d routes, %d clocks)",
+                 FETCH_INTERVAL_MIN, FETCH_INTERVAL_MAX, len(queries), len(clocks))
+        await run(client, clocks, queries, stop)
+        log.info("Stopped.")
+
+
+def main():
+    try:
+        configure_logging()
+        if not OJP_API_KEY:
+            log.error("OJP_API_KEY environment variable is not set.")
+            sys.exit(1)
+
+        asyncio.run(async_main())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,84 @@
+import functools
+import json
+import logging
 import requests
-from string import Template
-from .config import AWTRIX_URL
+import time
+from contextlib import ExitStack, contextmanager
+from .config import (
+    AWTRIX_URL, HTTP_CONNECT_TIMEOUT, AWTRIX_READ_TIMEOUT,
+    AWTRIX_HEARTBEAT, AWTRIX_MIN_INTERVAL, AWTRIX_RETRY_INTERVAL, AWTRIX_LIFETIME
+)
+from .metrics import AWTRIX_PUSHES, AWTRIX_PUSH_SECONDS
+from .mqtt import MQTTConnection, MQTTError, parse_mqtt_url
+from .session import create_session
+
+log = logging.getLogger(__name__)
 
 class AwtrixClient:
-    def __init__(self, url=AWTRIX_URL):
+    def __init__(self, url=AWTRIX_URL, session=None, timeout=(HTTP_CONNECT_TIMEOUT, AWTRIX_READ_TIMEOUT),
+                 heartbeat=AWTRIX_HEARTBEAT, min_interval=AWTRIX_MIN_INTERVAL,
+                 retry_interval=AWTRIX_RETRY_INTERVAL, lifetime=AWTRIX_LIFETIME, clock=time.time, mqtt=None,
+                 recorder=None):
+        """
+        :param url: The clock's custom app URL, either its HTTP API
+                    (http://clock/api/custom?name=tram) or its MQTT topic on a broker
+                    (mqtt://broker:1883/awtrix_a1b2c3/custom/tram, see parse_mqtt_url).
+        :param session: A requests Session to send requests with, by default the client
+                        creates (and closes) its own pooled keep-alive session.
+        :param timeout: (connect, read) timeouts in seconds for every request.
+        :param heartbeat: Seconds after which an unchanged payload is sent again (0 to disable).
+        :param min_interval: Minimum seconds between two pushes, changes in between are coalesced.
+        :param retry_interval: Seconds before a failed push is retried.
+        :param lifetime: Seconds after which the clock removes the app if it isn't updated (0 to disable).
+        :param clock: Function returning the current time in epoch seconds.
+        :param mqtt: The MQTTConnection to publish with for an MQTT URL, by default the
+                     connection shared by all clocks on the URL's broker.
+        :param recorder: A replay.Recorder to record every HTTP request and response to.
+        """
         self.url = url
         self.headers = {
             "Content-Type": "application/json",
         }
+        self.timeout = timeout
+        self.mqtt = None
+        self._owns_mqtt = False
+        if url and url.startswith(("mqtt://", "mqtts://")):
+            broker, self.topic, self.qos = parse_mqtt_url(url)
+            self._owns_mqtt = mqtt is None
+            self.mqtt = MQTTConnection.shared(**broker, timeout=timeout) if mqtt is None else mqtt
+        self._owns_session = session is None and self.mqtt is None
+        self.session = create_session(pool_size=1) if self._owns_session else session
+        if recorder is not None and self.session is not None:
+            recorder.attach(self.session, "awtrix")
+        self.heartbeat = heartbeat
+        self.min_interval = min_interval
+        self.retry_interval = retry_interval
+        self.lifetime = lifetime
+        self.clock = clock
 
-    def update_clock(self, line_colors):
+        # The payload the clock should show, and the last one it accepted
+        self._payload = None
+        self._delivered = None
+        self._delivered_at = None
+        self._attempted_at = None
+        self._failed = False
+
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+        if self._owns_mqtt:
+            self.mqtt.release()
+            self._owns_mqtt = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def build_payload(self, line_colors):
         """
-        Updates the clock with the given line colors.
-        :param line_colors: Dictionary of line number (str) to hex color (str)
-                            e.g. {'9': 'a83632', '14': '03fc14'}
+        Builds the custom app payload for the given line colors.
         """
         text_elements = []
         for line, color in line_colors.items():
@@ -26,11 +91,106 @@ class AwtrixClient:
             "text": text_elements,
             "repeat": 1
         }
-        
+        if self.lifetime:
+            payload["lifetime"] = self.lifetime
+        return payload
+
+    def update_clock(self, line_colors):
+        """
+        Updates the clock with the given line colors. Nothing is sent if the clock already
+        shows them, unless the heartbeat is due, and changes arriving within min_interval
+        of the previous push are held back until flush() is called at next_deadline().
+        :param line_colors: Dictionary of line number (str) to hex color (str)
+                            e.g. {'9': 'a83632', '14': '03fc14'}
+        :return: False if the clock could not be updated, True otherwise.
+        """
+        self._payload = self.build_payload(line_colors)
+        return self.flush()
+
+    def next_deadline(self):
+        """
+        The time (epoch seconds) flush() next has something to send, or None.
+        """
+        if self._payload is None:
+            return None
+        if self._failed:
+            return self._attempted_at + self.retry_interval
+        if self._payload != self._delivered:
+            if self._attempted_at is None:
+                return self.clock()
+            return self._attempted_at + self.min_interval
+        if self.heartbeat:
+            return self._delivered_at + self.heartbeat
+        return None
+
+    def flush(self):
+        """
+        Sends the pending payload or the heartbeat if either is due.
+        :return: False if the clock could not be updated, True otherwise.
+        """
+        deadline = self.next_deadline()
+        if deadline is None or self.clock() < deadline:
+            return not self._failed
+        return self._send(self._payload)
+
+    def _send(self, payload):
+        self._attempted_at = self.clock()
+        self._failed = True
+        if self.mqtt is not None:
+            return self._publish(payload)
         try:
-            response = requests.post(self.url, headers=self.headers, json=payload, timeout=5)
+            with AWTRIX_PUSH_SECONDS.time(transport="http"):
+                response = self.session.post(self.url, headers=self.headers, json=payload, timeout=self.timeout)
             if response.status_code != 200:
-                print(f"Warning: Clocky API call failed with status code {response.status_code}: {response.text}")
+                AWTRIX_PUSHES.inc(transport="http", outcome="failed")
+                log.warning("Clocky API call failed with status code %d: %s", response.status_code, response.text,
+                            extra={"url": self.url, "status": response.status_code})
+                return False
         except requests.exceptions.RequestException as e:
-            print(f"Warning: Could not connect to Clocky: {e}")
+            AWTRIX_PUSHES.inc(transport="http", outcome="failed")
+            log.warning("Could not connect to Clocky: %s", e, extra={"url": self.url, "error": str(e)})
+            return False
+        AWTRIX_PUSHES.inc(transport="http", outcome="ok")
+        self._failed = False
+        self._delivered = payload
+        self._delivered_at = self._attempted_at
+        return True
+
+    def _publish(self, payload):
+        data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        started = time.perf_counter()
+        try:
+            self.mqtt.publish(self.topic, data, qos=self.qos, callback=functools.partial(self._published, payload, started))
+        except MQTTError:
+            # Already reported to _published
+            return False
+        return not self._failed
+
+    def _published(self, payload, started, error):
+        AWTRIX_PUSH_SECONDS.observe(time.perf_counter() - started, transport="mqtt")
+        if error is not None:
+            AWTRIX_PUSHES.inc(transport="mqtt", outcome="failed")
+            log.warning("Could not publish to Clocky: %s", error, extra={"topic": self.topic, "error": str(error)})
+            return
+        AWTRIX_PUSHES.inc(transport="mqtt", outcome="ok")
+        self._failed = False
+        self._delivered = payload
+        self._delivered_at = self._attempted_at
+
 
+@contextmanager
+def batch_updates(clocks):
+    """
+    Sends the updates made inside the block to clocks sharing an MQTT broker together,
+    in one write per broker. HTTP clocks are updated right away as always. Whether a
+    batched update reached its clock is only known once the block ends.
+    :param clocks: The AwtrixClients about to be updated.
+    """
+    with ExitStack() as stack:
+        connections = []
+        for clock in clocks:
+            connection = getattr(clock, "mqtt", None)
+            if connection is not None and all(connection is not c for c in connections):
+                connections.append(connection)
+                stack.enter_context(connection.batch())
+        yield
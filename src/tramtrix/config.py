@@ -1,7 +1,90 @@
+import json
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+
+def _find_dotenv():
+    """
+    The .env file load_dotenv() would find: the first one in this module's directory or
+    above it, or None.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, ".env")
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def _write_private(path, text):
+    """
+    Replaces the file atomically with one only the user can read, it may hold secrets
+    like OJP_API_KEY.
+    """
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_dotenv_snapshot(snapshot_path, path=None):
+    """
+    Loads the .env file like load_dotenv(), but keeps the parsed values in snapshot_path
+    and reads them from there while the .env file is unchanged, skipping python-dotenv
+    (and its import) altogether. Variables already set in the environment win.
+    :param path: The .env file, by default the one load_dotenv() would find.
+    :return: The values of the .env file, by variable name.
+    """
+    path = path or _find_dotenv()
+    stat = os.stat(path) if path else None
+    key = [path, stat.st_mtime_ns, stat.st_size] if stat else None
+    try:
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            # Others may read it (written by an older version), write it again privately
+            private = os.name != "posix" or not os.fstat(f.fileno()).st_mode & 0o077
+            snapshot = json.load(f)
+        values = snapshot["values"] if private and snapshot.get("key") == key else None
+    except (OSError, ValueError, KeyError, AttributeError):
+        values = None
+
+    if values is None:
+        values = {}
+        if path:
+            from dotenv import dotenv_values
+            values = {name: value for name, value in dotenv_values(path).items() if value is not None}
+        try:
+            _write_private(snapshot_path, json.dumps({"key": key, "values": values}))
+        except OSError:
+            pass
+
+    for name, value in values.items():
+        os.environ.setdefault(name, value)
+    return values
+
+
+# Set DOTENV_SNAPSHOT_FILE (in the environment, not in .env) to keep the parsed .env file
+# there, as the one-shot command (tramtrix-once) does to start faster
+DOTENV_SNAPSHOT_FILE = os.getenv("DOTENV_SNAPSHOT_FILE")
+if DOTENV_SNAPSHOT_FILE:
+    load_dotenv_snapshot(DOTENV_SNAPSHOT_FILE)
+else:
+    from dotenv import load_dotenv
+    load_dotenv()
 
 OJP_API_KEY = os.getenv("OJP_API_KEY")
 OJP_URL = os.getenv("OJP_URL", "https://api.opentransportdata.swiss/ojp20")
@@ -18,6 +101,23 @@ STOP_NAME_DESTINATION = os.getenv("STOP_NAME_DESTINATION", "Zürich, Stauffacher
 # Defaults to "9,14" if not specified
 TRAM_LINES = [x.strip() for x in os.getenv("TRAM_LINES", "9,14").split(",") if x.strip()]
 
+# Optional JSON file declaring several routes and clocks, see routes.py for the format
+# When set, STOP_NAME_ORIGIN, STOP_NAME_DESTINATION and AWTRIX_URL are not used
+ROUTES_CONFIG_FILE = os.getenv("ROUTES_CONFIG_FILE")
+
+# How departures are fetched: "trip" plans trips from origin to destination (OJPTripRequest),
+# "stop_event" reads the origin's departure board (OJPStopEventRequest), which is lighter
+# for the API. Can be set per route in ROUTES_CONFIG_FILE.
+FETCH_MODE = os.getenv("FETCH_MODE", "trip")
+
+# "trip_incremental" plans trips like "trip", but keeps the departures it already knows:
+# each fetch only asks for the next TRIP_REFRESH_RESULTS trips (for their realtime
+# estimates), plus TRIP_EXTEND_RESULTS trips after the last known one whenever less than
+# TRIP_LOOKAHEAD minutes of departures are known
+TRIP_REFRESH_RESULTS = int(os.getenv("TRIP_REFRESH_RESULTS", "4"))
+TRIP_EXTEND_RESULTS = int(os.getenv("TRIP_EXTEND_RESULTS", "10"))
+TRIP_LOOKAHEAD = int(os.getenv("TRIP_LOOKAHEAD", "60"))
+
 # Traffic light time rules (in minutes)
 # Green window: TIME_AMBER_MAX < t <= TIME_GREEN_MAX
 TIME_GREEN_MAX = int(os.getenv("TIME_GREEN_MAX", "6"))
@@ -32,3 +132,114 @@ TIME_AMBER_MIN = int(os.getenv("TIME_AMBER_MIN", "2"))
 # Update interval in seconds
 UPDATE_INTERVAL = int(os.getenv("UPDATE_INTERVAL", "60"))
 
+# Adaptive fetching: the departures are fetched every FETCH_INTERVAL_MIN seconds while
+# a realtime estimate keeps moving by more than FETCH_VOLATILE_SECONDS, and only every
+# FETCH_INTERVAL_MAX seconds when no tram is due within FETCH_IDLE_HORIZON minutes.
+# Otherwise FETCH_INTERVAL_MIN seconds before the first colour change more than
+# UPDATE_INTERVAL seconds away, waiting at least UPDATE_INTERVAL seconds.
+# The clock is updated in between whenever a colour changes.
+FETCH_INTERVAL_MIN = int(os.getenv("FETCH_INTERVAL_MIN", "20"))
+FETCH_INTERVAL_MAX = int(os.getenv("FETCH_INTERVAL_MAX", "600"))
+FETCH_IDLE_HORIZON = int(os.getenv("FETCH_IDLE_HORIZON", "30"))
+FETCH_VOLATILE_SECONDS = int(os.getenv("FETCH_VOLATILE_SECONDS", "30"))
+
+
+# Departures are fetched in the background, and the clocks are recalculated from the last
+# ones every RENDER_INTERVAL seconds. Departures older than DEPARTURES_FRESH_FOR seconds are
+# fetched again, and after DEPARTURES_STALE_FOR seconds without a successful fetch they
+# are no longer shown.
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", "1"))
+DEPARTURES_FRESH_FOR = int(os.getenv("DEPARTURES_FRESH_FOR", str(FETCH_INTERVAL_MAX)))
+DEPARTURES_STALE_FOR = int(os.getenv("DEPARTURES_STALE_FOR", "3600"))
+
+# Server mode (tramtrix-server): address to listen on, and seconds the departures of a
+# route are shared between requests before they are fetched again
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_CACHE_TTL = int(os.getenv("SERVER_CACHE_TTL", "30"))
+# Routes the server keeps departures of (the least recently fetched are dropped first),
+# and whether it only answers the routes configured in ROUTES_CONFIG_FILE (or .env)
+SERVER_MAX_ROUTES = int(os.getenv("SERVER_MAX_ROUTES", "100"))
+SERVER_ROUTES_ONLY = os.getenv("SERVER_ROUTES_ONLY", "false").lower() in ("1", "true", "yes")
+
+# HTTP connection settings shared by the OJP and Awtrix clients
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "4"))
+HTTP_KEEP_ALIVE = os.getenv("HTTP_KEEP_ALIVE", "true").lower() in ("1", "true", "yes")
+# Only the clocks' connections retry, OJP requests are retried through the quota and breaker
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+
+# Read timeouts (in seconds), OJP trip requests can take a few seconds to calculate
+OJP_READ_TIMEOUT = float(os.getenv("OJP_READ_TIMEOUT", "15"))
+AWTRIX_READ_TIMEOUT = float(os.getenv("AWTRIX_READ_TIMEOUT", "5"))
+
+# OJP request quota: requests are spread so that no more than OJP_DAILY_QUOTA are made
+# per day, with bursts of up to OJP_RATE_BURST (e.g. at startup). All routes share it.
+# Stop names are resolved at startup, waiting up to OJP_RESOLVE_WAIT seconds for the quota.
+OJP_DAILY_QUOTA = int(os.getenv("OJP_DAILY_QUOTA", "20000"))
+OJP_RATE_BURST = int(os.getenv("OJP_RATE_BURST", "10"))
+OJP_RESOLVE_WAIT = float(os.getenv("OJP_RESOLVE_WAIT", "60"))
+
+# After OJP_BREAKER_FAILURES failed requests in a row the API is left alone for
+# OJP_BREAKER_RESET seconds (doubled each time it fails again, up to OJP_BREAKER_RESET_MAX),
+# and the clocks keep showing the last known departures.
+OJP_BREAKER_FAILURES = int(os.getenv("OJP_BREAKER_FAILURES", "5"))
+OJP_BREAKER_RESET = float(os.getenv("OJP_BREAKER_RESET", "30"))
+OJP_BREAKER_RESET_MAX = float(os.getenv("OJP_BREAKER_RESET_MAX", "600"))
+
+# Clock updates: unchanged colours are only sent again every AWTRIX_HEARTBEAT seconds,
+# and changes are sent at most every AWTRIX_MIN_INTERVAL seconds (more are coalesced).
+# Set AWTRIX_LIFETIME to have the clock remove the app after that many seconds without
+# an update, e.g. when tramtrix stops. It should be longer than AWTRIX_HEARTBEAT.
+AWTRIX_HEARTBEAT = int(os.getenv("AWTRIX_HEARTBEAT", "300"))
+AWTRIX_MIN_INTERVAL = float(os.getenv("AWTRIX_MIN_INTERVAL", "1"))
+AWTRIX_RETRY_INTERVAL = float(os.getenv("AWTRIX_RETRY_INTERVAL", "20"))
+AWTRIX_LIFETIME = int(os.getenv("AWTRIX_LIFETIME", "0"))
+
+# Clocks can also be updated over MQTT, by giving them an mqtt:// (or mqtts://) URL with
+# the custom app topic, e.g. mqtt://broker:1883/awtrix_a1b2c3/custom/tram. Clocks on the
+# same broker share one connection. AWTRIX_MQTT_QOS is the QoS used unless the URL sets
+# ?qos=, and MQTT_KEEPALIVE the seconds the connection never stays silent for (it is
+# pinged in the background, 0 to never ping).
+AWTRIX_MQTT_QOS = int(os.getenv("AWTRIX_MQTT_QOS", "1"))
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "60"))
+
+# Cache of resolved stop names, so restarts don't need to call the API
+# Set STOP_CACHE_FILE to an empty string to disable the cache
+STOP_CACHE_FILE = os.getenv(
+    "STOP_CACHE_FILE",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tramtrix", "stop_refs.json")
+)
+
+# How long a resolved stop name stays valid (in seconds), defaults to one week
+STOP_CACHE_TTL = int(os.getenv("STOP_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Offline stop index, built from a stop list with `tramtrix-stops build`. When the file
+# exists, stop names are looked up in it before asking the API
+STOP_INDEX_FILE = os.getenv(
+    "STOP_INDEX_FILE",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tramtrix", "stops.idx")
+)
+
+# Record every OJP and Awtrix request and response to this file (gzip compressed JSON
+# lines), to replay them later with `tramtrix-replay`. Unset to not record
+RECORD_FILE = os.getenv("RECORD_FILE")
+
+# Logging: the lowest level to log (DEBUG adds every API request and its latency),
+# and text lines or JSON objects for a log collector
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# Serve Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics. Unset (or 0) to
+# not collect metrics at all
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# One-shot mode (tramtrix-once, e.g. from a cron job or systemd timer): the departures,
+# fetch schedule and last clock colours kept between runs, so a run only fetches and
+# pushes what is due
+ONESHOT_STATE_FILE = os.getenv(
+    "ONESHOT_STATE_FILE",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tramtrix", "oneshot.json")
+)
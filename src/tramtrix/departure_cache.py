@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+from .metrics import FETCH_ERRORS
+from .scheduler import QuerySchedule
+from .config import DEPARTURES_FRESH_FOR, DEPARTURES_STALE_FOR
+
+FRESH = "fresh"
+STALE = "stale"
+EXPIRED = "expired"
+MISSING = "missing"
+
+log = logging.getLogger(__name__)
+
+
+def report_fetched(query, results, seconds, next_fetch_in):
+    """
+    Logs a successful fetch of a query's departures.
+    :param seconds: How long the fetch took.
+    :param next_fetch_in: Seconds until the next fetch.
+    """
+    count = sum(len(results[line]) for line in results)
+    log.info(
+        "Fetched %d departures (%s -> %s) in %.2fs, next fetch in %.0fs",
+        count, query.stop_ref_origin, query.stop_ref_destination, seconds, next_fetch_in,
+        extra={"origin": query.stop_ref_origin, "destination": query.stop_ref_destination, "mode": query.mode,
+               "departures": count, "seconds": seconds, "next_fetch_in": next_fetch_in},
+    )
+
+
+def report_fetch_failed(query, error, retry_in):
+    """
+    Logs and counts a failed fetch of a query's departures.
+    :param retry_in: Seconds until the fetch is retried.
+    """
+    FETCH_ERRORS.inc(origin=query.stop_ref_origin, destination=query.stop_ref_destination)
+    log.warning(
+        "Could not fetch departures (%s -> %s): %s (retrying in %.0fs)",
+        query.stop_ref_origin, query.stop_ref_destination, error, retry_in,
+        extra={"origin": query.stop_ref_origin, "destination": query.stop_ref_destination, "mode": query.mode,
+               "error": str(error), "retry_in": retry_in},
+    )
+
+
+class CachedDepartures:
+    __slots__ = ("results", "timelines", "fetched_at")
+
+    def __init__(self, results, timelines, fetched_at):
+        """
+        :param results: Departures, as returned by get_departures.
+        :param timelines: ColourTimelines by line for the departures.
+        :param fetched_at: Epoch seconds the departures were fetched.
+        """
+        self.results = results
+        self.timelines = timelines
+        self.fetched_at = fetched_at
+
+
+class DepartureCache:
+    """
+    The last departures of each query, written by the fetchers and read by the render
+    loop, so showing colours never waits for the network. Entries are:
+    - fresh for fresh_for seconds after they were fetched
+    - stale after that, still shown while a new fetch is due (stale-while-revalidate)
+    - expired after stale_for seconds, when they are no longer shown at all
+    Thread-safe.
+    """
+
+    def __init__(self, fresh_for=DEPARTURES_FRESH_FOR, stale_for=DEPARTURES_STALE_FOR, clock=time.time,
+                 max_entries=None):
+        """
+        :param clock: Function returning the current time in epoch seconds.
+        :param max_entries: The most queries kept, the least recently fetched ones are
+                            dropped first. None for no limit.
+        """
+        self.fresh_for = fresh_for
+        self.stale_for = max(stale_for, fresh_for)
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, results, timelines=None, now=None):
+        """
+        :param key: The Query (or other key) the departures belong to.
+        :param now: Epoch seconds the departures were fetched, by default the current time.
+        """
+        entry = CachedDepartures(results, timelines or {}, self._clock() if now is None else now)
+        with self._lock:
+            # Dicts keep their order, the first entry is the least recently fetched
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            if self.max_entries is not None:
+                while len(self._entries) > self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+
+    def state(self, key, now=None):
+        """
+        FRESH, STALE, EXPIRED or MISSING (never fetched).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return self._state(entry, self._clock() if now is None else now)
+
+    def _state(self, entry, now):
+        if entry is None:
+            return MISSING
+        age = now - entry.fetched_at
+        if age <= self.fresh_for:
+            return FRESH
+        if age <= self.stale_for:
+            return STALE
+        return EXPIRED
+
+    def get(self, key, now=None):
+        """
+        :return: (CachedDepartures or None, state). Expired departures are not returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        state = self._state(entry, self._clock() if now is None else now)
+        return (entry if state in (FRESH, STALE) else None), state
+
+    def revalidate_at(self, key):
+        """
+        Epoch seconds the departures turn stale and should have been fetched again, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else entry.fetched_at + self.fresh_for
+
+
+class FetchWorker:
+    """
+    Fetches the departures of a query into a DepartureCache whenever its schedule says so,
+    at the latest when the cached departures turn stale. Runs on its own thread after
+    start(), or is driven by calling fetch_if_due().
+    """
+
+    def __init__(self, client, query, cache, policy=None, clock=time.time):
+        """
+        :param client: The OJPApiClient to fetch with.
+        :param query: The Query to fetch, see RoutesConfig.queries.
+        :param policy: The FetchPolicy deciding how often to fetch.
+        :param clock: Function returning the current time in epoch seconds.
+        """
+        self.client = client
+        self.query = query
+        self.cache = cache
+        self.schedule = QuerySchedule(query, policy)
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def next_fetch_at(self):
+        return self.schedule.next_fetch_at
+
+    def fetch_if_due(self, now=None):
+        """
+        Fetches the departures if they are due, keeping the cached ones on failure.
+        :return: Epoch seconds the next fetch is due.
+        """
+        now = self._clock() if now is None else now
+        if not self.schedule.fetch_due(now):
+            return self.schedule.next_fetch_at
+
+        query = self.query
+        started = time.perf_counter()
+        try:
+            log.debug("Fetching tram data (%s -> %s)...", query.stop_ref_origin, query.stop_ref_destination)
+            results = self.client.get_departures(
+                stop_ref_origin=query.stop_ref_origin,
+                stop_ref_destination=query.stop_ref_destination,
+                mode=query.mode
+            )
+            self.schedule.fetched(results, now)
+            self.cache.put(query, results, self.schedule.timelines, now)
+            # Revalidate before the departures go stale, however quiet the schedule is
+            self.schedule.next_fetch_at = min(self.schedule.next_fetch_at, self.cache.revalidate_at(query))
+            report_fetched(query, results, time.perf_counter() - started, self.schedule.next_fetch_at - now)
+        except Exception as e:
+            delay = self.schedule.fetch_failed(now, getattr(e, "retry_after", None))
+            report_fetch_failed(query, e, delay)
+        return self.schedule.next_fetch_at
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"fetch {self.query.stop_ref_origin}->{self.query.stop_ref_destination}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            next_fetch_at = self.fetch_if_due()
+            self._stop.wait(max(next_fetch_at - self._clock(), 0))
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread, waiting up to timeout seconds for a fetch in progress to finish.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
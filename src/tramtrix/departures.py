@@ -0,0 +1,244 @@
+import functools
+import re
+from array import array
+from collections.abc import Mapping
+from datetime import date, datetime, timezone
+
+
+# datetime.fromisoformat only takes 3 or 6 digit fractions before Python 3.11
+_FRACTION = re.compile(r"(:\d\d)\.\d+")
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@functools.lru_cache(maxsize=64)
+def _midnight(day):
+    # Epoch seconds of midnight UTC of a 'YYYY-MM-DD' date, every departure of a day shares it
+    return (date.fromisoformat(day).toordinal() - _EPOCH_ORDINAL) * 86400
+
+
+def _parse_fixed(text):
+    """
+    Epoch seconds of a timestamp in the layout OJP sends, 'YYYY-MM-DDTHH:MM:SS' with an
+    optional fraction and 'Z', '+HH:MM', '-HH:MM' or no offset, or None for anything else.
+    """
+    if len(text) < 19 or text[10] != "T" or text[13] != ":" or text[16] != ":":
+        return None
+    clock = text[11:13] + text[14:16] + text[17:19]
+    if not (clock.isascii() and clock.isdigit()):
+        return None
+    hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+
+    offset = text[19:]
+    if offset[:1] == ".":
+        offset = offset[1:].lstrip("0123456789")
+        if len(offset) == len(text) - 20:
+            return None
+    if offset == "Z" or offset == "":
+        offset_seconds = 0
+    elif len(offset) == 6 and offset[0] in "+-" and offset[3] == ":":
+        digits = offset[1:3] + offset[4:6]
+        if not (digits.isascii() and digits.isdigit()) or int(offset[1:3]) > 23 or int(offset[4:6]) > 59:
+            return None
+        offset_seconds = int(offset[1:3]) * 3600 + int(offset[4:6]) * 60
+        if offset[0] == "-":
+            offset_seconds = -offset_seconds
+    else:
+        return None
+    return _midnight(text[:10]) + hour * 3600 + minute * 60 + second - offset_seconds
+
+
+# Departure times repeat across legs and from one fetch to the next, so the most
+# recently parsed timestamps are remembered
+@functools.lru_cache(maxsize=8192)
+def parse_iso8601(text):
+    """
+    Parses an OJP timestamp to integer epoch seconds, e.g. '2026-01-06T12:00:00Z' or
+    '2026-01-06T13:00:00.5+01:00'. Fractions of a second are dropped and timestamps
+    without an offset are taken as UTC. The fixed layout OJP sends is sliced apart,
+    anything else is left to datetime.fromisoformat.
+    :raises ValueError: If the text is not an ISO 8601 timestamp.
+    """
+    epoch = _parse_fixed(text)
+    if epoch is not None:
+        return epoch
+
+    normalised = text[:-1] + "+00:00" if text.endswith("Z") else text
+    if "." in normalised:
+        normalised = _FRACTION.sub(r"\1", normalised, count=1)
+    dt = datetime.fromisoformat(normalised)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+class Departure:
+    """
+    A single departure and what is known about it.
+    Times are integer epoch seconds.
+    """
+
+    __slots__ = ("line", "time", "planned_time", "stop_ref", "journey_ref", "operating_day")
+
+    def __init__(self, line, time, planned_time=None, stop_ref=None, journey_ref=None, operating_day=None):
+        """
+        :param time: The estimated (realtime) departure time.
+        :param planned_time: The timetabled departure time, if known.
+        :param stop_ref: StopPointRef the tram departs from, if known.
+        :param journey_ref: The JourneyRef identifying the tram's journey, if known.
+        :param operating_day: The OperatingDayRef the journey belongs to, if known.
+        """
+        self.line = line
+        self.time = time
+        self.planned_time = planned_time
+        self.stop_ref = stop_ref
+        self.journey_ref = journey_ref
+        self.operating_day = operating_day
+
+    @property
+    def delay(self):
+        """
+        Seconds the departure is behind its timetable, or None if unknown.
+        """
+        return None if self.planned_time is None else self.time - self.planned_time
+
+    def __eq__(self, other):
+        if not isinstance(other, Departure):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return f"Departure({', '.join(f'{slot}={getattr(self, slot)!r}' for slot in self.__slots__)})"
+
+
+class Departures(Mapping):
+    """
+    Departure times by line, each a sorted array of integer epoch seconds, e.g.
+    {'9': array('q', [1767700800, 1767701040]), '14': array('q', [1767700920])}.
+    The Departure details behind each time are available from details().
+    """
+
+    __slots__ = ("_times", "_details")
+
+    def __init__(self, departures=()):
+        """
+        :param departures: Iterable of Departure, in any order. Repeated times on the
+                           same line are only kept once.
+        """
+        by_line = {}
+        for departure in departures:
+            by_line.setdefault(departure.line, {}).setdefault(departure.time, departure)
+
+        self._times = {}
+        self._details = {}
+        for line, by_time in by_line.items():
+            times = sorted(by_time)
+            self._times[line] = array("q", times)
+            self._details[line] = [by_time[t] for t in times]
+
+    def __getitem__(self, line):
+        return self._times[line]
+
+    def __iter__(self):
+        return iter(self._times)
+
+    def __len__(self):
+        return len(self._times)
+
+    def details(self, line):
+        """
+        The Departures of a line, sorted by time.
+        """
+        return self._details.get(line, [])
+
+    def __repr__(self):
+        return f"Departures({dict((line, list(times)) for line, times in self._times.items())!r})"
+
+
+def journey_key(departure):
+    """
+    What identifies a departure's journey from one fetch to the next: its JourneyRef and
+    operating day, or failing those its line and timetabled time.
+    """
+    if departure.journey_ref:
+        return departure.journey_ref, departure.operating_day
+    return departure.line, departure.time if departure.planned_time is None else departure.planned_time
+
+
+class KnownDepartures:
+    """
+    The departures of a route collected over several fetches, each journey kept once
+    and updated with its latest estimate. Lets a fetch ask for only part of the
+    timetable (the next few trams, or the ones beyond the horizon) instead of all of it.
+    """
+
+    __slots__ = ("_by_journey",)
+
+    def __init__(self):
+        self._by_journey = {}
+
+    def __len__(self):
+        return len(self._by_journey)
+
+    @property
+    def horizon(self):
+        """
+        Epoch seconds of the last known departure, or None if none are known.
+        """
+        return max((d.time for d in self._by_journey.values()), default=None)
+
+    def merge(self, departures, window_start=None):
+        """
+        Adds or updates departures by journey. Known departures between window_start and
+        the last of the new ones that are missing from them are removed, as the fetch
+        would have returned them had they still been running.
+        :param departures: Iterable of Departure, all the departures fetched from window_start on.
+        :param window_start: Epoch seconds the fetch asked for departures from, None to only add.
+        :return: The number of departures added or changed.
+        """
+        fetched = {journey_key(d): d for d in departures}
+        changed = 0
+        if window_start is not None and fetched:
+            window_end = max(d.time for d in fetched.values())
+            for key, known in list(self._by_journey.items()):
+                if key not in fetched and window_start <= known.time < window_end:
+                    del self._by_journey[key]
+                    changed += 1
+        for key, departure in fetched.items():
+            if self._by_journey.get(key) != departure:
+                self._by_journey[key] = departure
+                changed += 1
+        return changed
+
+    def evict(self, now):
+        """
+        Removes the departures that have left.
+        :return: The number removed.
+        """
+        gone = [key for key, departure in self._by_journey.items() if departure.time < now]
+        for key in gone:
+            del self._by_journey[key]
+        return len(gone)
+
+    def departures(self):
+        """
+        The known departures as Departures.
+        """
+        return Departures(self._by_journey.values())
+
+    def snapshot(self):
+        """
+        The known departures as JSON serializable lists, see restore().
+        """
+        return [[getattr(departure, slot) for slot in Departure.__slots__] for departure in self._by_journey.values()]
+
+    @classmethod
+    def restore(cls, rows):
+        """
+        The KnownDepartures a snapshot() was taken of.
+        """
+        known = cls()
+        known.merge(Departure(*row) for row in rows)
+        return known
@@ -1,70 +1,128 @@
 from .ojp import OJPApiClient
-from .awtrix import AwtrixClient
-from .traffic_light import calculate_traffic_light_colour, to_hex_color
+from .stop_cache import StopRefCache
+from .stop_index import load_stop_index
+from .replay import Recorder
+from .routes import configured_routes
+from .departure_cache import DepartureCache, FetchWorker, STALE, EXPIRED
+from .awtrix import AwtrixClient, batch_updates
+from .traffic_light import compute_line_colors
+from .log import configure_logging
+from .metrics import COLOUR_SECONDS, serve_metrics
 from .config import (
-    OJP_API_KEY, TRAM_LINES,
-    STOP_NAME_ORIGIN, STOP_NAME_DESTINATION,
-    UPDATE_INTERVAL
+    OJP_API_KEY, STOP_CACHE_FILE, STOP_CACHE_TTL, RECORD_FILE,
+    FETCH_INTERVAL_MIN, FETCH_INTERVAL_MAX, RENDER_INTERVAL, METRICS_PORT, METRICS_HOST
 )
+import logging
 import sys
 import time
-from datetime import datetime, timezone
+from contextlib import ExitStack
 
-def main():
-    if not OJP_API_KEY:
-        print("Error: OJP_API_KEY environment variable is not set.")
-        sys.exit(1)
+log = logging.getLogger(__name__)
 
-    try:
-        client = OJPApiClient()
-        clock = AwtrixClient()
+def render(cache, queries, states, colours, now):
+    """
+    Recalculates the colours of every clock from the cached departures, logging the
+    departures behind any change.
+    :param cache: The DepartureCache the fetchers write to.
+    :param states: Dictionary kept between calls, of each Query to the state of its departures last shown.
+    :param colours: Dictionary kept between calls, of each clock name to the colours last shown.
+    :param now: Epoch seconds.
+    :return: List of (Clock, line colours, True if the colours changed).
+    """
+    rendered = []
+    for query in queries:
+        entry, state = cache.get(query, now)
+        if state in (STALE, EXPIRED) and states.get(query) != state:
+            log.warning("Departures (%s -> %s) are %s", query.stop_ref_origin, query.stop_ref_destination, state,
+                        extra={"origin": query.stop_ref_origin, "destination": query.stop_ref_destination, "state": state})
+        states[query] = state
+        results, timelines = (entry.results, entry.timelines) if entry is not None else ({}, {})
 
-        print(f"Resolving StopPointRef for '{STOP_NAME_ORIGIN}'...")
-        stop_ref_origin = client.resolve_stop_ref(STOP_NAME_ORIGIN)
-        print(f"Found: {stop_ref_origin}")
+        for clock_config in query.clocks:
+            with COLOUR_SECONDS.time():
+                line_colors = compute_line_colors(results, clock_config.lines, now=now, verbose=False, timelines=timelines)
+            changed = colours.get(clock_config.name) != line_colors
+            if changed:
+                # Colours changed, log the departures that changed them
+                compute_line_colors(results, clock_config.lines, now=now, timelines=timelines)
+                log.info("Updating clock %s...", clock_config.name, extra={"clock": clock_config.name})
+                colours[clock_config.name] = line_colors
+            rendered.append((clock_config, line_colors, changed))
+    return rendered
 
-        print(f"Resolving StopPointRef for '{STOP_NAME_DESTINATION}'...")
-        stop_ref_destination = client.resolve_stop_ref(STOP_NAME_DESTINATION)
-        print(f"Found: {stop_ref_destination}")
 
-        print(f"Starting Tramtrix loop (Interval: {UPDATE_INTERVAL}s)")
+def run(client, clocks, queries, policy=None, clock=time.time, sleep=time.sleep,
+        background=True, render_interval=RENDER_INTERVAL, cache=None):
+    """
+    Fetches departures in the background when each query's schedule says so, and
+    recalculates the clocks from the cached departures every render_interval seconds,
+    so a slow or failing API never holds up the clocks. Runs until interrupted.
+    :param clocks: Dictionary of clock name to AwtrixClient.
+    :param queries: The Queries to fetch, see RoutesConfig.queries.
+    :param clock: Function returning the current time in epoch seconds.
+    :param sleep: Function sleeping for the given number of seconds.
+    :param background: Set to False to fetch on the calling thread in between renders
+                       instead of on a thread per query, e.g. when clock and sleep are simulated.
+    :param cache: The DepartureCache to use, by default a new one.
+    """
+    cache = cache if cache is not None else DepartureCache(clock=clock)
+    workers = [FetchWorker(client, query, cache, policy, clock=clock) for query in queries]
+    if background:
+        for worker in workers:
+            worker.start()
+
+    states, colours = {}, {}
+    try:
         while True:
-            try:
-                print("Fetching tram data...")
-                results = client.get_trip_results(
-                    stop_ref_origin=stop_ref_origin,
-                    stop_ref_destination=stop_ref_destination
-                )
-                
-                line_colors = {}
-                now = datetime.now(timezone.utc)
-                for line in TRAM_LINES:
-                    times = results.get(line, set())
-                    status = calculate_traffic_light_colour(times)
-                    color = to_hex_color(status)
-                    line_colors[line] = color
-                    
-                    # Calculate minutes until next trams for debug
-                    deltas = []
-                    for t in times:
-                        diff_min = (t - now).total_seconds() / 60
-                        deltas.append(f"{diff_min:.1f}m")
-                    deltas_str = ", ".join(sorted(deltas))
+            if not background:
+                for worker in workers:
+                    worker.fetch_if_due()
+
+            now = clock()
+            # Clocks on the same MQTT broker are updated in one go
+            with batch_updates(clocks.values()):
+                for clock_config, line_colors, _ in render(cache, queries, states, colours, now):
+                    # The client skips the push if the clock already shows these colours
+                    clocks[clock_config.name].update_clock(line_colors)
+
+            wakes = [now + render_interval]
+            if not background:
+                wakes.extend(worker.next_fetch_at for worker in workers)
+            wakes.extend(deadline for deadline in (c.next_deadline() for c in clocks.values()) if deadline is not None)
+            sleep(max(min(wakes) - clock(), 0))
+    finally:
+        for worker in workers:
+            worker.stop(timeout=1)
+
+def main():
+    try:
+        configure_logging()
+        if not OJP_API_KEY:
+            log.error("OJP_API_KEY environment variable is not set.")
+            sys.exit(1)
+
+        routes = configured_routes()
+        stop_cache = StopRefCache(STOP_CACHE_FILE, ttl=STOP_CACHE_TTL) if STOP_CACHE_FILE else None
+        with ExitStack() as stack:
+            if METRICS_PORT:
+                stack.enter_context(serve_metrics(METRICS_PORT, METRICS_HOST))
+            recorder = stack.enter_context(Recorder(RECORD_FILE)) if RECORD_FILE else None
+            client = stack.enter_context(OJPApiClient(stop_cache=stop_cache, stop_index=load_stop_index(), recorder=recorder))
+            clocks = {clock.name: stack.enter_context(AwtrixClient(clock.url, recorder=recorder)) for clock in routes.clocks}
 
-                    print(f"Line {line}: {status} ({color}) | Next: [{deltas_str}]")
-                
-                print("Updating clock...")
-                clock.update_clock(line_colors)
-                print("Done. Sleeping...")
-                
-                time.sleep(UPDATE_INTERVAL)
+            stop_refs = {}
+            for stop_name in routes.stop_names():
+                log.info("Resolving StopPointRef for '%s'...", stop_name)
+                stop_refs[stop_name] = client.resolve_stop_ref(stop_name)
+                log.info("Found: %s", stop_refs[stop_name])
+            queries = routes.queries(stop_refs)
 
-            except Exception as e:
-                print(f"Error in loop: {e}")
-                time.sleep(UPDATE_INTERVAL)
+            log.info("Starting Tramtrix loop (Interval: %s-%ss, %d routes, %d clocks)",
+                     FETCH_INTERVAL_MIN, FETCH_INTERVAL_MAX, len(queries), len(clocks))
+            run(client, clocks, queries)
 
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("%s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
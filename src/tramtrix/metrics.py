@@ -0,0 +1,319 @@
+import bisect
+import threading
+import time
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a parsed departure board to a slow OJP response
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Null:
+    """
+    What a disabled metric's time() returns: a timer that does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL = _Null()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {self.label_names}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        :return: List of (name suffix, label values, extra labels, value)
+        """
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Observes how long the block takes, in seconds.
+        """
+        if not self.registry.enabled:
+            return _NULL
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", key, (), counts[-1]))
+            samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of a process. Until enable() is called, updating a metric returns at
+    once, so instrumented code costs next to nothing when metrics are off.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(self, name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, documentation, labels, buckets))
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+OJP_REQUESTS = REGISTRY.counter(
+    "tramtrix_ojp_requests_total", "OJP requests by kind and outcome (HTTP status, error or skipped).",
+    ("kind", "outcome"),
+)
+OJP_REQUEST_SECONDS = REGISTRY.histogram(
+    "tramtrix_ojp_request_seconds", "Time waiting for OJP responses.", ("kind",)
+)
+OJP_PARSE_SECONDS = REGISTRY.histogram(
+    "tramtrix_ojp_parse_seconds", "Time parsing OJP responses into departures.", ("kind",)
+)
+OJP_TRANSFERRED_BYTES = REGISTRY.counter(
+    "tramtrix_ojp_transferred_bytes_total", "Bytes of OJP response bodies as transferred, compressed or not.", ("kind",)
+)
+OJP_RESPONSE_BYTES = REGISTRY.counter(
+    "tramtrix_ojp_response_bytes_total", "Bytes of OJP response bodies once decompressed.", ("kind",)
+)
+OJP_PARSE_SKIPS = REGISTRY.counter(
+    "tramtrix_ojp_parse_skips_total", "OJP responses not parsed because they were the same as the last one.", ("kind",)
+)
+OJP_QUOTA_WAIT_SECONDS = REGISTRY.gauge(
+    "tramtrix_ojp_quota_wait_seconds", "Seconds until the request quota allows the next request."
+)
+OJP_BREAKER_OPEN = REGISTRY.gauge(
+    "tramtrix_ojp_breaker_open", "1 while the circuit breaker keeps requests from the OJP API, else 0."
+)
+STALE_DEPARTURES = REGISTRY.counter(
+    "tramtrix_stale_departures_total", "Fetches answered with the last departures because the API couldn't be used."
+)
+FETCH_ERRORS = REGISTRY.counter(
+    "tramtrix_fetch_errors_total", "Failed departure fetches by route.", ("origin", "destination")
+)
+COLOUR_SECONDS = REGISTRY.histogram(
+    "tramtrix_colour_seconds", "Time calculating the line colours of a clock."
+)
+AWTRIX_PUSHES = REGISTRY.counter(
+    "tramtrix_awtrix_pushes_total", "Clock updates by transport and outcome (ok or failed).", ("transport", "outcome")
+)
+AWTRIX_PUSH_SECONDS = REGISTRY.histogram(
+    "tramtrix_awtrix_push_seconds", "Time sending clock updates.", ("transport",)
+)
+
+
+def _handler(registry):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class MetricsServer:
+    """
+    Serves the metrics on GET /metrics for Prometheus to scrape, from a background thread.
+    http.server is only imported here, it takes longer to import than the rest of a
+    one-shot run (tramtrix-once) takes to start.
+    """
+
+    def __init__(self, address, registry=REGISTRY):
+        from http.server import ThreadingHTTPServer
+        self.registry = registry
+        self._server = ThreadingHTTPServer(address, _handler(registry))
+        self._server.daemon_threads = True
+        self.server_address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        """
+        Starts serving, unless already started (e.g. by serve_metrics).
+        """
+        if self._thread.ident is None:
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread.is_alive():
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def serve_metrics(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Enables the metrics and serves them on http://host:port/metrics.
+    :return: The started MetricsServer, close() it when done.
+    """
+    registry.enable()
+    return MetricsServer((host, port), registry).start()
@@ -1,15 +1,369 @@
-import requests
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
 import xml.etree.ElementTree as ET
-from datetime import datetime, timezone
-from .config import OJP_API_KEY, OJP_URL
+from email.utils import parsedate_to_datetime
+import requests
+from urllib3.util.request import ACCEPT_ENCODING
+from .config import (
+    OJP_API_KEY, OJP_URL, HTTP_CONNECT_TIMEOUT, OJP_READ_TIMEOUT,
+    OJP_DAILY_QUOTA, OJP_RATE_BURST, OJP_RESOLVE_WAIT,
+    OJP_BREAKER_FAILURES, OJP_BREAKER_RESET, OJP_BREAKER_RESET_MAX,
+    TRIP_REFRESH_RESULTS, TRIP_EXTEND_RESULTS, TRIP_LOOKAHEAD, FETCH_INTERVAL_MAX
+)
+from .departures import KnownDepartures
+from .metrics import (
+    OJP_REQUESTS, OJP_REQUEST_SECONDS, OJP_PARSE_SECONDS, OJP_QUOTA_WAIT_SECONDS, OJP_BREAKER_OPEN, STALE_DEPARTURES,
+    OJP_TRANSFERRED_BYTES, OJP_RESPONSE_BYTES, OJP_PARSE_SKIPS
+)
+from .ojp_parser import iter_departures, parse_trip_results, parse_stop_events
+from .ojp_requests import (
+    MODE_TRIP, MODE_STOP_EVENT, MODE_TRIP_INCREMENTAL, FETCH_MODES,
+    trip_request, stop_event_request, location_information_request
+)
+from .scheduler import backoff_delay
+from .session import create_session
+
+log = logging.getLogger(__name__)
+
+# Response values that change on every call even when the departures don't, masked
+# when comparing a response with the last one
+_VOLATILE = re.compile(
+    rb"(<(?:\w+:)?(?:ResponseTimestamp|RequestMessageRef|CalcTime)>)[^<]*"
+)
+
+
+class OJPApiError(Exception):
+    """
+    An OJP request failed.
+    """
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        """
+        :param status_code: The HTTP status of the response, if there was one.
+        :param retry_after: Seconds to wait before trying again, if known.
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class OJPRateLimitError(OJPApiError):
+    """
+    The request was not sent (or was rejected with 429) because the quota is used up.
+    """
+
+
+class OJPCircuitOpenError(OJPApiError):
+    """
+    The request was not sent because the API failed repeatedly and is given time to recover.
+    """
+
+
+class StopNotFoundError(LookupError):
+    """
+    The API knows no stop by that name.
+    """
+
+
+def _retry_after(response, now):
+    """
+    The seconds a response's Retry-After header asks to wait, or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _transferred_bytes(response):
+    """
+    The bytes of a response's body as they came over the network, compressed or not.
+    """
+    tell = getattr(response.raw, "tell", None)
+    # Responses that didn't come over the network (e.g. replayed ones) have no raw stream
+    return tell() if tell is not None else len(response.content)
+
+
+def _digest(body):
+    """
+    Identifies a response body, ignoring the values that change on every call. These
+    are all in the delivery's header, only that is searched for them.
+    """
+    header_end = body.find(b"Result>")
+    if header_end < 0:
+        header_end = len(body)
+    digest = hashlib.blake2b(_VOLATILE.sub(rb"\1", body[:header_end]), digest_size=16)
+    digest.update(body[header_end:])
+    return digest.digest()
+
+
+class TokenBucket:
+    """
+    Allows requests at an average rate, with bursts of up to capacity requests.
+    Thread-safe, so a single bucket can be shared by every route using the API key.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: Maximum number of tokens, the bucket starts full.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._paused_until = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_daily_quota(cls, quota=OJP_DAILY_QUOTA, burst=OJP_RATE_BURST, **kwargs):
+        """
+        A bucket that can't use up the daily quota within a day.
+        """
+        return cls(quota / 86400.0, burst, **kwargs)
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_time(self, now):
+        wait = 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+        if self._paused_until is not None:
+            wait = max(wait, self._paused_until - now)
+        return wait
+
+    def wait_time(self):
+        """
+        Seconds until a token is available.
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            return self._wait_time(now)
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available right now.
+        :return: True if a token was taken.
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            if self._wait_time(now) > 0:
+                return False
+            self._tokens -= 1
+            return True
+
+    def acquire(self, timeout=None):
+        """
+        Takes a token, waiting for one if needed.
+        :param timeout: Maximum seconds to wait, forever if None.
+        :return: True if a token was taken, False if none became available in time.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while not self.try_acquire():
+            wait = self.wait_time()
+            if deadline is not None and self._clock() + wait > deadline:
+                return False
+            self._sleep(wait)
+        return True
+
+    def snapshot(self):
+        """
+        The bucket's tokens, for restore() in the next process. Only meaningful with a
+        wall clock like time.time, time.monotonic starts again in every process.
+        """
+        with self._lock:
+            return {"tokens": self._tokens, "updated": self._updated, "paused_until": self._paused_until}
+
+    def restore(self, snapshot):
+        """
+        Goes on from the tokens a snapshot() left, refilled for the time since.
+        """
+        with self._lock:
+            self._tokens = min(float(snapshot["tokens"]), self.capacity)
+            self._updated = min(float(snapshot["updated"]), self._clock())
+            paused_until = snapshot["paused_until"]
+            self._paused_until = None if paused_until is None else float(paused_until)
+
+    def pause(self, seconds):
+        """
+        Hands out no tokens for the next seconds, e.g. after a 429 response, and
+        empties the bucket so requests resume at the average rate.
+        """
+        with self._lock:
+            now = self._clock()
+            self._paused_until = max(self._paused_until or now, now + seconds)
+            self._tokens = 0
+            self._updated = now
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a failing API for a while. After failure_threshold failures in
+    a row the circuit opens for reset_timeout seconds, after which one trial request
+    is let through. If that fails too it opens again for twice as long, up to
+    max_reset_timeout, with some jitter.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=OJP_BREAKER_FAILURES, reset_timeout=OJP_BREAKER_RESET,
+                 max_reset_timeout=OJP_BREAKER_RESET_MAX, clock=time.monotonic, random=random.random):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._random = random
+        self.failures = 0
+        self._opened = 0
+        self._open_until = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(self._clock())
+
+    def _state(self, now):
+        if self._open_until is None:
+            return self.CLOSED
+        if now < self._open_until or self._trial:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def retry_after(self):
+        """
+        Seconds until the circuit lets a request through again.
+        """
+        with self._lock:
+            if self._open_until is None:
+                return 0
+            return max(self._open_until - self._clock(), 0)
+
+    def allow(self):
+        """
+        :return: True if a request may be sent now.
+        """
+        with self._lock:
+            state = self._state(self._clock())
+            if state == self.HALF_OPEN:
+                # Only one trial request until it has succeeded or failed
+                self._trial = True
+                return True
+            return state == self.CLOSED
+
+    def snapshot(self):
+        """
+        The breaker's failures and how long it stays open, for restore() in the next
+        process. Only meaningful with a wall clock like time.time.
+        """
+        with self._lock:
+            return {"failures": self.failures, "opened": self._opened, "open_until": self._open_until}
+
+    def restore(self, snapshot):
+        """
+        Goes on from the failures and open time a snapshot() left.
+        """
+        with self._lock:
+            self.failures = int(snapshot["failures"])
+            self._opened = int(snapshot["opened"])
+            open_until = snapshot["open_until"]
+            self._open_until = None if open_until is None else float(open_until)
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened = 0
+            self._open_until = None
+            self._trial = False
+
+    def record_skipped(self):
+        """
+        The allowed request was not sent after all, or says nothing about the API's health.
+        """
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._open_until is not None or self.failures >= self.failure_threshold:
+                self._opened += 1
+                timeout = backoff_delay(self._opened, self.reset_timeout, self.max_reset_timeout, self._random)
+                self._open_until = self._clock() + timeout
+
 
 class OJPApiClient:
-    def __init__(self, api_key=OJP_API_KEY, url=OJP_URL):
+    def __init__(self, api_key=OJP_API_KEY, url=OJP_URL, stop_cache=None, session=None,
+                 timeout=(HTTP_CONNECT_TIMEOUT, OJP_READ_TIMEOUT), rate_limiter=None, breaker=None, stop_index=None,
+                 recorder=None, clock=time.time, max_routes=None):
+        """
+        :param stop_cache: The StopRefCache remembering resolved stop names.
+        :param stop_index: The offline StopIndex stop names are looked up in before asking the API.
+        :param session: A requests Session to send requests with, by default the client
+                        creates (and closes) its own pooled keep-alive session. It should
+                        not retry requests itself, see create_session(retries=0).
+        :param timeout: (connect, read) timeouts in seconds for every request.
+        :param rate_limiter: The TokenBucket every request takes a token from, by default one
+                             sized to OJP_DAILY_QUOTA. Share one client (or bucket) between
+                             all routes using the same API key.
+        :param breaker: The CircuitBreaker guarding the API, by default one from the OJP_BREAKER_* settings.
+        :param recorder: A replay.Recorder to record every request and response to.
+        :param clock: Function returning the current time in epoch seconds.
+        :param max_routes: The most routes the last (and incrementally fetched) departures
+                           are kept of, the least recently fetched ones are dropped first.
+                           None for no limit, when the routes are fixed.
+        """
         self.api_key = api_key
         self.url = url
+        self.stop_cache = stop_cache
+        self.stop_index = stop_index
+        self.timeout = timeout
+        self._owns_session = session is None
+        # No transport retries: every attempt has to take a token and be seen by the
+        # breaker, failed fetches are retried with backoff by the caller
+        self.session = create_session(retries=0) if session is None else session
+        if recorder is not None:
+            recorder.attach(self.session, "ojp")
+        self.clock = clock
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket.for_daily_quota()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.max_routes = max_routes
+        # The last departures of each (origin, destination), served while the API can't be used
+        self._last_results = {}
+        # The digest of the response the last departures of each key were parsed from
+        self._last_digests = {}
+        # The departures collected so far for each route fetched incrementally
+        self._known_departures = {}
+        # (horizon, epoch seconds) of each route whose departures couldn't be extended
+        # beyond that horizon, not asked for again before then unless the horizon moves
+        self._exhausted_horizons = {}
+        self._routes_lock = threading.Lock()
         self.headers = {
             "Content-Type": "application/xml",
             "Accept": "application/xml",
+            # Everything the installed urllib3 decompresses: gzip and deflate, br with
+            # brotli installed (the compression extra), zstd with zstandard
+            "Accept-Encoding": ACCEPT_ENCODING,
             "Authorization": f"Bearer {self.api_key}"
         }
         self.namespaces = {
@@ -17,105 +371,303 @@ class OJPApiClient:
             "siri": "http://www.siri.org.uk/siri",
         }
 
-    def get_trip_results(self, stop_ref_origin, stop_ref_destination):
-        now_iso = datetime.now(timezone.utc).isoformat()
-        
-        request_body = f"""<?xml version="1.0" encoding="UTF-8"?>
-<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.vdv.de/ojp OJP_changes_for_v1.1/OJP.xsd">
-    <OJPRequest>
-        <siri:ServiceRequest>
-            <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
-            <siri:RequestorRef>MENTZRegTest</siri:RequestorRef>
-            <OJPTripRequest>
-                <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
-                <siri:MessageIdentifier>TR-1h2</siri:MessageIdentifier>
-                <Origin>
-                    <PlaceRef>
-                        <siri:StopPointRef>{stop_ref_origin}</siri:StopPointRef>
-                    </PlaceRef>
-                </Origin>
-                <Destination>
-                    <PlaceRef>
-                        <siri:StopPointRef>{stop_ref_destination}</siri:StopPointRef>
-                    </PlaceRef>
-                </Destination>
-                <Params>
-                    <ModeAndModeOfOperationFilter>
-                        <Exclude>false</Exclude>
-                        <PtMode>tram</PtMode>
-                    </ModeAndModeOfOperationFilter>
-                    <NumberOfResults>10</NumberOfResults>
-                </Params>
-            </OJPTripRequest>
-        </siri:ServiceRequest>
-    </OJPRequest>
-</OJP>
-"""
-
-        response = requests.post(self.url, headers=self.headers, data=request_body)
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _post(self, request_body):
+        """
+        :param request_body: The encoded request, see ojp_requests.
+        """
+        return self.session.post(self.url, headers=self.headers, data=request_body, timeout=self.timeout)
+
+    def _request(self, request_body, wait=0, kind=MODE_TRIP):
+        """
+        Sends a request through the circuit breaker and rate limiter.
+        :param wait: Seconds to wait for a token when the quota is used up.
+        :param kind: What is requested, e.g. 'trip' or 'location', for the metrics.
+        :return: The successful (200) response.
+        :raises OJPApiError: If the request failed or could not be sent.
+        """
+        try:
+            response = self._send(request_body, wait, kind)
+        except OJPApiError as e:
+            if e.status_code is not None:
+                outcome = e.status_code
+            elif isinstance(e, (OJPCircuitOpenError, OJPRateLimitError)):
+                outcome = "skipped"
+            else:
+                outcome = "error"
+            OJP_REQUESTS.inc(kind=kind, outcome=outcome)
+            raise
+        finally:
+            if OJP_REQUESTS.registry.enabled:
+                OJP_QUOTA_WAIT_SECONDS.set(self.rate_limiter.wait_time())
+                OJP_BREAKER_OPEN.set(int(self.breaker.state == CircuitBreaker.OPEN))
+        OJP_REQUESTS.inc(kind=kind, outcome=200)
+        return response
+
+    def _send(self, request_body, wait, kind):
+        if not self.breaker.allow():
+            raise OJPCircuitOpenError("API call skipped, the API is failing", retry_after=self.breaker.retry_after())
+        if not (self.rate_limiter.try_acquire() or (wait and self.rate_limiter.acquire(timeout=wait))):
+            # The trial request of a half-open circuit was not sent, it can go again
+            self.breaker.record_skipped()
+            raise OJPRateLimitError("API call skipped, request quota used up", retry_after=self.rate_limiter.wait_time())
+
+        started = time.perf_counter()
+        try:
+            response = self._post(request_body)
+        except requests.RequestException as e:
+            elapsed = time.perf_counter() - started
+            OJP_REQUEST_SECONDS.observe(elapsed, kind=kind)
+            self.breaker.record_failure()
+            log.debug("OJP %s request failed after %.3fs: %s", kind, elapsed, e,
+                      extra={"kind": kind, "seconds": elapsed, "error": str(e)})
+            raise OJPApiError(f"API call failed: {e}", retry_after=self.breaker.retry_after() or None) from e
+        elapsed = time.perf_counter() - started
+        OJP_REQUEST_SECONDS.observe(elapsed, kind=kind)
+        transferred, size = _transferred_bytes(response), len(response.content)
+        OJP_TRANSFERRED_BYTES.inc(transferred, kind=kind)
+        OJP_RESPONSE_BYTES.inc(size, kind=kind)
+        log.debug("OJP %s request answered %d in %.3fs, %d bytes (%d transferred)", kind, response.status_code,
+                  elapsed, size, transferred,
+                  extra={"kind": kind, "status": response.status_code, "seconds": elapsed, "bytes": size,
+                         "transferred_bytes": transferred})
+
+        if response.status_code == 429:
+            retry_after = _retry_after(response, self.clock())
+            self.rate_limiter.pause(retry_after if retry_after is not None else 60)
+            self.breaker.record_skipped()
+            raise OJPRateLimitError(
+                f"API call failed with status code 429: {response.text}",
+                status_code=429, retry_after=self.rate_limiter.wait_time()
+            )
+        # Any other answer but a server error shows the API is up again
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
         if response.status_code != 200:
-            raise Exception(f"API call failed with status code {response.status_code}: {response.text}")
+            raise OJPApiError(
+                f"API call failed with status code {response.status_code}: {response.text}",
+                status_code=response.status_code, retry_after=self.breaker.retry_after() or None
+            )
+        return response
 
-        return self._parse_response(response.text)
+    def snapshot(self):
+        """
+        What a client in the next process needs to go on where this one stopped, e.g. in
+        one-shot mode: the request quota and circuit breaker, and the departures of the
+        routes fetched incrementally. JSON serializable, see restore().
+        """
+        with self._routes_lock:
+            known = {"|".join(key): departures.snapshot() for key, departures in self._known_departures.items()}
+            exhausted = {"|".join(key): list(value) for key, value in self._exhausted_horizons.items()}
+        return {
+            "rate_limiter": self.rate_limiter.snapshot(),
+            "breaker": self.breaker.snapshot(),
+            "known_departures": known,
+            "exhausted_horizons": exhausted,
+        }
 
-    def _parse_response(self, xml_text):
-        root = ET.fromstring(xml_text)
-        trip_results = {}
-        
-        for trip_result in root.findall(".//ojp:TripResult", self.namespaces):
-            # Parse individual trip legs keyed by PublishedServiceName
-            for leg in trip_result.findall(".//ojp:Leg", self.namespaces):
-                published_service_name_element = leg.find(".//ojp:PublishedServiceName", self.namespaces)
-                published_service_name = None
-                if published_service_name_element is not None:
-                    published_service_name = published_service_name_element.findtext("ojp:Text", namespaces=self.namespaces)
-
-                estimated_time_text = leg.findtext(".//ojp:EstimatedTime", namespaces=self.namespaces)
-                estimated_time_text_iso = estimated_time_text.replace("Z", "+00:00") if estimated_time_text else None
-                estimated_time = datetime.fromisoformat(estimated_time_text_iso) if estimated_time_text else None
-
-                if published_service_name and estimated_time:
-                    if published_service_name not in trip_results:
-                        trip_results[published_service_name] = set()
-                    trip_results[published_service_name].add(estimated_time)
-        
-        return trip_results
+    def restore(self, snapshot):
+        """
+        Goes on from a snapshot() taken by an earlier client.
+        :raises KeyError, TypeError, ValueError: If the snapshot is not one.
+        """
+        self.rate_limiter.restore(snapshot["rate_limiter"])
+        self.breaker.restore(snapshot["breaker"])
+        for key, rows in snapshot["known_departures"].items():
+            self._remember(self._known_departures, tuple(key.split("|", 2)), KnownDepartures.restore(rows))
+        for key, (horizon, retry_at) in snapshot["exhausted_horizons"].items():
+            self._remember(self._exhausted_horizons, tuple(key.split("|", 2)), (horizon, retry_at))
+
+    def _remember(self, routes, key, value):
+        """
+        Keeps value for the route key in routes (one of the per-route dicts), as the most
+        recently fetched, and drops the least recently fetched routes beyond max_routes.
+        """
+        with self._routes_lock:
+            # Dicts keep their order, the first entry is the least recently fetched
+            routes.pop(key, None)
+            routes[key] = value
+            if self.max_routes is not None:
+                while len(routes) > self.max_routes:
+                    del routes[next(iter(routes))]
+        return value
+
+    def _fetch_departures(self, key, request_body, parse, allow_stale, reuse_unchanged=True):
+        """
+        Sends a departures request, falling back to the last departures for the same key
+        while the circuit is open or the quota is used up.
+        :param parse: Function parsing the response body (bytes) into departures.
+        :param reuse_unchanged: Return the last departures instead of parsing the response
+                                again if it is the same as the last one (but for its
+                                timestamps), for parse functions that depend on nothing else.
+        """
+        try:
+            response = self._request(request_body, kind=key[0])
+        except (OJPCircuitOpenError, OJPRateLimitError) as e:
+            last_results = self._last_results.get(key)
+            if not allow_stale or last_results is None:
+                raise
+            log.warning("%s, using the last departures", e)
+            STALE_DEPARTURES.inc()
+            return last_results
+
+        # Parsed straight from the (decompressed) bytes, decoding them to text first is slower
+        body = response.content
+        digest = _digest(body) if reuse_unchanged else None
+        last_results = self._last_results.get(key)
+        if digest is not None and digest == self._last_digests.get(key) and last_results is not None:
+            OJP_PARSE_SKIPS.inc(kind=key[0])
+            log.debug("OJP %s response unchanged, reusing the last departures", key[0], extra={"kind": key[0]})
+            return last_results
+
+        with OJP_PARSE_SECONDS.time(kind=key[0]):
+            results = parse(body)
+        self._remember(self._last_results, key, results)
+        self._remember(self._last_digests, key, digest)
+        return results
+
+    def get_trip_results(self, stop_ref_origin, stop_ref_destination, allow_stale=True):
+        """
+        Fetches the departures from one stop to another with an OJPTripRequest.
+        :param allow_stale: While the circuit is open or the quota is used up, return the
+                            last departures fetched for these stops instead of raising.
+        :return: Departures, mapping each line (str) to its sorted departure epoch seconds.
+        :raises OJPApiError: If the request failed and there are no departures to fall back to.
+        """
+        request_body, _ = trip_request(stop_ref_origin, stop_ref_destination, now=self.clock())
+        return self._fetch_departures(
+            (MODE_TRIP, stop_ref_origin, stop_ref_destination), request_body, self._parse_response, allow_stale
+        )
+
+    def get_trip_results_incremental(self, stop_ref_origin, stop_ref_destination, allow_stale=True, now=None):
+        """
+        Fetches the departures from one stop to another like get_trip_results, but merges
+        them into the ones fetched before instead of asking for all of them every time:
+        only the next TRIP_REFRESH_RESULTS trips are asked for, to update their realtime
+        estimates, and TRIP_EXTEND_RESULTS more after the last known departure whenever
+        less than TRIP_LOOKAHEAD minutes are known. When there are none after it (e.g.
+        at the end of service), they are asked for again after FETCH_INTERVAL_MAX seconds
+        or once the last known departure changed. Departures are matched by journey, and
+        dropped once they have left.
+        :param allow_stale: While the circuit is open or the quota is used up, return the
+                            last departures fetched for these stops instead of raising.
+        :param now: Epoch seconds to fetch the departures from, by default the current time.
+        :return: Departures, mapping each line (str) to its sorted departure epoch seconds.
+        :raises OJPApiError: If the request failed and there are no departures to fall back to.
+        """
+        key = (MODE_TRIP_INCREMENTAL, stop_ref_origin, stop_ref_destination)
+        now = self.clock() if now is None else now
+        known = self._known_departures.get(key)
+        known = self._remember(self._known_departures, key, known if known is not None else KnownDepartures())
+        known.evict(now)
+        refreshed = []
 
-    def resolve_stop_ref(self, stop_name):
+        def refresh(body):
+            known.merge(iter_departures(body), window_start=now)
+            refreshed.append(True)
+            return known.departures()
+
+        request_body, _ = trip_request(
+            stop_ref_origin, stop_ref_destination, now=now,
+            results=TRIP_REFRESH_RESULTS if len(known) else TRIP_EXTEND_RESULTS
+        )
+        # Merging depends on the time and the departures known, an unchanged response is merged again
+        results = self._fetch_departures(key, request_body, refresh, allow_stale, reuse_unchanged=False)
+
+        horizon = known.horizon
+        extend = refreshed and horizon is not None and horizon - now < TRIP_LOOKAHEAD * 60
+        exhausted = self._exhausted_horizons.get(key)
+        if extend and exhausted is not None and exhausted[0] == horizon and now < exhausted[1]:
+            extend = False
+        if extend:
+            request_body, _ = trip_request(
+                stop_ref_origin, stop_ref_destination, now=now, departure_time=horizon, results=TRIP_EXTEND_RESULTS
+            )
+            try:
+                response = self._request(request_body, kind=MODE_TRIP_INCREMENTAL)
+            except OJPApiError as e:
+                # The refreshed departures are still good, extend them next time
+                log.warning("Could not fetch the departures after %s: %s",
+                            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(horizon)), e)
+            else:
+                with OJP_PARSE_SECONDS.time(kind=MODE_TRIP_INCREMENTAL):
+                    known.merge(iter_departures(response.content), window_start=horizon)
+                results = self._remember(self._last_results, key, known.departures())
+                if known.horizon == horizon:
+                    # Nothing runs after it
+                    self._remember(self._exhausted_horizons, key, (horizon, now + FETCH_INTERVAL_MAX))
+        return results
+
+    def get_stop_events(self, stop_ref_origin, stop_ref_destination=None, allow_stale=True):
+        """
+        Fetches the departures from one stop with an OJPStopEventRequest, the stop's
+        departure board. Much cheaper for the API than routing a TripRequest.
+        :param stop_ref_destination: Only keep trams that call at this stop later on.
+        :param allow_stale: While the circuit is open or the quota is used up, return the
+                            last departures fetched for these stops instead of raising.
+        :return: Departures, mapping each line (str) to its sorted departure epoch seconds.
+        :raises OJPApiError: If the request failed and there are no departures to fall back to.
+        """
+        request_body, _ = stop_event_request(
+            stop_ref_origin, onward_calls=stop_ref_destination is not None, now=self.clock()
+        )
+        return self._fetch_departures(
+            (MODE_STOP_EVENT, stop_ref_origin, stop_ref_destination), request_body,
+            lambda body: parse_stop_events(body, destination=stop_ref_destination), allow_stale
+        )
+
+    def get_departures(self, stop_ref_origin, stop_ref_destination, mode=MODE_TRIP, allow_stale=True):
+        """
+        Fetches the departures from one stop towards another.
+        :param mode: MODE_TRIP to use an OJPTripRequest, MODE_STOP_EVENT to use an OJPStopEventRequest,
+                     MODE_TRIP_INCREMENTAL to use OJPTripRequests for the departures not known yet.
+        """
+        if mode == MODE_TRIP:
+            return self.get_trip_results(stop_ref_origin, stop_ref_destination, allow_stale=allow_stale)
+        if mode == MODE_TRIP_INCREMENTAL:
+            return self.get_trip_results_incremental(stop_ref_origin, stop_ref_destination, allow_stale=allow_stale)
+        if mode == MODE_STOP_EVENT:
+            return self.get_stop_events(stop_ref_origin, stop_ref_destination, allow_stale=allow_stale)
+        raise ValueError(f"Unknown fetch mode '{mode}'")
+
+    def _parse_response(self, body):
+        return parse_trip_results(body)
+
+    def resolve_stop_ref(self, stop_name, use_cache=True):
         """
         Resolves a stop name to a StopPointRef using OJP LocationInformationRequest.
+        If the client has a stop cache, it is consulted first and updated on success. Then
+        the stop index, if any, before calling the API.
         :param stop_name: The name of the stop to resolve.
+        :param use_cache: Set to False to skip the cache and index lookups and force an API call.
         :return: The StopPointRef string.
-        :raises Exception: If the stop cannot be found.
+        :raises OJPApiError: If the request failed.
+        :raises StopNotFoundError: If the stop cannot be found.
         """
-        now_iso = datetime.now(timezone.utc).isoformat()
-        
-        request_body = f"""<?xml version="1.0" encoding="UTF-8"?>
-<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.vdv.de/ojp OJP_changes_for_v1.1/OJP.xsd">
-    <OJPRequest>
-        <siri:ServiceRequest>
-            <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
-            <siri:RequestorRef>MENTZRegTest</siri:RequestorRef>
-            <OJPLocationInformationRequest>
-                <siri:RequestTimestamp>{now_iso}</siri:RequestTimestamp>
-                <siri:MessageIdentifier>LIR-001</siri:MessageIdentifier>
-                <InitialInput>
-                    <Name>{stop_name}</Name>
-                </InitialInput>
-                <Restrictions>
-                    <Type>stop</Type>
-                    <NumberOfResults>1</NumberOfResults>
-                </Restrictions>
-            </OJPLocationInformationRequest>
-        </siri:ServiceRequest>
-    </OJPRequest>
-</OJP>
-"""
-        response = requests.post(self.url, headers=self.headers, data=request_body)
+        if self.stop_cache is not None and use_cache:
+            cached_ref = self.stop_cache.get(self.url, stop_name)
+            if cached_ref:
+                return cached_ref
 
-        if response.status_code != 200:
-            raise Exception(f"API call failed with status code {response.status_code}: {response.text}")
+        if self.stop_index is not None and use_cache:
+            indexed_ref = self.stop_index.lookup(stop_name)
+            if indexed_ref:
+                return indexed_ref
+
+        request_body, _ = location_information_request(stop_name, now=self.clock())
+        # Stops are resolved at startup, so rather wait for the quota than give up
+        response = self._request(request_body, wait=OJP_RESOLVE_WAIT, kind="location")
 
         # Parse response
         root = ET.fromstring(response.text)
@@ -127,7 +679,10 @@ class OJPApiClient:
         ref = stop_place_ref or stop_point_ref
         
         if not ref:
-            print(f"DEBUG: Response for {stop_name}:\n{response.text}")
-            raise Exception(f"Could not resolve stop reference for '{stop_name}'")
-            
+            log.debug("Response for %s:\n%s", stop_name, response.text)
+            raise StopNotFoundError(f"Could not resolve stop reference for '{stop_name}'")
+
+        if self.stop_cache is not None:
+            self.stop_cache.set(self.url, stop_name, ref)
+
         return ref
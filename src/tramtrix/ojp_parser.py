@@ -0,0 +1,171 @@
+import io
+import xml.etree.ElementTree as ET
+from .departures import Departure, Departures, parse_iso8601
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+OJP_NAMESPACE = "http://www.vdv.de/ojp"
+SIRI_NAMESPACE = "http://www.siri.org.uk/siri"
+
+_TRIP_RESULT = f"{{{OJP_NAMESPACE}}}TripResult"
+_STOP_EVENT_RESULT = f"{{{OJP_NAMESPACE}}}StopEventResult"
+_THIS_CALL = f"{{{OJP_NAMESPACE}}}ThisCall"
+_ONWARD_CALL = f"{{{OJP_NAMESPACE}}}OnwardCall"
+_SERVICE = f"{{{OJP_NAMESPACE}}}Service"
+_LEG = f"{{{OJP_NAMESPACE}}}Leg"
+_PUBLISHED_SERVICE_NAME = f"{{{OJP_NAMESPACE}}}PublishedServiceName"
+_TEXT = f"{{{OJP_NAMESPACE}}}Text"
+_SERVICE_DEPARTURE = f"{{{OJP_NAMESPACE}}}ServiceDeparture"
+_ESTIMATED_TIME = f"{{{OJP_NAMESPACE}}}EstimatedTime"
+_TIMETABLED_TIME = f"{{{OJP_NAMESPACE}}}TimetabledTime"
+_JOURNEY_REF = f"{{{OJP_NAMESPACE}}}JourneyRef"
+_OPERATING_DAY_REF = f"{{{OJP_NAMESPACE}}}OperatingDayRef"
+_STOP_POINT_REF = f"{{{SIRI_NAMESPACE}}}StopPointRef"
+
+
+def _as_stream(source):
+    if isinstance(source, str):
+        return io.BytesIO(source.encode("utf-8"))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def _iter_result_elements(stream, tag, use_lxml):
+    """
+    Yields each result element (e.g. TripResult) once it is complete, then discards it.
+    """
+    if use_lxml is None:
+        use_lxml = lxml_etree is not None
+    if use_lxml:
+        if lxml_etree is None:
+            raise ImportError("lxml is not installed")
+        # lxml filters by tag in C, only the results reach Python
+        for _, elem in lxml_etree.iterparse(stream, events=("end",), tag=tag):
+            yield elem
+            elem.clear(keep_tail=False)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+
+    for _, elem in ET.iterparse(stream, events=("end",)):
+        if elem.tag == tag:
+            yield elem
+            elem.clear()
+
+
+def _first_text(elem, tag):
+    found = next(elem.iter(tag), None)
+    return found.text if found is not None else None
+
+
+def iter_departures(source, use_lxml=None):
+    """
+    Streams an OJP TripDelivery document and yields a Departure for each leg.
+
+    Each TripResult is searched on its own as soon as it has been parsed, then cleared, so
+    the work per leg no longer depends on the size of the document and memory stays flat
+    no matter how many TripResults it holds. For each Leg the line is the Text of the first
+    PublishedServiceName, and the time is the first EstimatedTime anywhere in the leg.
+    Legs missing either are skipped.
+
+    :param source: The response as str/bytes, or a binary file-like object.
+    :param use_lxml: Force (True) or disable (False) the lxml parser, defaults to lxml if installed.
+    """
+    for trip_result in _iter_result_elements(_as_stream(source), _TRIP_RESULT, use_lxml):
+        for leg in trip_result.iter(_LEG):
+            service_name_element = next(leg.iter(_PUBLISHED_SERVICE_NAME), None)
+            service_name = service_name_element.findtext(_TEXT) if service_name_element is not None else None
+            estimated_time = _first_text(leg, _ESTIMATED_TIME)
+            if not service_name or not estimated_time:
+                continue
+            timetabled_time = _first_text(leg, _TIMETABLED_TIME)
+            yield Departure(
+                service_name,
+                parse_iso8601(estimated_time),
+                planned_time=parse_iso8601(timetabled_time) if timetabled_time else None,
+                stop_ref=_first_text(leg, _STOP_POINT_REF),
+                journey_ref=_first_text(leg, _JOURNEY_REF),
+                operating_day=_first_text(leg, _OPERATING_DAY_REF),
+            )
+
+
+def parse_trip_results(source, use_lxml=None):
+    """
+    Parses an OJP TripDelivery response into the departure times for each line.
+    :param source: The response as str/bytes, or a binary file-like object.
+    :param use_lxml: Force (True) or disable (False) the lxml parser, defaults to lxml if installed.
+    :return: Departures, mapping each line (str) to its sorted departure epoch seconds.
+    """
+    return Departures(iter_departures(source, use_lxml=use_lxml))
+
+
+def stop_key(ref):
+    """
+    The part of a stop reference that identifies the stop itself, so that refs of the
+    same stop compare equal whichever form they take: Swiss SLOIDs of a platform
+    ('ch:1:sloid:91381:1:2') and UIC stop numbers with the country code ('8591381')
+    both become '91381'. Other refs are returned as they are.
+    """
+    if ref.startswith("ch:1:sloid:"):
+        return ref.split(":")[3]
+    if len(ref) == 7 and ref.isdigit():
+        return ref[2:]
+    return ref
+
+
+def iter_stop_event_departures(source, destination=None, use_lxml=None):
+    """
+    Streams an OJP StopEventDelivery (a departure board) and yields a Departure for each
+    stop event, like iter_departures does for trips.
+
+    The line is the Text of the Service's PublishedServiceName and the time is the
+    EstimatedTime of ThisCall's ServiceDeparture, not of its ServiceArrival, which comes
+    first at stops the tram doesn't start from. Events missing either are skipped.
+
+    :param source: The response as str/bytes, or a binary file-like object.
+    :param destination: Only yield trams calling at this stop ref later on (requires the
+                        request to include onward calls), so the board is limited to one direction.
+    :param use_lxml: Force (True) or disable (False) the lxml parser, defaults to lxml if installed.
+    """
+    destination_key = stop_key(destination) if destination else None
+    for result in _iter_result_elements(_as_stream(source), _STOP_EVENT_RESULT, use_lxml):
+        this_call = next(result.iter(_THIS_CALL), None)
+        service = next(result.iter(_SERVICE), None)
+        if this_call is None or service is None:
+            continue
+        service_name_element = next(service.iter(_PUBLISHED_SERVICE_NAME), None)
+        service_name = service_name_element.findtext(_TEXT) if service_name_element is not None else None
+        service_departure = next(this_call.iter(_SERVICE_DEPARTURE), None)
+        estimated_time = service_departure.findtext(_ESTIMATED_TIME) if service_departure is not None else None
+        if not service_name or not estimated_time:
+            continue
+        if destination_key is not None and not any(
+            stop_key(ref.text or "") == destination_key
+            for onward_call in result.iter(_ONWARD_CALL)
+            for ref in onward_call.iter(_STOP_POINT_REF)
+        ):
+            continue
+        timetabled_time = service_departure.findtext(_TIMETABLED_TIME)
+        yield Departure(
+            service_name,
+            parse_iso8601(estimated_time),
+            planned_time=parse_iso8601(timetabled_time) if timetabled_time else None,
+            stop_ref=_first_text(this_call, _STOP_POINT_REF),
+            journey_ref=_first_text(service, _JOURNEY_REF),
+            operating_day=_first_text(service, _OPERATING_DAY_REF),
+        )
+
+
+def parse_stop_events(source, destination=None, use_lxml=None):
+    """
+    Parses an OJP StopEventDelivery response into the departure times for each line.
+    :param source: The response as str/bytes, or a binary file-like object.
+    :param destination: Only keep trams calling at this stop ref later on.
+    :param use_lxml: Force (True) or disable (False) the lxml parser, defaults to lxml if installed.
+    :return: Departures, mapping each line (str) to its sorted departure epoch seconds.
+    """
+    return Departures(iter_stop_event_departures(source, destination=destination, use_lxml=use_lxml))
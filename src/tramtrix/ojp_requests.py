@@ -0,0 +1,147 @@
+import itertools
+import os
+import time
+
+# How departures are fetched, see OJPApiClient.get_departures
+MODE_TRIP = "trip"
+MODE_STOP_EVENT = "stop_event"
+MODE_TRIP_INCREMENTAL = "trip_incremental"
+FETCH_MODES = (MODE_TRIP, MODE_STOP_EVENT, MODE_TRIP_INCREMENTAL)
+
+# Message identifiers are unique per process run, so responses and log lines can be
+# correlated with the request that caused them.
+_RUN_ID = os.urandom(4).hex()
+_message_counter = itertools.count(1)
+
+
+def next_message_id(prefix):
+    """
+    A new MessageIdentifier, e.g. 'TR-3f9a0c12-7'.
+    """
+    return f"{prefix}-{_RUN_ID}-{next(_message_counter)}"
+
+
+def request_timestamp(now=None):
+    """
+    The RequestTimestamp for an epoch seconds instant, by default the current time,
+    e.g. '2026-01-06T12:00:00Z'.
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(int(time.time() if now is None else now)))
+
+
+def _escape(value):
+    # What xml.sax.saxutils.escape does, without it importing urllib.request (and with it
+    # http.client and email) into every process that builds a request
+    return str(value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _envelope(timestamp, request):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.vdv.de/ojp OJP_changes_for_v1.1/OJP.xsd">
+    <OJPRequest>
+        <siri:ServiceRequest>
+            <siri:RequestTimestamp>{timestamp}</siri:RequestTimestamp>
+            <siri:RequestorRef>MENTZRegTest</siri:RequestorRef>
+{request}
+        </siri:ServiceRequest>
+    </OJPRequest>
+</OJP>
+""".encode("utf-8")
+
+
+def trip_request(origin, destination, now=None, message_id=None, departure_time=None, results=10):
+    """
+    Builds an OJPTripRequest for trams from one stop to another.
+    :param origin: StopPointRef of the origin.
+    :param destination: StopPointRef of the destination.
+    :param now: Epoch seconds to send as the RequestTimestamp, by default the current time.
+    :param message_id: The MessageIdentifier, by default a new unique one.
+    :param departure_time: Epoch seconds to plan trips departing from, by default now.
+    :param results: The number of trips to ask for.
+    :return: (body bytes, message id)
+    """
+    message_id = message_id or next_message_id("TR")
+    timestamp = request_timestamp(now)
+    departure_time = timestamp if departure_time is None else request_timestamp(departure_time)
+    body = _envelope(timestamp, f"""            <OJPTripRequest>
+                <siri:RequestTimestamp>{timestamp}</siri:RequestTimestamp>
+                <siri:MessageIdentifier>{_escape(message_id)}</siri:MessageIdentifier>
+                <Origin>
+                    <PlaceRef>
+                        <siri:StopPointRef>{_escape(origin)}</siri:StopPointRef>
+                    </PlaceRef>
+                    <DepArrTime>{departure_time}</DepArrTime>
+                </Origin>
+                <Destination>
+                    <PlaceRef>
+                        <siri:StopPointRef>{_escape(destination)}</siri:StopPointRef>
+                    </PlaceRef>
+                </Destination>
+                <Params>
+                    <ModeAndModeOfOperationFilter>
+                        <Exclude>false</Exclude>
+                        <PtMode>tram</PtMode>
+                    </ModeAndModeOfOperationFilter>
+                    <NumberOfResults>{int(results)}</NumberOfResults>
+                </Params>
+            </OJPTripRequest>""")
+    return body, message_id
+
+
+def stop_event_request(stop, onward_calls=True, now=None, message_id=None):
+    """
+    Builds an OJPStopEventRequest for the next tram departures from a stop.
+    :param stop: StopPointRef of the stop.
+    :param onward_calls: Include the stops each tram calls at afterwards, needed to tell its direction.
+    :param now: Epoch seconds to send as the RequestTimestamp and departure time, by default the current time.
+    :param message_id: The MessageIdentifier, by default a new unique one.
+    :return: (body bytes, message id)
+    """
+    message_id = message_id or next_message_id("SER")
+    timestamp = request_timestamp(now)
+    body = _envelope(timestamp, f"""            <OJPStopEventRequest>
+                <siri:RequestTimestamp>{timestamp}</siri:RequestTimestamp>
+                <siri:MessageIdentifier>{_escape(message_id)}</siri:MessageIdentifier>
+                <Location>
+                    <PlaceRef>
+                        <siri:StopPointRef>{_escape(stop)}</siri:StopPointRef>
+                    </PlaceRef>
+                    <DepArrTime>{timestamp}</DepArrTime>
+                </Location>
+                <Params>
+                    <ModeAndModeOfOperationFilter>
+                        <Exclude>false</Exclude>
+                        <PtMode>tram</PtMode>
+                    </ModeAndModeOfOperationFilter>
+                    <NumberOfResults>20</NumberOfResults>
+                    <StopEventType>departure</StopEventType>
+                    <IncludePreviousCalls>false</IncludePreviousCalls>
+                    <IncludeOnwardCalls>{"true" if onward_calls else "false"}</IncludeOnwardCalls>
+                    <UseRealtimeData>full</UseRealtimeData>
+                </Params>
+            </OJPStopEventRequest>""")
+    return body, message_id
+
+
+def location_information_request(name, now=None, message_id=None):
+    """
+    Builds an OJPLocationInformationRequest for the best matching stop of a name.
+    :param name: The stop name to look up.
+    :param now: Epoch seconds to send as the RequestTimestamp, by default the current time.
+    :param message_id: The MessageIdentifier, by default a new unique one.
+    :return: (body bytes, message id)
+    """
+    message_id = message_id or next_message_id("LIR")
+    timestamp = request_timestamp(now)
+    body = _envelope(timestamp, f"""            <OJPLocationInformationRequest>
+                <siri:RequestTimestamp>{timestamp}</siri:RequestTimestamp>
+                <siri:MessageIdentifier>{_escape(message_id)}</siri:MessageIdentifier>
+                <InitialInput>
+                    <Name>{_escape(name)}</Name>
+                </InitialInput>
+                <Restrictions>
+                    <Type>stop</Type>
+                    <NumberOfResults>1</NumberOfResults>
+                </Restrictions>
+            </OJPLocationInformationRequest>""")
+    return body, message_id
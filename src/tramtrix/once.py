@@ -0,0 +1,19 @@
+"""
+Entry point of tramtrix-once, see oneshot. Keeps the parsed .env file for the next runs
+(see config.load_dotenv_snapshot), which has to be asked for before the config is
+loaded, so nothing else of tramtrix is imported here.
+"""
+import os
+import sys
+
+
+def main(argv=None):
+    os.environ.setdefault("DOTENV_SNAPSHOT_FILE", os.path.join(
+        os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tramtrix", "dotenv.json"
+    ))
+    from .oneshot import main as run
+    return run(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+One-shot mode for cron jobs and systemd timers: fetches the departures that are due,
+pushes the clocks whose colours changed, and exits. Everything a run learns (stop refs,
+departures, when to fetch next, what the clocks show, the request quota and circuit
+breaker) is kept for the next run, so most
+runs neither fetch nor push, and don't even import the HTTP clients. Run through
+once.main (tramtrix-once), which also keeps the parsed .env file.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import ExitStack
+from .departure_cache import report_fetched, report_fetch_failed
+from .log import configure_logging
+from .routes import configured_routes
+from .scheduler import QuerySchedule
+from .stop_cache import StopRefCache
+from .traffic_light import compute_line_colors, to_epoch
+from .config import (
+    OJP_API_KEY, OJP_URL, STOP_CACHE_FILE, STOP_CACHE_TTL, ONESHOT_STATE_FILE,
+    AWTRIX_HEARTBEAT, DEPARTURES_STALE_FOR
+)
+
+log = logging.getLogger(__name__)
+
+
+class OneShotState:
+    """
+    What a run leaves for the next one: the departures of every query with their fetch
+    schedule, the colours last pushed to every clock, and the OJP client's snapshot.
+    """
+
+    def __init__(self, path, queries=None, clocks=None, client=None):
+        self.path = path
+        self.queries = queries if queries is not None else {}
+        self.clocks = clocks if clocks is not None else {}
+        self.client = client
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads the state the last run left, or starts from nothing if there is none.
+        """
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            return cls(path, dict(state["queries"]), dict(state["clocks"]), state.get("client"))
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupt state file, fetch and push everything
+            return cls(path)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"queries": self.queries, "clocks": self.clocks, "client": self.client}, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _key(query):
+        return f"{query.mode}|{query.stop_ref_origin}|{query.stop_ref_destination}"
+
+    def schedule(self, query, policy=None):
+        """
+        The QuerySchedule of a query, with the departures and schedule of the last run.
+        """
+        schedule = QuerySchedule(query, policy)
+        entry = self.queries.get(self._key(query))
+        if entry:
+            schedule.results = entry["departures"]
+            schedule.fetched_at = entry["fetched_at"]
+            schedule.next_fetch_at = entry["next_fetch_at"]
+            schedule.failures = entry["failures"]
+        return schedule
+
+    def restore_client(self, client):
+        """
+        Lets the OJP client go on with the request quota, circuit breaker and incrementally
+        fetched departures of the last run that used it.
+        """
+        if self.client is None:
+            return
+        try:
+            client.restore(self.client)
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning("Could not restore the OJP client from %s: %s", self.path, e)
+
+    def keep_client(self, client):
+        self.client = client.snapshot()
+
+    def keep_schedule(self, schedule):
+        """
+        Keeps the departures (of the lines the clocks show) and schedule for the next run.
+        """
+        results = schedule.results
+        self.queries[self._key(schedule.query)] = {
+            "departures": {line: [int(to_epoch(t)) for t in results.get(line, ())] for line in schedule.query.lines},
+            "fetched_at": schedule.fetched_at,
+            "next_fetch_at": schedule.next_fetch_at,
+            "failures": schedule.failures,
+        }
+
+    def push_due(self, clock_config, line_colors, now, heartbeat=AWTRIX_HEARTBEAT):
+        """
+        True unless the clock already shows these colours and its heartbeat isn't due.
+        """
+        last = self.clocks.get(clock_config.name)
+        if last is None or last["url"] != clock_config.url or last["colors"] != line_colors:
+            return True
+        return bool(heartbeat) and now - last["pushed_at"] >= heartbeat
+
+    def pushed(self, clock_config, line_colors, now):
+        self.clocks[clock_config.name] = {"url": clock_config.url, "colors": line_colors, "pushed_at": now}
+
+
+def run_once(routes, state, ojp_client, awtrix_client, stop_cache=None, policy=None, now=None, force=False,
+             stale_for=DEPARTURES_STALE_FOR):
+    """
+    Fetches the departures that are due and pushes the clocks whose colours changed (or
+    whose heartbeat is due), then returns.
+    :param routes: The RoutesConfig.
+    :param state: The OneShotState of the last run, updated in place.
+    :param ojp_client: Function returning the OJPApiClient, only called when a stop has to
+                       be resolved or departures fetched.
+    :param awtrix_client: Function returning the AwtrixClient of a clock URL, only called
+                          for the clocks to push.
+    :param stop_cache: StopRefCache to look stops up in before resolving them.
+    :param now: Epoch seconds, defaults to the current time.
+    :param force: Fetch and push everything, whether it is due or not.
+    :param stale_for: Seconds after which departures that could not be fetched again are
+                      no longer shown.
+    :return: True if every fetch and push that was due succeeded.
+    """
+    now = time.time() if now is None else now
+    ok = True
+
+    stop_refs = {}
+    for name in routes.stop_names():
+        ref = stop_cache.get(OJP_URL, name) if stop_cache is not None else None
+        stop_refs[name] = ref if ref is not None else ojp_client().resolve_stop_ref(name)
+
+    for query in routes.queries(stop_refs):
+        schedule = state.schedule(query, policy)
+        if force or schedule.fetch_due(now):
+            started = time.perf_counter()
+            try:
+                results = ojp_client().get_departures(query.stop_ref_origin, query.stop_ref_destination, query.mode)
+                schedule.fetched(results, now)
+                report_fetched(query, results, time.perf_counter() - started, schedule.next_fetch_at - now)
+            except Exception as e:
+                ok = False
+                report_fetch_failed(query, e, schedule.fetch_failed(now, getattr(e, "retry_after", None)))
+            state.keep_schedule(schedule)
+
+        results = schedule.results
+        if schedule.fetched_at is None or now - schedule.fetched_at > stale_for:
+            results = {}
+        for clock_config in query.clocks:
+            line_colors = compute_line_colors(results, clock_config.lines, now=now, verbose=False)
+            if not (force or state.push_due(clock_config, line_colors, now)):
+                continue
+            log.info("Updating clock %s...", clock_config.name, extra={"clock": clock_config.name})
+            if awtrix_client(clock_config.url).update_clock(line_colors):
+                state.pushed(clock_config, line_colors, now)
+            else:
+                ok = False
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tramtrix-once", description="Fetch the departures that are due, update the clocks and exit."
+    )
+    parser.add_argument("--force", action="store_true", help="Fetch and push everything, whether due or not")
+    parser.add_argument("--state", default=ONESHOT_STATE_FILE, help="File the runs keep their state in")
+    args = parser.parse_args(argv)
+
+    try:
+        configure_logging()
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    if not OJP_API_KEY:
+        log.error("OJP_API_KEY environment variable is not set.")
+        return 1
+
+    state = OneShotState.load(args.state)
+    stop_cache = StopRefCache(STOP_CACHE_FILE, ttl=STOP_CACHE_TTL) if STOP_CACHE_FILE else None
+    with ExitStack() as stack:
+        clients = {}
+
+        # The HTTP clients (and requests) are only imported when a run needs them
+        def ojp_client():
+            if "ojp" not in clients:
+                from .ojp import OJPApiClient, TokenBucket, CircuitBreaker
+                from .stop_index import load_stop_index
+                # On the wall clock, so the quota and breaker carry over to the next run
+                client = OJPApiClient(stop_cache=stop_cache, stop_index=load_stop_index(),
+                                      rate_limiter=TokenBucket.for_daily_quota(clock=time.time),
+                                      breaker=CircuitBreaker(clock=time.time))
+                state.restore_client(client)
+                clients["ojp"] = stack.enter_context(client)
+            return clients["ojp"]
+
+        def awtrix_client(url):
+            if url not in clients:
+                from .awtrix import AwtrixClient
+                clients[url] = stack.enter_context(AwtrixClient(url, min_interval=0))
+            return clients[url]
+
+        try:
+            ok = run_once(configured_routes(), state, ojp_client, awtrix_client, stop_cache=stop_cache,
+                          force=args.force)
+        except Exception as e:
+            log.error("%s", e)
+            return 1
+        finally:
+            if "ojp" in clients:
+                state.keep_client(clients["ojp"])
+            try:
+                state.save()
+            except OSError as e:
+                log.warning("Could not write state %s: %s", state.path, e)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,411 @@
+import argparse
+import bisect
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from .awtrix import AwtrixClient
+from .ojp import OJPApiClient, TokenBucket, CircuitBreaker
+from .routes import configured_routes
+from .scheduler import FetchPolicy
+from .stop_cache import StopRefCache
+from .stop_index import load_stop_index
+from .log import configure_logging
+from .config import OJP_URL, STOP_CACHE_FILE, LOG_LEVEL
+
+# Response headers worth keeping, the body is stored decoded so the rest don't apply
+_KEPT_HEADERS = ("Content-Type", "Retry-After")
+
+# Request values that change on every call, masked when matching a request to a recording
+_VOLATILE = re.compile(
+    r"(<(?:siri:)?(?:RequestTimestamp|MessageIdentifier)>|<DepArrTime>)[^<]*"
+)
+
+
+def _text(body):
+    if body is None:
+        return ""
+    if isinstance(body, bytes):
+        return body.decode("utf-8", errors="replace")
+    return body
+
+
+def request_key(method, url, body):
+    """
+    What a request is matched to recorded ones by: its method, URL and, for XML (OJP)
+    requests, its body without the timestamps and message identifier. JSON (Awtrix)
+    bodies are left out, a clock answers every update the same way.
+    """
+    body = _text(body)
+    if body.lstrip().startswith("<"):
+        return method, url, _VOLATILE.sub(r"\1", body)
+    return method, url, None
+
+
+class Recorder:
+    """
+    Appends every request and response of the sessions it is attached to to a gzip
+    compressed JSON lines file, one object per exchange, e.g.
+    {"service": "ojp", "t": 1767700800.0, "latency": 0.412, "method": "POST",
+     "url": "https://...", "request": "<?xml ...", "status": 200,
+     "headers": {"Content-Type": "application/xml"}, "response": "<?xml ..."}
+    Failed requests have an "error" instead of status, headers and response. Request
+    headers are not recorded, so the API key never ends up in a recording.
+    Thread-safe.
+    """
+
+    def __init__(self, path, clock=time.time):
+        """
+        :param path: The recording file, appended to if it exists.
+        :param clock: Function returning the current time in epoch seconds.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.clock = clock
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def attach(self, session, service):
+        """
+        Records the requests the session sends from now on.
+        :param service: Name the exchanges are recorded under, e.g. 'ojp' or 'awtrix'.
+        """
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, RecordingAdapter(session.get_adapter(prefix), self, service))
+
+    def write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            # A sync flush keeps the compression history, so this costs little and a
+            # recording survives the process being killed
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Sends requests with the adapter it wraps and records them to a Recorder.
+    """
+
+    def __init__(self, adapter, recorder, service):
+        super().__init__()
+        self.adapter = adapter
+        self.recorder = recorder
+        self.service = service
+
+    def send(self, request, **kwargs):
+        entry = {
+            "service": self.service,
+            "t": self.recorder.clock(),
+            "method": request.method,
+            "url": request.url,
+            "request": _text(request.body),
+        }
+        started = time.perf_counter()
+        try:
+            response = self.adapter.send(request, **kwargs)
+            content = response.content
+        except requests.RequestException as e:
+            entry["latency"] = time.perf_counter() - started
+            entry["error"] = str(e)
+            self.recorder.write(entry)
+            raise
+        entry["latency"] = time.perf_counter() - started
+        entry["status"] = response.status_code
+        entry["headers"] = {name: response.headers[name] for name in _KEPT_HEADERS if name in response.headers}
+        entry["response"] = content.decode(response.encoding or "utf-8", errors="replace")
+        self.recorder.write(entry)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class Recording:
+    """
+    The exchanges of one or more recordings, ready to be replayed.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: The recorded exchanges, see Recorder.
+        """
+        self.entries = sorted(entries, key=lambda entry: entry["t"])
+        self._by_key = {}
+        for entry in self.entries:
+            self._by_key.setdefault(request_key(entry["method"], entry["url"], entry["request"]), []).append(entry)
+        self._times = {key: [entry["t"] for entry in entries] for key, entries in self._by_key.items()}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a recording file. A recording cut short (e.g. the recording process was
+        killed) is read up to where it ends.
+        """
+        entries = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        entries.append(json.loads(line))
+            except (EOFError, ValueError):
+                pass
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def start(self):
+        return self.entries[0]["t"] if self.entries else None
+
+    @property
+    def end(self):
+        return self.entries[-1]["t"] if self.entries else None
+
+    def find(self, method, url, body, now=None):
+        """
+        The recorded exchange for a request: of the ones with the same request_key, the
+        last one recorded at or before now, or the first one if all are later.
+        :return: The entry, or None if the request was never recorded.
+        """
+        key = request_key(method, url, body)
+        entries = self._by_key.get(key)
+        if not entries:
+            return None
+        if now is None:
+            return entries[0]
+        return entries[max(bisect.bisect_right(self._times[key], now) - 1, 0)]
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from a Recording instead of the network, after the recorded latency
+    (scaled by latency_scale) has passed on the given clock. Every request it is sent is
+    kept in sent, e.g. to compare the clock updates of a replay with the recorded ones.
+    """
+
+    def __init__(self, recording, clock=time.time, sleep=time.sleep, latency_scale=1.0, default_status=None):
+        """
+        :param clock: Function returning the current time in epoch seconds, which picks
+                      the recorded response, see Recording.find.
+        :param sleep: Function sleeping for the given number of seconds.
+        :param latency_scale: Multiplies the recorded latencies, 0 to answer at once.
+        :param default_status: Answer requests that were never recorded with this status
+                               and no body, instead of a connection error.
+        """
+        super().__init__()
+        self.recording = recording
+        self.clock = clock
+        self.sleep = sleep
+        self.latency_scale = latency_scale
+        self.default_status = default_status
+        self.sent = []
+        self.missed = 0
+
+    def send(self, request, **kwargs):
+        now = self.clock()
+        self.sent.append((now, request.method, request.url, _text(request.body)))
+        entry = self.recording.find(request.method, request.url, request.body, now)
+        if entry is None:
+            self.missed += 1
+            if self.default_status is None:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+            return self._response(request, self.default_status, "", {})
+
+        if self.latency_scale:
+            self.sleep(entry.get("latency", 0) * self.latency_scale)
+        if "error" in entry:
+            raise requests.ConnectionError(entry["error"], request=request)
+        return self._response(request, entry["status"], entry["response"], entry.get("headers", {}))
+
+    @staticmethod
+    def _response(request, status, text, headers):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = text.encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def replay_session(adapter):
+    """
+    A requests Session sending every request to the adapter.
+    """
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ReplayFinished(BaseException):
+    """
+    Raised by SimulatedTime.sleep at the end of the replay. Not an Exception, so the
+    error handling of a fetch doesn't swallow it and the main loop stops.
+    """
+
+
+class SimulatedTime:
+    """
+    A clock that only moves when slept on, so a recorded day is replayed as fast as the
+    code runs (speed=0), or at speed times real time.
+    """
+
+    def __init__(self, start, until=None, speed=0):
+        self.now = start
+        self.until = until
+        self.speed = speed
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if self.until is not None and self.now + seconds >= self.until:
+            self.now = self.until
+            raise ReplayFinished()
+        self.now += seconds
+        if self.speed:
+            time.sleep(seconds / self.speed)
+
+
+def replay(path, routes=None, hours=None, speed=0, latency_scale=1.0, seed=0, stop_cache=None, stop_index=None,
+           policy=None):
+    """
+    Runs the main loop against a recording, from its first exchange to its last (or for
+    the given number of hours), on simulated time. OJP requests are answered from the
+    recording, clock updates are accepted and counted. The same recording, routes and
+    seed always give the same clock updates.
+    :param routes: The RoutesConfig to run, by default the configured one.
+    :param speed: 0 to run as fast as possible, otherwise times real time.
+    :param latency_scale: Multiplies the recorded OJP latencies, 0 to leave them out.
+    :param seed: Seeds the backoff jitter.
+    :param policy: The FetchPolicy to replay with, by default the configured one.
+    :return: Dictionary summarizing the replay: simulated and real seconds, OJP requests
+             sent and missing from the recording, and clock updates per clock URL next to
+             the ones recorded over the same time.
+    """
+    from .main import run
+
+    recording = Recording.load(path)
+    if not len(recording):
+        raise ValueError(f"{path} holds no recorded requests")
+    routes = routes if routes is not None else configured_routes()
+    until = recording.end if hours is None else recording.start + hours * 3600
+    simulated = SimulatedTime(recording.start, until=until, speed=speed)
+    rng = random.Random(seed)
+
+    ojp_adapter = ReplayAdapter(recording, simulated.time, simulated.sleep, latency_scale)
+    awtrix_adapter = ReplayAdapter(recording, simulated.time, simulated.sleep, 0, default_status=200)
+    started = time.perf_counter()
+    with ExitStack() as stack:
+        client = stack.enter_context(OJPApiClient(
+            api_key="replay",
+            url=next((e["url"] for e in recording.entries if e.get("service") == "ojp"), OJP_URL),
+            session=replay_session(ojp_adapter),
+            stop_cache=stop_cache,
+            stop_index=stop_index,
+            rate_limiter=TokenBucket.for_daily_quota(clock=simulated.time, sleep=simulated.sleep),
+            breaker=CircuitBreaker(clock=simulated.time, random=rng.random),
+            clock=simulated.time,
+        ))
+        clocks = {}
+        for clock in routes.clocks:
+            # MQTT clocks are replayed as HTTP ones, only what is sent to them matters
+            url = clock.url if clock.url and clock.url.startswith("http") else f"http://{clock.name}/api/custom?name=tram"
+            clocks[clock.name] = stack.enter_context(
+                AwtrixClient(url, session=replay_session(awtrix_adapter), clock=simulated.time)
+            )
+
+        stop_refs = {name: client.resolve_stop_ref(name) for name in routes.stop_names()}
+        try:
+            policy = policy if policy is not None else FetchPolicy(random=rng.random)
+            run(client, clocks, routes.queries(stop_refs), policy,
+                clock=simulated.time, sleep=simulated.sleep, background=False)
+        except ReplayFinished:
+            pass
+
+    recorded_updates = {}
+    for entry in recording.entries:
+        if entry.get("service") == "awtrix" and entry["t"] <= until:
+            recorded_updates[entry["url"]] = recorded_updates.get(entry["url"], 0) + 1
+    replayed_updates = {}
+    for _, _, url, _ in awtrix_adapter.sent:
+        replayed_updates[url] = replayed_updates.get(url, 0) + 1
+    return {
+        "simulated_seconds": simulated.now - recording.start,
+        "real_seconds": time.perf_counter() - started,
+        "ojp_requests": len(ojp_adapter.sent),
+        "ojp_missed": ojp_adapter.missed,
+        "clock_updates": replayed_updates,
+        "recorded_clock_updates": recorded_updates,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tramtrix-replay", description="Run the main loop against a recording.")
+    parser.add_argument("recording", help="A recording made with RECORD_FILE set")
+    parser.add_argument("--hours", type=float, help="Only replay this many hours from the start")
+    parser.add_argument("--speed", type=float, default=0, help="Times real time, 0 (default) for as fast as possible")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies the recorded latencies")
+    parser.add_argument("--seed", type=int, default=0, help="Seeds the backoff jitter")
+    parser.add_argument("--quiet", action="store_true", help="Only print the summary")
+    args = parser.parse_args(argv)
+
+    try:
+        configure_logging("ERROR" if args.quiet else LOG_LEVEL)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Stops are looked up in a copy of the stop cache, the replay's lookups at
+        # simulated times never reach the daemon's
+        stop_cache = None
+        if STOP_CACHE_FILE:
+            stop_cache = StopRefCache(os.path.join(tmp_dir, "stop_refs.json"), ttl=None)
+            try:
+                shutil.copyfile(STOP_CACHE_FILE, stop_cache.path)
+            except OSError:
+                pass
+        try:
+            summary = replay(args.recording, hours=args.hours, speed=args.speed, latency_scale=args.latency_scale,
+                             seed=args.seed, stop_cache=stop_cache, stop_index=load_stop_index())
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+
+    print(f"Replayed {summary['simulated_seconds'] / 3600:.1f}h in {summary['real_seconds']:.1f}s: "
+          f"{summary['ojp_requests']} OJP requests ({summary['ojp_missed']} not in the recording)")
+    for url, count in sorted(summary["clock_updates"].items()):
+        print(f"  {url}: {count} updates (recorded: {summary['recorded_clock_updates'].get(url, 0)})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import json
+from .ojp_requests import FETCH_MODES
+from .config import AWTRIX_URL, STOP_NAME_ORIGIN, STOP_NAME_DESTINATION, TRAM_LINES, ROUTES_CONFIG_FILE, FETCH_MODE
+
+
+class Route:
+    def __init__(self, name, origin, destination, mode=FETCH_MODE):
+        """
+        :param origin: Stop name the trams are boarded at.
+        :param destination: Stop name the trams must be heading to.
+        :param mode: How the departures are fetched, one of FETCH_MODES: 'trip'
+                     (OJPTripRequest), 'stop_event' (OJPStopEventRequest) or
+                     'trip_incremental' (OJPTripRequests for the departures not known yet).
+        """
+        if mode not in FETCH_MODES:
+            raise ValueError(f"Route '{name}' has unknown mode '{mode}', expected one of {', '.join(FETCH_MODES)}")
+        self.name = name
+        self.origin = origin
+        self.destination = destination
+        self.mode = mode
+
+    def __repr__(self):
+        return f"Route({self.name!r}, {self.origin!r}, {self.destination!r}, {self.mode!r})"
+
+
+class Clock:
+    def __init__(self, name, url, route, lines):
+        """
+        :param url: The Awtrix custom app URL of the clock.
+        :param route: Name of the Route the clock shows.
+        :param lines: The lines to show, in display order.
+        """
+        self.name = name
+        self.url = url
+        self.route = route
+        self.lines = list(lines)
+
+    def __repr__(self):
+        return f"Clock({self.name!r}, {self.url!r}, {self.route!r}, {self.lines!r})"
+
+
+class Query:
+    """
+    A distinct trip request, shared by every clock whose route resolves to the same stops.
+    """
+
+    def __init__(self, stop_ref_origin, stop_ref_destination, clocks=None, mode=FETCH_MODE):
+        self.stop_ref_origin = stop_ref_origin
+        self.stop_ref_destination = stop_ref_destination
+        self.clocks = clocks if clocks is not None else []
+        self.mode = mode
+
+    @property
+    def lines(self):
+        """
+        All lines any subscribed clock shows.
+        """
+        lines = []
+        for clock in self.clocks:
+            lines.extend(line for line in clock.lines if line not in lines)
+        return lines
+
+    def __repr__(self):
+        return f"Query({self.stop_ref_origin!r}, {self.stop_ref_destination!r}, {[c.name for c in self.clocks]!r}, {self.mode!r})"
+
+
+class RoutesConfig:
+    def __init__(self, routes, clocks):
+        """
+        :param routes: List of Routes.
+        :param clocks: List of Clocks, each referring to one of the routes by name.
+        """
+        self.routes = {route.name: route for route in routes}
+        self.clocks = list(clocks)
+        for clock in self.clocks:
+            if clock.route not in self.routes:
+                raise ValueError(f"Clock '{clock.name}' refers to unknown route '{clock.route}'")
+
+    def stop_names(self):
+        """
+        The distinct stop names used by routes with at least one clock.
+        """
+        names = []
+        for clock in self.clocks:
+            route = self.routes[clock.route]
+            names.extend(name for name in (route.origin, route.destination) if name not in names)
+        return names
+
+    def queries(self, stop_refs):
+        """
+        Groups the clocks into one Query per distinct (origin, destination) pair of stop refs
+        and fetch mode, so each pair is only fetched once per cycle however many clocks show it.
+        :param stop_refs: Dictionary of stop name to resolved StopPointRef.
+        :return: List of Queries, in the order of their first clock.
+        """
+        queries = {}
+        for clock in self.clocks:
+            route = self.routes[clock.route]
+            key = (stop_refs[route.origin], stop_refs[route.destination], route.mode)
+            if key not in queries:
+                queries[key] = Query(*key[:2], mode=route.mode)
+            queries[key].clocks.append(clock)
+        return list(queries.values())
+
+
+def _lines(value, where):
+    if value is None:
+        return TRAM_LINES
+    if isinstance(value, str):
+        value = value.split(",")
+    lines = [str(line).strip() for line in value if str(line).strip()]
+    if not lines:
+        raise ValueError(f"{where} has no lines")
+    return lines
+
+
+def parse_routes_config(data):
+    """
+    Builds a RoutesConfig from a parsed config file, e.g.
+    {
+        "routes": {
+            "heuried": {"origin": "Zürich, Heuried", "destination": "Zürich, Stauffacher", "mode": "stop_event"}
+        },
+        "clocks": {
+            "kitchen": {"url": "http://kitchen/api/custom?name=tram", "route": "heuried", "lines": ["9", "14"]},
+            "office": {"url": "http://office/api/custom?name=tram", "route": "heuried", "lines": ["14"]}
+        }
+    }
+    A route's mode defaults to FETCH_MODE. A clock's route may be left out when there is only
+    one route, and its lines default to TRAM_LINES.
+    :raises ValueError: If the config is incomplete or inconsistent.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("routes"), dict) or not isinstance(data.get("clocks"), dict):
+        raise ValueError("Config must contain 'routes' and 'clocks' objects")
+
+    routes = []
+    for name, route in data["routes"].items():
+        try:
+            routes.append(Route(name, route["origin"], route["destination"], route.get("mode", FETCH_MODE)))
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError(f"Route '{name}' needs an 'origin' and a 'destination'")
+
+    clocks = []
+    for name, clock in data["clocks"].items():
+        if not isinstance(clock, dict) or not clock.get("url"):
+            raise ValueError(f"Clock '{name}' needs a 'url'")
+        route = clock.get("route")
+        if route is None:
+            if len(routes) != 1:
+                raise ValueError(f"Clock '{name}' needs a 'route'")
+            route = routes[0].name
+        clocks.append(Clock(name, clock["url"], route, _lines(clock.get("lines"), f"Clock '{name}'")))
+
+    return RoutesConfig(routes, clocks)
+
+
+def load_routes_config(path):
+    """
+    Loads a RoutesConfig from a JSON file, see parse_routes_config for the format.
+    """
+    with open(path, encoding="utf-8") as f:
+        return parse_routes_config(json.load(f))
+
+
+def default_routes_config():
+    """
+    The single route and clock configured by the STOP_NAME_* / AWTRIX_URL / TRAM_LINES settings.
+    """
+    return RoutesConfig(
+        [Route("default", STOP_NAME_ORIGIN, STOP_NAME_DESTINATION)],
+        [Clock("default", AWTRIX_URL, "default", TRAM_LINES)],
+    )
+
+
+def configured_routes():
+    """
+    The routes from ROUTES_CONFIG_FILE if set, otherwise the single default route.
+    """
+    if ROUTES_CONFIG_FILE:
+        return load_routes_config(ROUTES_CONFIG_FILE)
+    return default_routes_config()
@@ -0,0 +1,130 @@
+import random
+from .traffic_light import colour_timelines, to_epoch
+from .config import (
+    TIME_GREEN_MAX, TIME_AMBER_MAX, TIME_AMBER_MIN,
+    UPDATE_INTERVAL, FETCH_INTERVAL_MIN, FETCH_INTERVAL_MAX,
+    FETCH_IDLE_HORIZON, FETCH_VOLATILE_SECONDS
+)
+
+
+def backoff_delay(failures, base, cap, random=random.random):
+    """
+    Exponential backoff with jitter: base seconds after the first failure, doubled for
+    each further failure up to cap, then a random amount of up to half of it taken off
+    so that clients failing together don't retry together.
+    """
+    delay = min(cap, base * 2 ** max(failures - 1, 0))
+    return delay / 2 + random() * delay / 2
+
+
+class FetchPolicy:
+    """
+    Decides how long to wait before fetching departures again:
+    - min_interval while the realtime estimates keep moving between fetches
+    - max_interval when no tram is due within the idle horizon, e.g. at night
+    - otherwise min_interval before the first colour change of a coming tram that is
+      more than interval away, so every colour change is worked out from departures at
+      most interval old, but never sooner than interval nor later than max_interval
+    Failed fetches are retried with exponential backoff from min_interval up to max_interval.
+    """
+
+    def __init__(self, interval=UPDATE_INTERVAL, min_interval=FETCH_INTERVAL_MIN, max_interval=FETCH_INTERVAL_MAX,
+                 idle_horizon=FETCH_IDLE_HORIZON * 60, volatile_seconds=FETCH_VOLATILE_SECONDS, random=random.random):
+        """
+        :param random: Function returning a random float in [0, 1), for the backoff jitter.
+        """
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.idle_horizon = idle_horizon
+        self.volatile_seconds = volatile_seconds
+        self.random = random
+
+    def retry_delay(self, failures, retry_after=None):
+        """
+        Seconds to wait before fetching again after failures failed fetches in a row.
+        :param retry_after: Seconds the API asked to wait, if it did.
+        """
+        delay = backoff_delay(failures, self.min_interval, self.max_interval, self.random)
+        return max(delay, retry_after or 0)
+
+    def is_volatile(self, results, previous_results, lines, now):
+        """
+        True if a departure due within the green window moved by more than volatile_seconds
+        since the previous fetch.
+        """
+        if previous_results is None:
+            return False
+        horizon = now + TIME_GREEN_MAX * 60 * 2
+        for line in lines:
+            previous = [to_epoch(t) for t in previous_results.get(line, ())]
+            for departure in results.get(line, ()):
+                t = to_epoch(departure)
+                if now <= t <= horizon:
+                    if not previous or min(abs(t - p) for p in previous) > self.volatile_seconds:
+                        return True
+        return False
+
+    def delay(self, results, previous_results, lines, now):
+        """
+        Seconds to wait before the next fetch.
+        :param results: The departures that were just fetched.
+        :param previous_results: The departures from the fetch before, or None.
+        :param now: Epoch seconds.
+        """
+        if self.is_volatile(results, previous_results, lines, now):
+            return self.min_interval
+        upcoming = [t for t in (to_epoch(departure) for line in lines for departure in results.get(line, ())) if t > now]
+        if not upcoming or min(upcoming) - now > self.idle_horizon:
+            return self.max_interval
+
+        # A tram turns green, amber and red at these offsets before it leaves. The changes
+        # until the next regular fetch are covered by the departures just fetched
+        offsets = (TIME_GREEN_MAX * 60, TIME_AMBER_MAX * 60, TIME_AMBER_MIN * 60)
+        later = [t - offset for t in upcoming for offset in offsets if t - offset > now + self.interval]
+        if not later:
+            return self.interval
+        return min(self.max_interval, max(self.interval, min(later) - self.min_interval - now))
+
+
+class QuerySchedule:
+    """
+    Keeps the last departures of a Query, with their colour timelines, and works out
+    when they next need fetching.
+    """
+
+    def __init__(self, query, policy=None):
+        self.query = query
+        self.policy = policy if policy is not None else FetchPolicy()
+        self.results = {}
+        self.timelines = {}
+        self.fetched_at = None
+        self.next_fetch_at = 0
+        self.failures = 0
+
+    def fetch_due(self, now):
+        return now >= self.next_fetch_at
+
+    def fetched(self, results, now):
+        """
+        Records a successful fetch and schedules the next one.
+        :return: Seconds until the next fetch.
+        """
+        delay = self.policy.delay(results, self.results if self.fetched_at is not None else None, self.query.lines, now)
+        self.results = results
+        self.timelines = colour_timelines(results, now, lines=self.query.lines)
+        self.fetched_at = now
+        self.next_fetch_at = now + delay
+        self.failures = 0
+        return delay
+
+    def fetch_failed(self, now, retry_after=None):
+        """
+        Keeps the last departures and retries with backoff.
+        :param retry_after: Seconds the API asked to wait, if it did.
+        :return: Seconds until the next fetch.
+        """
+        self.failures += 1
+        delay = self.policy.retry_delay(self.failures, retry_after)
+        self.next_fetch_at = now + delay
+        return delay
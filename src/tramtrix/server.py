@@ -0,0 +1,305 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from .departure_cache import DepartureCache, FRESH
+from .ojp import OJPApiClient, OJPApiError, StopNotFoundError, FETCH_MODES
+from .routes import configured_routes
+from .stop_cache import StopRefCache
+from .stop_index import load_stop_index
+from .replay import Recorder
+from .traffic_light import calculate_traffic_light_colour, colour_timelines, to_hex_color
+from .log import configure_logging
+from .metrics import serve_metrics
+from .config import (
+    OJP_API_KEY, FETCH_MODE, STOP_CACHE_FILE, STOP_CACHE_TTL, RECORD_FILE,
+    SERVER_HOST, SERVER_PORT, SERVER_CACHE_TTL, SERVER_MAX_ROUTES, SERVER_ROUTES_ONLY, DEPARTURES_STALE_FOR,
+    METRICS_PORT, METRICS_HOST
+)
+
+log = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers asking for a key while its call is
+    in progress wait for it and share its result (or its exception) instead of making
+    their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """
+        :param function: Called without arguments if no call for the key is in progress.
+        :return: The function's result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class DepartureService:
+    """
+    Answers departure and colour queries for any route, sharing the fetched departures
+    between everyone asking for the same one. Departures are fetched at most once per
+    ttl seconds per route, however many requests come in, and stale ones are served
+    while the API fails. Only the max_routes routes fetched last are kept, or only the
+    configured routes are answered at all.
+    """
+
+    def __init__(self, client, ttl=SERVER_CACHE_TTL, stale_for=DEPARTURES_STALE_FOR, clock=time.time,
+                 max_routes=SERVER_MAX_ROUTES, stop_refs=None, routes=None):
+        """
+        :param client: The OJPApiClient to fetch with.
+        :param ttl: Seconds fetched departures are served before fetching them again.
+        :param stale_for: Seconds departures are served while fetching them again fails.
+        :param clock: Function returning the current time in epoch seconds.
+        :param max_routes: The most routes departures are kept of, and half the most stop
+                           names remembered.
+        :param stop_refs: Stop names already resolved, mapped to their StopPointRefs.
+        :param routes: Only answer these (origin ref, destination ref) pairs, and only
+                       the stop names in stop_refs. None to answer any route.
+        """
+        self.client = client
+        self.cache = DepartureCache(fresh_for=ttl, stale_for=stale_for, clock=clock, max_entries=max_routes)
+        self.max_stops = max(2 * max_routes, len(stop_refs or ()))
+        self.routes = None if routes is None else set(routes)
+        self._clock = clock
+        self._flight = SingleFlight()
+        self._stop_refs = OrderedDict(stop_refs or {})
+        self._lock = threading.Lock()
+
+    def resolve(self, stop_name):
+        """
+        The StopPointRef of a stop name, resolved once and then remembered.
+        :raises StopNotFoundError: If there is no such stop, or it is not on a configured route.
+        """
+        with self._lock:
+            ref = self._stop_refs.get(stop_name)
+            if ref is not None:
+                self._stop_refs.move_to_end(stop_name)
+                return ref
+        if self.routes is not None:
+            raise StopNotFoundError(f"'{stop_name}' is not a stop of the configured routes")
+        ref = self._flight.do(("resolve", stop_name), lambda: self.client.resolve_stop_ref(stop_name))
+        with self._lock:
+            self._stop_refs[stop_name] = ref
+            while len(self._stop_refs) > self.max_stops:
+                self._stop_refs.popitem(last=False)
+        return ref
+
+    def _fetch(self, key):
+        # A caller that just missed the previous fetch finds its departures here
+        entry, state = self.cache.get(key)
+        if state == FRESH:
+            return entry
+        origin, destination, mode = key
+        results = self.client.get_departures(origin, destination, mode=mode, allow_stale=False)
+        now = self._clock()
+        self.cache.put(key, results, colour_timelines(results, now), now)
+        return self.cache.get(key, now)[0]
+
+    def get(self, origin, destination, mode=FETCH_MODE):
+        """
+        :return: (CachedDepartures, state)
+        :raises LookupError: If only the configured routes are answered and this isn't one.
+        :raises OJPApiError: If the departures could not be fetched and none are cached.
+        """
+        if self.routes is not None and (origin, destination) not in self.routes:
+            raise LookupError(f"{origin} -> {destination} is not a configured route")
+        key = (origin, destination, mode)
+        entry, state = self.cache.get(key)
+        if state == FRESH:
+            return entry, state
+        try:
+            return self._flight.do(key, lambda: self._fetch(key)), FRESH
+        except OJPApiError:
+            if entry is None:
+                raise
+            return entry, state
+
+    def departures(self, origin, destination, lines=None, mode=FETCH_MODE):
+        """
+        The colours and departures of a route, as sent by the server, e.g.
+        {"origin": "8591190", "destination": "8591381", "mode": "trip", "state": "fresh",
+         "fetched_at": 1767700800, "age": 12,
+         "lines": {"9": {"status": "GREEN", "color": "03fc14", "departures": [1767701100]}}}
+        :param lines: The lines to include, by default all lines departing.
+        """
+        entry, state = self.get(origin, destination, mode)
+        now = self._clock()
+        lines = list(entry.results) if lines is None else lines
+        by_line = {}
+        for line in lines:
+            times = entry.results.get(line, ())
+            timeline = entry.timelines.get(line)
+            status = timeline.colour_at(now) if timeline is not None else calculate_traffic_light_colour(times, now=now)
+            by_line[line] = {"status": status, "color": to_hex_color(status), "departures": [int(t) for t in times]}
+        return {
+            "origin": origin,
+            "destination": destination,
+            "mode": mode,
+            "state": state,
+            "fetched_at": int(entry.fetched_at),
+            "age": int(now - entry.fetched_at),
+            "lines": by_line,
+        }
+
+    def handle_query(self, query):
+        """
+        Answers a /departures query string, e.g.
+        origin=Zürich, Heuried&destination=Zürich, Stauffacher&lines=9,14 or
+        origin_ref=8591190&destination_ref=8591381&mode=stop_event
+        :raises ValueError: If the query is incomplete.
+        """
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        refs = []
+        for end in ("origin", "destination"):
+            if params.get(f"{end}_ref"):
+                refs.append(params[f"{end}_ref"])
+            elif params.get(end):
+                refs.append(self.resolve(params[end]))
+            else:
+                raise ValueError(f"Missing '{end}' or '{end}_ref'")
+        mode = params.get("mode", FETCH_MODE)
+        if mode not in FETCH_MODES:
+            raise ValueError(f"Unknown mode '{mode}', expected one of {', '.join(FETCH_MODES)}")
+        lines = [line.strip() for line in params["lines"].split(",") if line.strip()] if params.get("lines") else None
+        return self.departures(refs[0], refs[1], lines=lines, mode=mode)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections open, pollers ask again and again
+    protocol_version = "HTTP/1.1"
+    server_version = "tramtrix"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            self._send_json(200, {"status": "ok"})
+            return
+        if url.path != "/departures":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            self._send_json(200, self.server.service.handle_query(url.query))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except LookupError as e:
+            # No such stop, or not a route this server answers
+            self._send_json(404, {"error": str(e)})
+        except OJPApiError as e:
+            headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after else {}
+            self._send_json(503 if e.retry_after else 502, {"error": str(e)}, headers)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class TramtrixServer(ThreadingHTTPServer):
+    """
+    HTTP server answering GET /departures (see DepartureService.handle_query) and
+    GET /health, one thread per connection.
+    """
+
+    daemon_threads = True
+    # Many clients may connect at once, the default backlog of 5 drops their connections
+    request_queue_size = 1024
+
+    def __init__(self, service, address=(SERVER_HOST, SERVER_PORT), verbose=False):
+        """
+        :param service: The DepartureService answering the queries.
+        :param verbose: Log every request to stderr.
+        """
+        self.service = service
+        self.verbose = verbose
+        super().__init__(address, _Handler)
+
+
+def main():
+    try:
+        configure_logging()
+        if not OJP_API_KEY:
+            log.error("OJP_API_KEY environment variable is not set.")
+            sys.exit(1)
+
+        stop_cache = StopRefCache(STOP_CACHE_FILE, ttl=STOP_CACHE_TTL) if STOP_CACHE_FILE else None
+        with ExitStack() as stack:
+            if METRICS_PORT:
+                stack.enter_context(serve_metrics(METRICS_PORT, METRICS_HOST))
+            recorder = stack.enter_context(Recorder(RECORD_FILE)) if RECORD_FILE else None
+            client = stack.enter_context(OJPApiClient(stop_cache=stop_cache, stop_index=load_stop_index(), recorder=recorder,
+                                                      max_routes=SERVER_MAX_ROUTES))
+            stop_refs, routes = None, None
+            if SERVER_ROUTES_ONLY:
+                config = configured_routes()
+                stop_refs = {name: client.resolve_stop_ref(name) for name in config.stop_names()}
+                routes = [(query.stop_ref_origin, query.stop_ref_destination) for query in config.queries(stop_refs)]
+                log.info("Answering the %d configured routes only", len(routes))
+            server = TramtrixServer(DepartureService(client, stop_refs=stop_refs, routes=routes))
+            host, port = server.server_address[:2]
+            log.info("Serving departures on http://%s:%s/departures (cache TTL: %ss)", host, port, SERVER_CACHE_TTL)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                log.info("Stopped.")
+    except Exception as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import HTTP_POOL_SIZE, HTTP_KEEP_ALIVE, HTTP_RETRIES, HTTP_RETRY_BACKOFF
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, keep_alive=HTTP_KEEP_ALIVE,
+                   retries=HTTP_RETRIES, retry_backoff=HTTP_RETRY_BACKOFF):
+    """
+    Creates a requests Session with a pool of keep-alive connections, so repeated
+    calls to the same host reuse the TCP/TLS connection instead of reconnecting.
+
+    :param pool_size: Maximum number of connections kept open per host.
+    :param keep_alive: Set to False to close the connection after every request.
+    :param retries: How often connection errors and 502/503/504 responses are retried.
+    :param retry_backoff: Backoff factor (seconds) between retries, doubled each attempt.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=retry_backoff,
+        status_forcelist=(502, 503, 504),
+        # Our POSTs are queries or idempotent app updates, so they are safe to retry
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
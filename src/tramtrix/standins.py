@@ -0,0 +1,535 @@
+import argparse
+import gzip
+import json
+import math
+import random
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+from .departures import parse_iso8601
+from .ojp import TokenBucket
+from .ojp_parser import OJP_NAMESPACE, SIRI_NAMESPACE
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution, one of
+    - '0.2': always 0.2 seconds
+    - 'uniform:0.1:0.5': evenly between 0.1 and 0.5 seconds
+    - 'lognormal:0.3:0.5': log-normal with a median of 0.3 seconds and a sigma of 0.5,
+      the long tail real APIs have
+    - 'exponential:0.3': exponential with a mean of 0.3 seconds
+    :return: Function taking a random.Random and returning a latency in seconds.
+    :raises ValueError: If the spec is not one of these.
+    """
+    kind, _, args = str(spec).partition(":")
+    try:
+        values = [float(x) for x in args.split(":")] if args else []
+        if not args:
+            fixed = float(kind)
+            if fixed < 0:
+                raise ValueError()
+            return lambda rng: fixed
+        if kind == "uniform" and len(values) == 2 and 0 <= values[0] <= values[1]:
+            return lambda rng: rng.uniform(*values)
+        if kind == "lognormal" and len(values) == 2 and values[0] > 0 and values[1] >= 0:
+            return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+        if kind == "exponential" and len(values) == 1 and values[0] > 0:
+            return lambda rng: rng.expovariate(1 / values[0])
+    except ValueError:
+        pass
+    raise ValueError(
+        f"Invalid latency '{spec}', expected e.g. 0.2, uniform:0.1:0.5, lognormal:0.3:0.5 or exponential:0.3"
+    )
+
+
+class Faults:
+    """
+    What a stand-in server does to each request before answering it: wait for a latency
+    drawn from a distribution, then answer 503 (error_rate), close the connection without
+    answering (drop_rate), or answer 429 when more than rate_limit requests a second
+    arrive. Thread-safe.
+    """
+
+    def __init__(self, latency="0", error_rate=0.0, drop_rate=0.0, rate_limit=0, burst=None, seed=None,
+                 clock=time.monotonic):
+        """
+        :param latency: The latency distribution, see parse_latency.
+        :param error_rate: Fraction of requests answered with 503.
+        :param drop_rate: Fraction of requests whose connection is closed without an answer.
+        :param rate_limit: Requests a second let through, 0 for no limit.
+        :param burst: Requests let through at once, by default a second's worth.
+        :param seed: Seeds the latencies and faults.
+        """
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.bucket = TokenBucket(rate_limit, burst or max(rate_limit, 1), clock=clock) if rate_limit else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def decide(self):
+        """
+        :return: (latency in seconds, None to answer, or 'error', 'drop' or 'throttle')
+        """
+        with self._lock:
+            latency = self.latency(self._random)
+            roll = self._random.random()
+        if self.bucket is not None and not self.bucket.try_acquire():
+            return latency, "throttle"
+        if roll < self.drop_rate:
+            return latency, "drop"
+        if roll < self.drop_rate + self.error_rate:
+            return latency, "error"
+        return latency, None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API and the clocks
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.serve_request(self)
+
+    def do_POST(self):
+        self.server.serve_request(self)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A local HTTP server standing in for a real service in tests, benchmarks and soak
+    tests, with injected latency and faults (see Faults). Serves in a background thread
+    once started, and counts the answers it gave.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), faults=None, sleep=time.sleep, verbose=False, compress=False):
+        """
+        :param address: (host, port) to listen on, port 0 for any free one.
+        :param faults: The Faults to inject, by default none.
+        :param compress: Gzip the answers to requests accepting it.
+        """
+        super().__init__(address, _Handler)
+        self.faults = faults if faults is not None else Faults()
+        self.sleep = sleep
+        self.verbose = verbose
+        self.compress = compress
+        self.requests = 0
+        # Number of answers by status code, and of connections closed without one
+        self.statuses = {}
+        self.dropped = 0
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        with self._stats_lock:
+            return {"requests": self.requests, "statuses": dict(self.statuses), "dropped": self.dropped}
+
+    def respond(self, method, path, body):
+        """
+        The answer to a request that gets one, to be implemented by each stand-in.
+        :return: (status code, content type, body bytes)
+        """
+        raise NotImplementedError()
+
+    def serve_request(self, handler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        latency, fault = self.faults.decide()
+        if latency:
+            self.sleep(latency)
+
+        with self._stats_lock:
+            self.requests += 1
+            if fault == "drop":
+                self.dropped += 1
+        if fault == "drop":
+            handler.close_connection = True
+            return
+
+        headers = {}
+        if fault == "throttle":
+            status, content_type, content = 429, "text/plain", b"Too Many Requests"
+            headers["Retry-After"] = str(max(math.ceil(self.faults.bucket.wait_time()), 1))
+        elif fault == "error":
+            status, content_type, content = 503, "text/plain", b"Service Unavailable"
+        else:
+            try:
+                status, content_type, content = self.respond(handler.command, handler.path, body)
+            except Exception as e:
+                status, content_type, content = 500, "text/plain", f"Stand-in failed: {e}".encode("utf-8")
+
+        if self.compress and "gzip" in handler.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content)
+            headers["Content-Encoding"] = "gzip"
+
+        with self._stats_lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _hash(*parts):
+    return zlib.crc32("|".join(str(part) for part in parts).encode("utf-8"))
+
+
+_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+            <siri:ProducerRef>tramtrix-standin</siri:ProducerRef>
+            <{delivery}>
+                <siri:ResponseTimestamp>{now}</siri:ResponseTimestamp>
+                <siri:Status>true</siri:Status>
+{results}            </{delivery}>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+_PLACE_RESULT = """                <PlaceResult>
+                    <Place>
+                        <StopPlace>
+                            <StopPlaceRef>{ref}</StopPlaceRef>
+                            <StopPlaceName>
+                                <Text xml:lang="de">{name}</Text>
+                            </StopPlaceName>
+                        </StopPlace>
+                    </Place>
+                    <Complete>true</Complete>
+                    <Probability>1</Probability>
+                </PlaceResult>
+"""
+
+_TRIP_RESULT = """                <TripResult>
+                    <Id>{journey_ref}</Id>
+                    <Trip>
+                        <Leg>
+                            <TimedLeg>
+                                <LegBoard>
+                                    <siri:StopPointRef>{origin}</siri:StopPointRef>
+                                    <ServiceDeparture>
+                                        <TimetabledTime>{timetabled}</TimetabledTime>
+                                        <EstimatedTime>{estimated}</EstimatedTime>
+                                    </ServiceDeparture>
+                                </LegBoard>
+                                <LegAlight>
+                                    <siri:StopPointRef>{destination}</siri:StopPointRef>
+                                    <ServiceArrival>
+                                        <TimetabledTime>{arrival}</TimetabledTime>
+                                    </ServiceArrival>
+                                </LegAlight>
+                                <Service>
+                                    <OperatingDayRef>{operating_day}</OperatingDayRef>
+                                    <JourneyRef>{journey_ref}</JourneyRef>
+                                    <PublishedServiceName>
+                                        <Text xml:lang="de">{line}</Text>
+                                    </PublishedServiceName>
+                                </Service>
+                            </TimedLeg>
+                        </Leg>
+                    </Trip>
+                </TripResult>
+"""
+
+_STOP_EVENT_RESULT = """                <StopEventResult>
+                    <Id>{journey_ref}</Id>
+                    <StopEvent>
+                        <ThisCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>{origin}</siri:StopPointRef>
+                                <ServiceDeparture>
+                                    <TimetabledTime>{timetabled}</TimetabledTime>
+                                    <EstimatedTime>{estimated}</EstimatedTime>
+                                </ServiceDeparture>
+                            </CallAtStop>
+                        </ThisCall>
+{onward_calls}                        <Service>
+                            <OperatingDayRef>{operating_day}</OperatingDayRef>
+                            <JourneyRef>{journey_ref}</JourneyRef>
+                            <PublishedServiceName>
+                                <Text xml:lang="de">{line}</Text>
+                            </PublishedServiceName>
+                        </Service>
+                    </StopEvent>
+                </StopEventResult>
+"""
+
+_ONWARD_CALL = """                        <OnwardCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>{stop}</siri:StopPointRef>
+                                <ServiceArrival>
+                                    <TimetabledTime>{arrival}</TimetabledTime>
+                                </ServiceArrival>
+                            </CallAtStop>
+                        </OnwardCall>
+"""
+
+
+class OJPStandIn(StandInServer):
+    """
+    Stands in for the OJP 2.0 API, answering the LocationInformationRequests,
+    TripRequests and StopEventRequests OJPApiClient sends. Every name resolves to a
+    stable made up stop ref, and every route gets a tram of each line every headway
+    seconds, with delays that differ per journey and drift a little from minute to minute
+    like realtime data does. On a stop's departure board, every tram calls at each other
+    stop the stand-in has seen a request for afterwards. Other requests are answered with 400.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), faults=None, lines=("9", "14"), headway=450, travel_time=600,
+                 clock=time.time, **kwargs):
+        """
+        :param lines: The lines running on every route.
+        :param headway: Seconds between two trams of a line.
+        :param travel_time: Seconds a tram takes from the origin to the destination.
+        :param clock: Function returning the current time in epoch seconds, the departure
+                      time of requests without one.
+        """
+        super().__init__(address, faults, **kwargs)
+        self.lines = list(lines)
+        self.headway = headway
+        self.travel_time = travel_time
+        self.clock = clock
+        self._stops = set()
+        self._stops_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return super().url + "/ojp20"
+
+    @staticmethod
+    def stop_ref(name):
+        """
+        The stop ref a name resolves to: always the same one for the same name.
+        """
+        return f"85{_hash(name.strip().casefold()) % 100000:05d}"
+
+    def seen(self, *stop_refs):
+        """
+        Remembers stops as calls on the departure boards of the other stops.
+        """
+        with self._stops_lock:
+            self._stops.update(stop_refs)
+
+    def departures(self, origin, destination, departure_time, results):
+        """
+        The next results trams of any line leaving origin for destination (None for a
+        departure board) at or after departure_time.
+        :return: Sorted list of (estimated, timetabled, line, journey ref)
+        """
+        now = self.clock()
+        found = []
+        for line in self.lines:
+            offset = _hash(origin, destination, line) % self.headway
+            # Trams timetabled a bit earlier may leave late enough to be in
+            first = (int(departure_time) - offset - 300) // self.headway
+            for number in range(first, first + results + 2):
+                timetabled = offset + number * self.headway
+                journey = f"ch:1:sjyid:100001:{line}-{number}"
+                delay = _hash(journey) % 120 + _hash(journey, int(now // 60)) % 20
+                if timetabled + delay >= departure_time:
+                    found.append((timetabled + delay, timetabled, line, journey))
+        found.sort()
+        return found[:results]
+
+    def respond(self, method, path, body):
+        if method != "POST":
+            return 405, "text/plain", b"Method Not Allowed"
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            return 400, "text/plain", f"Invalid request: {e}".encode("utf-8")
+        now = self.clock()
+
+        lir = next(root.iter(f"{{{OJP_NAMESPACE}}}OJPLocationInformationRequest"), None)
+        if lir is not None:
+            name = lir.findtext(f".//{{{OJP_NAMESPACE}}}Name") or ""
+            results = ""
+            if name.strip():
+                self.seen(self.stop_ref(name))
+                results = _PLACE_RESULT.format(ref=self.stop_ref(name), name=escape(name))
+            return self._document(now, "OJPLocationInformationDelivery", results)
+
+        trip = next(root.iter(f"{{{OJP_NAMESPACE}}}OJPTripRequest"), None)
+        if trip is not None:
+            stop_point_ref = f".//{{{SIRI_NAMESPACE}}}StopPointRef"
+            origin = trip.findtext(f"{{{OJP_NAMESPACE}}}Origin/{stop_point_ref}")
+            destination = trip.findtext(f"{{{OJP_NAMESPACE}}}Destination/{stop_point_ref}")
+            if not origin or not destination:
+                return 400, "text/plain", b"Invalid request: origin and destination required"
+            self.seen(origin, destination)
+            departure_time = trip.findtext(f".//{{{OJP_NAMESPACE}}}DepArrTime")
+            departure_time = parse_iso8601(departure_time) if departure_time else now
+            results = int(trip.findtext(f".//{{{OJP_NAMESPACE}}}NumberOfResults") or 5)
+            trips = "".join(
+                _TRIP_RESULT.format(
+                    origin=escape(origin), destination=escape(destination), line=line, journey_ref=journey,
+                    timetabled=_iso(timetabled), estimated=_iso(estimated),
+                    arrival=_iso(timetabled + self.travel_time), operating_day=_iso(timetabled)[:10],
+                )
+                for estimated, timetabled, line, journey in self.departures(origin, destination, departure_time, results)
+            )
+            return self._document(now, "OJPTripDelivery", trips)
+
+        stop_event = next(root.iter(f"{{{OJP_NAMESPACE}}}OJPStopEventRequest"), None)
+        if stop_event is not None:
+            origin = stop_event.findtext(f"{{{OJP_NAMESPACE}}}Location//{{{SIRI_NAMESPACE}}}StopPointRef")
+            if not origin:
+                return 400, "text/plain", b"Invalid request: location required"
+            self.seen(origin)
+            departure_time = stop_event.findtext(f".//{{{OJP_NAMESPACE}}}DepArrTime")
+            departure_time = parse_iso8601(departure_time) if departure_time else now
+            results = int(stop_event.findtext(f".//{{{OJP_NAMESPACE}}}NumberOfResults") or 10)
+            onward = stop_event.findtext(f".//{{{OJP_NAMESPACE}}}IncludeOnwardCalls") == "true"
+            with self._stops_lock:
+                stops = sorted(self._stops - {origin}) if onward else []
+            events = "".join(
+                _STOP_EVENT_RESULT.format(
+                    origin=escape(origin), line=line, journey_ref=journey,
+                    timetabled=_iso(timetabled), estimated=_iso(estimated), operating_day=_iso(timetabled)[:10],
+                    onward_calls="".join(
+                        _ONWARD_CALL.format(stop=escape(stop), arrival=_iso(timetabled + self.travel_time))
+                        for stop in stops
+                    ),
+                )
+                for estimated, timetabled, line, journey in self.departures(origin, None, departure_time, results)
+            )
+            return self._document(now, "OJPStopEventDelivery", events)
+
+        return 400, "text/plain", (b"Unsupported request, the stand-in answers LocationInformation, Trip and "
+                                   b"StopEvent requests")
+
+    @staticmethod
+    def _document(now, delivery, results):
+        document = _RESPONSE.format(now=_iso(now), delivery=delivery, results=results)
+        return 200, "application/xml; charset=utf-8", document.encode("utf-8")
+
+
+class AwtrixStandIn(StandInServer):
+    """
+    Stands in for any number of Awtrix clocks behind one address, accepting the custom
+    app updates AwtrixClient sends (POST /api/custom?name=tram) and keeping the last
+    payload of each app.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), faults=None, **kwargs):
+        super().__init__(address, faults, **kwargs)
+        # App name to its last payload, and the number of updates it got
+        self.apps = {}
+        self.updates = {}
+
+    def clock_url(self, app):
+        return f"{self.url}/api/custom?name={app}"
+
+    def respond(self, method, path, body):
+        parts = urlsplit(path)
+        if parts.path == "/api/stats" and method == "GET":
+            with self._stats_lock:
+                stats = {"apps": len(self.apps), "updates": sum(self.updates.values())}
+            return 200, "application/json", json.dumps(stats).encode("utf-8")
+        if parts.path != "/api/custom":
+            return 404, "text/plain", b"Not Found"
+        if method != "POST":
+            return 405, "text/plain", b"Method Not Allowed"
+        app = parse_qs(parts.query).get("name", [""])[-1]
+        if not app:
+            return 400, "text/plain", b"Missing app name"
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return 400, "text/plain", b"Invalid JSON"
+        with self._stats_lock:
+            self.apps[app] = payload
+            self.updates[app] = self.updates.get(app, 0) + 1
+        return 200, "text/plain", b"OK"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tramtrix-standins",
+        description="Run local stand-ins for the OJP API and Awtrix clocks, with injected latency and faults.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ojp-port", type=int, default=8081)
+    parser.add_argument("--awtrix-port", type=int, default=8082)
+    parser.add_argument("--lines", default="9,14", help="Lines running on every route")
+    parser.add_argument("--headway", type=int, default=450, help="Seconds between two trams of a line")
+    parser.add_argument("--seed", type=int, help="Seeds the latencies and faults")
+    for service, latency in (("ojp", "lognormal:0.3:0.5"), ("awtrix", "uniform:0.01:0.05")):
+        group = parser.add_argument_group(f"{service} faults")
+        group.add_argument(f"--{service}-latency", default=latency, help=f"Latency distribution (default {latency})")
+        group.add_argument(f"--{service}-error-rate", type=float, default=0.0, help="Fraction answered with 503")
+        group.add_argument(f"--{service}-drop-rate", type=float, default=0.0, help="Fraction of connections dropped")
+        group.add_argument(f"--{service}-rate-limit", type=float, default=0, help="Requests a second, then 429")
+    parser.add_argument("--compress", action="store_true", help="Gzip the answers to requests accepting it")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(argv)
+
+    def faults(service):
+        return Faults(
+            latency=getattr(args, f"{service}_latency"), error_rate=getattr(args, f"{service}_error_rate"),
+            drop_rate=getattr(args, f"{service}_drop_rate"), rate_limit=getattr(args, f"{service}_rate_limit"),
+            seed=args.seed,
+        )
+
+    lines = [line.strip() for line in args.lines.split(",") if line.strip()]
+    with OJPStandIn((args.host, args.ojp_port), faults("ojp"), lines=lines, headway=args.headway,
+                    verbose=args.verbose, compress=args.compress) as ojp, \
+            AwtrixStandIn((args.host, args.awtrix_port), faults("awtrix"), verbose=args.verbose,
+                          compress=args.compress) as awtrix:
+        print(f"OJP stand-in on {ojp.url} (OJP_URL)")
+        print(f"Awtrix stand-in on {awtrix.clock_url('tram')} (AWTRIX_URL, any app name)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import time
+import unicodedata
+
+log = logging.getLogger(__name__)
+
+
+def normalize_stop_name(stop_name):
+    """
+    Normalizes a stop name so that trivially different spellings share a cache entry.
+    e.g. ' zürich,  Heuried ' -> 'zürich, heuried'
+    """
+    name = unicodedata.normalize("NFC", stop_name)
+    return " ".join(name.split()).casefold()
+
+
+class StopRefCache:
+    """
+    File-backed cache of stop name -> StopPointRef lookups.
+
+    Entries are keyed by the OJP endpoint URL and the normalized stop name, so
+    switching between e.g. the test and production API never mixes refs.
+    Entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._entries = None
+
+    @staticmethod
+    def _key(url, stop_name):
+        return f"{url}|{normalize_stop_name(stop_name)}"
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    entries = json.load(f)
+                self._entries = entries if isinstance(entries, dict) else {}
+            except (OSError, ValueError):
+                # Missing or corrupt cache file, start again from empty
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def get(self, url, stop_name):
+        """
+        Returns the cached ref for the stop, or None if missing or expired.
+        """
+        entry = self._load().get(self._key(url, stop_name))
+        if not entry:
+            return None
+        if self.ttl is not None and time.time() - entry.get("resolved_at", 0) > self.ttl:
+            return None
+        return entry.get("ref")
+
+    def set(self, url, stop_name, ref):
+        self._load()[self._key(url, stop_name)] = {
+            "name": stop_name,
+            "ref": ref,
+            "resolved_at": time.time(),
+        }
+        try:
+            self._save()
+        except OSError as e:
+            log.warning("Could not write stop cache %s: %s", self.path, e)
+
+    def invalidate(self, url=None, stop_name=None):
+        """
+        Removes cached entries.
+        :param url: Only remove entries for this OJP endpoint (all endpoints if None).
+        :param stop_name: Only remove the entry for this stop (all stops if None).
+        :return: The number of entries removed.
+        """
+        entries = self._load()
+        if url is not None and stop_name is not None:
+            keys = [self._key(url, stop_name)] if self._key(url, stop_name) in entries else []
+        else:
+            normalized = normalize_stop_name(stop_name) if stop_name is not None else None
+            keys = [
+                key for key in entries
+                if (url is None or key.startswith(f"{url}|"))
+                and (normalized is None or key.endswith(f"|{normalized}"))
+            ]
+        for key in keys:
+            del entries[key]
+        if keys:
+            self._save()
+        return len(keys)
+
+    def clear(self):
+        return self.invalidate()
@@ -0,0 +1,379 @@
+import argparse
+import csv
+import difflib
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+import unicodedata
+from .config import STOP_INDEX_FILE
+
+log = logging.getLogger(__name__)
+
+# File layout, all integers little-endian:
+#   header   magic, number of stops, number of tokens
+#   stops    (key offset, key length, name offset, name length, ref offset, ref length)
+#            per stop, sorted by key
+#   tokens   (token offset, token length, stop number) per word of every key, sorted by
+#            token, the token text pointing into its key
+#   strings  the UTF-8 keys, names and refs the tables point to
+# Keys are folded stop names (see fold_stop_name). UTF-8 bytes sort in the same order as
+# the text, so both tables are binary searched straight from the mapped file.
+_MAGIC = b"TTXSTOP1"
+_HEADER = struct.Struct("<8sII")
+_STOP = struct.Struct("<IHIHIH")
+_TOKEN = struct.Struct("<IHI")
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+# Columns read from stop lists, the first one present is used. Covers the Swiss service
+# point list (opentransportdata.swiss), the older DiDok list and GTFS stops.txt
+NAME_COLUMNS = ("designationOfficial", "Dst-Bezeichnung-offiziell", "stop_name", "name")
+REF_COLUMNS = ("number", "BPUIC", "stop_id", "sloid", "ref")
+
+# Fuzzy matches must be at least this similar to the query
+_FUZZY_CUTOFF = 0.75
+
+
+def fold_stop_name(stop_name):
+    """
+    Folds a stop name for matching, ignoring case, accents and punctuation.
+    e.g. 'Zürich,  Heuried' -> 'zurich heuried'
+    """
+    name = unicodedata.normalize("NFKD", stop_name)
+    name = "".join(c for c in name if not unicodedata.combining(c)).casefold()
+    return " ".join(_NON_WORD.sub(" ", name).split())
+
+
+def read_stop_csv(path, name_column=None, ref_column=None):
+    """
+    Reads the stops of a stop list CSV, comma or semicolon separated.
+    Rows of the Swiss service point list that are not stops are skipped.
+    :param name_column: Column with the stop names, by default the first of NAME_COLUMNS.
+    :param ref_column: Column with the StopPointRefs, by default the first of REF_COLUMNS.
+    :return: Iterator of (name, ref).
+    :raises ValueError: If the columns are not found.
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        header = f.readline()
+        delimiter = ";" if header.count(";") > header.count(",") else ","
+        f.seek(0)
+        reader = csv.DictReader(f, delimiter=delimiter)
+        columns = reader.fieldnames or []
+
+        def column(wanted, candidates, what):
+            if wanted is not None:
+                if wanted not in columns:
+                    raise ValueError(f"{path} has no column '{wanted}'")
+                return wanted
+            for candidate in candidates:
+                if candidate in columns:
+                    return candidate
+            raise ValueError(f"{path} has no {what} column, expected one of {', '.join(candidates)}")
+
+        name_column = column(name_column, NAME_COLUMNS, "stop name")
+        ref_column = column(ref_column, REF_COLUMNS, "stop reference")
+        stops_only = "stopPoint" in columns
+
+        for row in reader:
+            if stops_only and row["stopPoint"].strip().lower() != "true":
+                continue
+            name = (row[name_column] or "").strip()
+            ref = (row[ref_column] or "").strip()
+            if name and ref:
+                yield name, ref
+
+
+def build_stop_index(stops, path):
+    """
+    Writes a stop index file, replacing any existing one.
+    :param stops: Iterable of (name, ref). Names that fold to the same key keep all their
+                  refs, repeated (name, ref) pairs are only kept once.
+    :return: The number of stops written.
+    """
+    entries = {}
+    for name, ref in stops:
+        key = fold_stop_name(name)
+        if key:
+            entries.setdefault((key.encode("utf-8"), ref.encode("utf-8")), name.encode("utf-8"))
+
+    strings = bytearray()
+    stop_fields = []
+    token_fields = []
+    for i, ((key, ref), name) in enumerate(sorted(entries.items())):
+        key_at = len(strings)
+        strings += key
+        stop_fields.append((key_at, len(key), key_at + len(key), len(name), key_at + len(key) + len(name), len(ref)))
+        strings += name
+        strings += ref
+
+        at = 0
+        seen = set()
+        for token in key.split(b" "):
+            if token not in seen:
+                seen.add(token)
+                token_fields.append((token, key_at + at, len(token), i))
+            at += len(token) + 1
+    token_fields.sort(key=lambda token: (token[0], token[3]))
+
+    # The tables hold absolute offsets into the file
+    strings_at = _HEADER.size + len(stop_fields) * _STOP.size + len(token_fields) * _TOKEN.size
+    out = bytearray(_HEADER.pack(_MAGIC, len(stop_fields), len(token_fields)))
+    for key_at, key_len, name_at, name_len, ref_at, ref_len in stop_fields:
+        out += _STOP.pack(strings_at + key_at, key_len, strings_at + name_at, name_len, strings_at + ref_at, ref_len)
+    for _, token_at, token_len, stop in token_fields:
+        out += _TOKEN.pack(strings_at + token_at, token_len, stop)
+    out += strings
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+    os.replace(tmp_path, path)
+    return len(stop_fields)
+
+
+class StopIndex:
+    """
+    Read-only index of stop names to StopPointRefs, memory-mapped from a file written by
+    build_stop_index. Opening it reads nothing but the header, and every lookup is a
+    binary search over the mapped tables, so resolving a name takes microseconds.
+    """
+
+    def __init__(self, path):
+        """
+        :raises OSError: If the file can't be opened.
+        :raises ValueError: If the file is not a stop index.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"{path} is not a stop index (empty file)")
+        if len(self._map) < _HEADER.size or self._map[:len(_MAGIC)] != _MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a stop index")
+        _, self._count, self._token_count = _HEADER.unpack_from(self._map, 0)
+        self._stops_at = _HEADER.size
+        self._tokens_at = self._stops_at + self._count * _STOP.size
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        key_at, key_len = struct.unpack_from("<IH", self._map, self._stops_at + i * _STOP.size)
+        return self._map[key_at:key_at + key_len]
+
+    def _stop(self, i):
+        _, _, name_at, name_len, ref_at, ref_len = _STOP.unpack_from(self._map, self._stops_at + i * _STOP.size)
+        return (
+            self._map[name_at:name_at + name_len].decode("utf-8"),
+            self._map[ref_at:ref_at + ref_len].decode("utf-8"),
+        )
+
+    def _token(self, j):
+        token_at, token_len, stop = _TOKEN.unpack_from(self._map, self._tokens_at + j * _TOKEN.size)
+        return self._map[token_at:token_at + token_len], stop
+
+    @staticmethod
+    def _lower_bound(count, get, value):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if get(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _stops_with_prefix(self, prefix):
+        i = self._lower_bound(self._count, self._key, prefix)
+        while i < self._count and self._key(i).startswith(prefix):
+            yield i
+            i += 1
+
+    def _tokens_with_prefix(self, prefix):
+        j = self._lower_bound(self._token_count, lambda j: self._token(j)[0], prefix)
+        while j < self._token_count:
+            token, stop = self._token(j)
+            if not token.startswith(prefix):
+                break
+            yield token, stop
+            j += 1
+
+    def lookup(self, stop_name):
+        """
+        The ref of the stop exactly matching the name, ignoring case, accents and
+        punctuation, or None. The first ref in the index if several stops match.
+        """
+        key = fold_stop_name(stop_name).encode("utf-8")
+        i = self._lower_bound(self._count, self._key, key)
+        if key and i < self._count and self._key(i) == key:
+            return self._stop(i)[1]
+        return None
+
+    def prefix(self, query, limit=10):
+        """
+        The stops whose name starts with the query, in name order.
+        :return: List of (name, ref).
+        """
+        key = fold_stop_name(query).encode("utf-8")
+        if not key:
+            return []
+        stops = []
+        for i in self._stops_with_prefix(key):
+            if len(stops) >= limit:
+                break
+            stops.append(self._stop(i))
+        return stops
+
+    def search(self, query, limit=10):
+        """
+        The stops best matching the query, best first:
+        - the exact name, then names starting with the query
+        - names with a word starting with each word of the query, in any order,
+          e.g. 'heur zur' finds 'Zürich, Heuried'
+        - names with a word similar to the longest word of the query (typos), as long
+          as it starts with the same two letters
+        Case, accents and punctuation are ignored throughout.
+        :return: List of (name, ref).
+        """
+        key = fold_stop_name(query)
+        if not key:
+            return []
+        words = key.encode("utf-8").split(b" ")
+        longest = max(words, key=len)
+
+        found = list(self._stops_with_prefix(key.encode("utf-8")))
+        if len(found) < limit:
+            matches = sorted(
+                {stop for _, stop in self._tokens_with_prefix(longest)} - set(found),
+                key=lambda i: (len(self._key(i)), i)
+            )
+            for i in matches:
+                stop_words = self._key(i).split(b" ")
+                if all(any(stop_word.startswith(word) for stop_word in stop_words) for word in words):
+                    found.append(i)
+
+        if len(found) < limit:
+            matcher = difflib.SequenceMatcher(None)
+            matcher.set_seq2(longest)
+            similar = {}
+            for token, stop in self._tokens_with_prefix(longest[:2]):
+                if stop in similar:
+                    continue
+                matcher.set_seq1(token)
+                if matcher.real_quick_ratio() >= _FUZZY_CUTOFF and matcher.ratio() >= _FUZZY_CUTOFF:
+                    similar[stop] = difflib.SequenceMatcher(None, self._key(stop), key.encode("utf-8")).ratio()
+            for stop in set(found):
+                similar.pop(stop, None)
+            found.extend(sorted(similar, key=lambda i: (-similar[i], i)))
+
+        return [self._stop(i) for i in found[:limit]]
+
+
+def load_stop_index(path=STOP_INDEX_FILE):
+    """
+    Opens the stop index if there is one.
+    :return: The StopIndex, or None if the path is empty, the file doesn't exist or it
+             can't be read.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return StopIndex(path)
+    except (OSError, ValueError) as e:
+        log.warning("Could not open stop index %s: %s", path, e)
+        return None
+
+
+def _resolve(index, names, limit):
+    missing = 0
+    start = time.perf_counter()
+    lines = []
+    for name in names:
+        ref = index.lookup(name)
+        if ref is not None:
+            lines.append(f"{name}\t{ref}")
+            continue
+        missing += 1
+        suggestions = index.search(name, limit=limit)
+        hint = f" (did you mean {', '.join(repr(n) for n, _ in suggestions)}?)" if suggestions else ""
+        lines.append(f"{name}\t\tnot found{hint}")
+    elapsed = time.perf_counter() - start
+    print("\n".join(lines))
+    print(f"Resolved {len(names) - missing} of {len(names)} names in {elapsed * 1000:.1f}ms", file=sys.stderr)
+    return missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tramtrix-stops", description="Build and query the offline stop index.")
+    parser.add_argument("--index", default=STOP_INDEX_FILE, help="The stop index file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Build the index from a stop list CSV")
+    build.add_argument("csv", help="Stop list, e.g. the Swiss service point list from opentransportdata.swiss")
+    build.add_argument("--name-column", help="Column with the stop names")
+    build.add_argument("--ref-column", help="Column with the StopPointRefs")
+
+    resolve = commands.add_parser("resolve", help="Resolve stop names to StopPointRefs, one per line")
+    resolve.add_argument("names", nargs="*", help="Stop names, read from stdin if none are given")
+    resolve.add_argument("--routes", action="store_true", help="Resolve the stop names of the configured routes")
+    resolve.add_argument("--suggestions", type=int, default=3, help="Suggestions shown for names not found")
+
+    search = commands.add_parser("search", help="Find stops by (part of) their name")
+    search.add_argument("query", nargs="+")
+    search.add_argument("--limit", type=int, default=10)
+
+    args = parser.parse_args(argv)
+    if not args.index:
+        parser.error("No index file, set STOP_INDEX_FILE or pass --index")
+
+    if args.command == "build":
+        start = time.perf_counter()
+        try:
+            count = build_stop_index(read_stop_csv(args.csv, args.name_column, args.ref_column), args.index)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+        print(f"Indexed {count} stops into {args.index} in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    try:
+        index = StopIndex(args.index)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not open stop index: {e}")
+        return 1
+
+    with index:
+        if args.command == "search":
+            for name, ref in index.search(" ".join(args.query), limit=args.limit):
+                print(f"{name}\t{ref}")
+            return 0
+
+        names = list(args.names)
+        if args.routes:
+            from .routes import configured_routes
+            names.extend(configured_routes().stop_names())
+        if not names:
+            names = [line.strip() for line in sys.stdin if line.strip()]
+        return 1 if _resolve(index, names, args.suggestions) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,36 @@
-from datetime import datetime, timezone
+import logging
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 from .config import TIME_GREEN_MAX, TIME_AMBER_MAX, TIME_AMBER_MIN
 
-def calculate_traffic_light_colour(datetime_set):
+log = logging.getLogger(__name__)
+
+
+def calculate_traffic_light_colour(datetime_set, now=None):
     """
-    Checks a set of datetimes against the current time and returns a status.
+    Checks a set of departure times against the current time and returns a status.
     
-    :param datetime_set: A set of datetime objects
+    :param datetime_set: A set of datetime objects or epoch seconds, or a line's sorted
+                         array of epoch seconds from Departures (checked with bisect)
+    :param now: The time to check against (datetime or epoch seconds), defaults to the current time
     :return: "GREEN" if any datetime is within the Green window,
              "AMBER" if none are Green but any are within the Amber window,
              otherwise "RED".
     """
-    now = datetime.now(timezone.utc)
+    now = time.time() if now is None else to_epoch(now)
     found_green = False
     found_amber = False
     
     if not datetime_set:
         return "RED"
 
+    if isinstance(datetime_set, array):
+        return _colour_from_sorted(datetime_set, now)
+
     for dt in datetime_set:
         # Calculate the time difference in seconds
-        time_diff = (dt - now).total_seconds()
+        time_diff = to_epoch(dt) - now
         
         abs_diff = abs(time_diff)
         
@@ -48,3 +59,157 @@ def to_hex_color(color):
         return "fcca03"
     else:
         return "ffffff"
+
+
+def to_epoch(t):
+    """
+    Epoch seconds for a datetime, numbers are returned unchanged.
+    """
+    return t.timestamp() if hasattr(t, "timestamp") else t
+
+
+def colour_boundaries(departures):
+    """
+    The instants (epoch seconds) at which a line's colour can change.
+    calculate_traffic_light_colour compares the absolute distance to each departure
+    against the window edges, so every departure has an edge on either side of it.
+    :param departures: Iterable of departure datetimes (or epoch seconds).
+    """
+    offsets = (TIME_GREEN_MAX * 60, TIME_AMBER_MAX * 60, TIME_AMBER_MIN * 60)
+    boundaries = []
+    for departure in departures:
+        t = to_epoch(departure)
+        for offset in offsets:
+            boundaries.append(t - offset)
+            boundaries.append(t + offset)
+    boundaries.sort()
+    return boundaries
+
+
+def _colour_from_sorted(departures, t):
+    """
+    The colour at t for sorted epoch departures, using bisect instead of a full scan.
+    Same windows as calculate_traffic_light_colour.
+    """
+    green_max, amber_max, amber_min = TIME_GREEN_MAX * 60, TIME_AMBER_MAX * 60, TIME_AMBER_MIN * 60
+    # Green: amber_max < |d - t| <= green_max
+    if (bisect_left(departures, t - amber_max) > bisect_left(departures, t - green_max) or
+            bisect_right(departures, t + green_max) > bisect_right(departures, t + amber_max)):
+        return "GREEN"
+    # Amber: amber_min <= |d - t| <= amber_max
+    if (bisect_right(departures, t - amber_min) > bisect_left(departures, t - amber_max) or
+            bisect_right(departures, t + amber_max) > bisect_left(departures, t + amber_min)):
+        return "AMBER"
+    return "RED"
+
+
+class ColourTimeline:
+    """
+    The colour of a line over time, as a list of (start, end, colour) intervals in
+    epoch seconds. Intervals are half-open [start, end); at the exact instant a window
+    edge is crossed the timeline already reports the following colour.
+    Outside the intervals the colour is calculated directly from the departures.
+    """
+
+    def __init__(self, departures, intervals):
+        """
+        :param departures: Sorted departure epoch seconds.
+        :param intervals: Sorted, contiguous (start, end, colour) tuples.
+        """
+        self.departures = departures
+        self.intervals = intervals
+        self._starts = [interval[0] for interval in intervals]
+
+    def colour_at(self, t):
+        """
+        The colour ("GREEN", "AMBER" or "RED") at t (datetime or epoch seconds).
+        """
+        t = to_epoch(t)
+        index = bisect_right(self._starts, t) - 1
+        if index >= 0 and t < self.intervals[index][1]:
+            return self.intervals[index][2]
+        return _colour_from_sorted(self.departures, t)
+
+    def next_change(self, t):
+        """
+        The start (epoch seconds) of the first interval after t with a different colour,
+        or None if the colour doesn't change again within the timeline.
+        """
+        t = to_epoch(t)
+        index = bisect_right(self._starts, t)
+        if index < len(self.intervals):
+            return self._starts[index]
+        return None
+
+
+def colour_timeline(departures, start, horizon=None):
+    """
+    Precomputes the colour timeline of a line.
+    :param departures: The line's departure datetimes (or epoch seconds), or its sorted array from Departures.
+    :param start: Start of the timeline (datetime or epoch seconds).
+    :param horizon: Length of the timeline in seconds, by default until the last colour change.
+    :return: A ColourTimeline.
+    """
+    if not isinstance(departures, array):
+        departures = sorted(to_epoch(t) for t in departures)
+    start = to_epoch(start)
+    boundaries = colour_boundaries(departures)
+    end = start + horizon if horizon is not None else max(start, boundaries[-1] if boundaries else start) + 1
+
+    points = [start]
+    for boundary in boundaries:
+        if start < boundary < end and boundary != points[-1]:
+            points.append(boundary)
+    points.append(end)
+
+    intervals = []
+    for segment_start, segment_end in zip(points, points[1:]):
+        # The colour is constant between boundaries, sample the middle of the segment
+        colour = _colour_from_sorted(departures, (segment_start + segment_end) / 2)
+        if intervals and intervals[-1][2] == colour:
+            intervals[-1] = (intervals[-1][0], segment_end, colour)
+        else:
+            intervals.append((segment_start, segment_end, colour))
+    return ColourTimeline(departures, intervals)
+
+
+def colour_timelines(results, start, lines=None, horizon=None):
+    """
+    Precomputes the colour timelines of many lines in one call.
+    :param results: Dictionary of line (str) to departure datetimes (or epoch seconds).
+    :param start: Start of the timelines (datetime or epoch seconds).
+    :param lines: The lines to compute, defaults to all lines in results. Missing lines are RED throughout.
+    :return: Dictionary of line (str) to ColourTimeline.
+    """
+    lines = results.keys() if lines is None else lines
+    return {line: colour_timeline(results.get(line, ()), start, horizon) for line in lines}
+
+
+def compute_line_colors(results, lines, now=None, verbose=True, timelines=None):
+    """
+    Calculates the clock colour for each line and logs the upcoming departures.
+    :param results: Departures (or a dictionary of line to departure times), as returned by get_trip_results.
+    :param lines: The lines to show, in display order.
+    :param now: The time to calculate the colours for (epoch seconds or datetime), defaults to the current time.
+    :param verbose: Set to False to skip logging the departures.
+    :param timelines: Optional precomputed ColourTimelines by line, looked up instead of
+                      rescanning the departures.
+    :return: Dictionary of line (str) to hex colour (str).
+    """
+    line_colors = {}
+    now = time.time() if now is None else to_epoch(now)
+    for line in lines:
+        times = results.get(line, ())
+        if timelines is not None and line in timelines:
+            status = timelines[line].colour_at(now)
+        else:
+            status = calculate_traffic_light_colour(times, now=now)
+        color = to_hex_color(status)
+        line_colors[line] = color
+
+        if verbose:
+            # Calculate minutes until next trams for debug
+            deltas_str = ", ".join(f"{(t - now) / 60:.1f}m" for t in sorted(to_epoch(t) for t in times))
+
+            log.info("Line %s: %s (%s) | Next: [%s]", line, status, color, deltas_str)
+    return line_colors
@@ -0,0 +1,120 @@
+"""
+Fakes shared by the tests: simulated time, an OJP client and a clock answering from
+memory.
+"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from tramtrix.ojp import StopNotFoundError
+
+NOW = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+T0 = int(NOW.timestamp())
+
+
+def at(minutes):
+    return NOW + timedelta(minutes=minutes)
+
+
+class StopLoop(Exception):
+    """
+    Raised by FakeTime.sleep to end a loop that would run forever.
+    """
+
+
+class FakeTime:
+    """
+    A clock that only moves when told to or slept on. Call it (or its time method) for
+    the current time.
+    """
+
+    def __init__(self, now=1000.0, max_sleeps=None):
+        """
+        :param max_sleeps: Raise StopLoop on this many sleeps, None to never.
+        """
+        self.now = now
+        self.sleeps = []
+        self.max_sleeps = max_sleeps
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if self.max_sleeps is not None and len(self.sleeps) >= self.max_sleeps:
+            raise StopLoop()
+        self.now += seconds
+
+
+class FakeOJPClient:
+    """
+    Answers every route with the same departures, or raises error, counting the calls.
+    Thread-safe.
+    """
+
+    def __init__(self, results=None, error=None, delay=0.0, stop_refs=None):
+        """
+        :param delay: Seconds each call takes.
+        :param stop_refs: Dictionary of the stop names it resolves to their refs.
+        """
+        self.results = results
+        self.error = error
+        self.delay = delay
+        self.stop_refs = stop_refs if stop_refs is not None else {}
+        self.calls = 0
+        self.resolved = []
+        self.lock = threading.Lock()
+
+    def get_departures(self, stop_ref_origin, stop_ref_destination, mode="trip", allow_stale=True):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def resolve_stop_ref(self, stop_name, use_cache=True):
+        with self.lock:
+            self.resolved.append(stop_name)
+        time.sleep(self.delay)
+        if stop_name not in self.stop_refs:
+            raise StopNotFoundError(f"Could not resolve stop reference for '{stop_name}'")
+        return self.stop_refs[stop_name]
+
+
+class FakeClock:
+    """
+    Stands in for an AwtrixClient, keeping the colours pushed to it and answering ok.
+    """
+
+    def __init__(self, time=None, ok=True):
+        """
+        :param time: Function returning the current time, to keep when each push was made.
+        """
+        self.time = time
+        self.ok = ok
+        self.updates = []
+        self.times = []
+
+    def update_clock(self, line_colors):
+        self.updates.append(dict(line_colors))
+        self.times.append(self.time() if self.time is not None else None)
+        return self.ok
+
+    def flush(self):
+        return self.ok
+
+    def next_deadline(self):
+        return None
+
+    def changes(self):
+        """
+        (time, colours) of each push showing other colours than the one before.
+        """
+        changes = []
+        for pushed_at, line_colors in zip(self.times, self.updates):
+            if not changes or changes[-1][1] != line_colors:
+                changes.append((pushed_at, line_colors))
+        return changes
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from unittest.mock import MagicMock
+from tramtrix.aio import AsyncAwtrixClient, AsyncOJPApiClient, ClockPusher, clock_pushers, run, _install_signal_handlers
+from tramtrix.routes import Clock, Query
+from tramtrix.scheduler import FetchPolicy
+
+class SlowOJPClient:
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_departures(self, stop_ref_origin, stop_ref_destination, mode="trip"):
+        with self.lock:
+            self.calls.append((stop_ref_origin, stop_ref_destination))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return {}
+
+    def close(self):
+        pass
+
+class SlowClock:
+    def __init__(self, delay):
+        self.delay = delay
+        self.updates = []
+
+    def update_clock(self, line_colors):
+        time.sleep(self.delay)
+        self.updates.append(line_colors)
+
+    def next_deadline(self):
+        return None
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self):
+        self.batches = 0
+        self.batching = False
+
+    @contextmanager
+    def batch(self):
+        self.batches += 1
+        self.batching = True
+        try:
+            yield
+        finally:
+            self.batching = False
+
+class BatchedClock:
+    def __init__(self, mqtt):
+        self.mqtt = mqtt
+        self.updates = []
+
+    def update_clock(self, line_colors):
+        self.updates.append((line_colors, self.mqtt is not None and self.mqtt.batching))
+        return True
+
+    def flush(self):
+        return True
+
+    def next_deadline(self):
+        return None
+
+    def close(self):
+        pass
+
+class TestAsyncRuntime(unittest.IsolatedAsyncioTestCase):
+    async def test_routes_are_fetched_concurrently(self):
+        ojp = SlowOJPClient(delay=0.2)
+        client = AsyncOJPApiClient(client=ojp, max_workers=4)
+        clock = AsyncAwtrixClient(client=SlowClock(delay=0))
+        stop = asyncio.Event()
+        queries = [Query(f"A{i}", f"B{i}", [Clock("kitchen", "http://kitchen", "r", ["9"])]) for i in range(3)]
+
+        started = time.monotonic()
+        task = asyncio.ensure_future(run(client, {"kitchen": clock}, queries, stop, FetchPolicy(10, 10, 10)))
+        await asyncio.sleep(0.3)
+        stop.set()
+        await asyncio.wait_for(task, timeout=1)
+
+        # All three queries were in flight at the same time, and stopping didn't wait for the interval
+        self.assertEqual(len(ojp.calls), 3)
+        self.assertEqual(ojp.max_in_flight, 3)
+        self.assertLess(time.monotonic() - started, 1)
+        client.close()
+        clock.close()
+
+    async def test_slow_clock_does_not_delay_fetching(self):
+        ojp = SlowOJPClient(delay=0)
+        slow_clock = SlowClock(delay=0.5)
+        client = AsyncOJPApiClient(client=ojp)
+        clock = AsyncAwtrixClient(client=slow_clock)
+        stop = asyncio.Event()
+
+        query = Query("A", "B", [Clock("kitchen", "http://kitchen", "r", ["9"])])
+        task = asyncio.ensure_future(run(client, {"kitchen": clock}, [query], stop, FetchPolicy(0.05, 0.05, 0.05)))
+        await asyncio.sleep(0.3)
+        stop.set()
+        await asyncio.wait_for(task, timeout=1)
+
+        # Several fetches happened while the first push was still in progress
+        self.assertGreaterEqual(len(ojp.calls), 4)
+        client.close()
+        clock.close()
+
+    async def test_pusher_only_sends_latest_colours(self):
+        clock = MagicMock()
+        clock.next_deadline.return_value = None
+        clock.mqtt = None
+        pushed = []
+        release = threading.Event()
+
+        def update_clock(line_colors):
+            pushed.append(line_colors)
+            release.wait(1)
+
+        clock.update_clock = update_clock
+        pusher = ClockPusher({"kitchen": AsyncAwtrixClient(client=clock)})
+        pusher.start()
+
+        pusher.submit("kitchen", {"9": "a83632"})
+        await asyncio.sleep(0.01)
+        # Submitted while the first push is still running, only the last one is sent
+        pusher.submit("kitchen", {"9": "fcca03"})
+        pusher.submit("kitchen", {"9": "03fc14"})
+        release.set()
+        await asyncio.sleep(0.05)
+        await pusher.stop()
+
+        self.assertEqual(pushed, [{"9": "a83632"}, {"9": "03fc14"}])
+
+    async def test_clocks_on_one_broker_are_pushed_together(self):
+        broker = FakeConnection()
+        kitchen, office = BatchedClock(broker), BatchedClock(broker)
+        hallway, other = BatchedClock(None), BatchedClock(FakeConnection())
+        clocks = {name: AsyncAwtrixClient(client=clock)
+                  for name, clock in (("kitchen", kitchen), ("office", office), ("hallway", hallway), ("other", other))}
+        pushers = clock_pushers(clocks)
+        self.assertIs(pushers["kitchen"], pushers["office"])
+        self.assertEqual(len(set(pushers.values())), 3)
+
+        # What one render pass changed
+        pushers["kitchen"].start()
+        pushers["kitchen"].submit("kitchen", {"9": "03fc14"})
+        pushers["kitchen"].submit("office", {"14": "fcca03"})
+        await asyncio.sleep(0.05)
+        await pushers["kitchen"].stop()
+
+        self.assertEqual(broker.batches, 1)
+        self.assertEqual((kitchen.updates, office.updates), ([({"9": "03fc14"}, True)], [({"14": "fcca03"}, True)]))
+
+    @unittest.skipIf(sys.platform == "win32", "signal handlers need a Unix event loop")
+    async def test_sigterm_stops_runtime(self):
+        stop = asyncio.Event()
+        _install_signal_handlers(stop)
+        try:
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(stop.wait(), timeout=1)
+        finally:
+            loop = asyncio.get_running_loop()
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGINT)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import MagicMock
+import requests
+from tramtrix.awtrix import AwtrixClient
+from helpers import FakeTime
+
+class TestAwtrixClient(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        self.session = MagicMock()
+        self.session.post.return_value.status_code = 200
+        self.clock = AwtrixClient(
+            url="http://clock/api/custom?name=test", session=self.session,
+            heartbeat=300, min_interval=1, retry_interval=20, clock=self.time,
+        )
+
+    def pushed_colors(self):
+        return [[e["c"] for e in call.kwargs["json"]["text"]] for call in self.session.post.call_args_list]
+
+    def test_build_payload(self):
+        self.assertEqual(self.clock.build_payload({"9": "a83632", "14": "03fc14"}), {
+            "text": [{"t": "9 ", "c": "a83632"}, {"t": "14 ", "c": "03fc14"}],
+            "repeat": 1,
+        })
+        self.clock.lifetime = 900
+        self.assertEqual(self.clock.build_payload({"9": "a83632"})["lifetime"], 900)
+
+    def test_unchanged_colours_are_not_pushed(self):
+        self.assertTrue(self.clock.update_clock({"9": "a83632"}))
+        self.time.now += 10
+        self.assertTrue(self.clock.update_clock({"9": "a83632"}))
+        self.assertEqual(self.session.post.call_count, 1)
+
+        self.clock.update_clock({"9": "03fc14"})
+        self.assertEqual(self.pushed_colors(), [["a83632"], ["03fc14"]])
+
+    def test_rapid_changes_are_coalesced(self):
+        self.clock.update_clock({"9": "a83632"})
+        self.time.now += 0.2
+        self.clock.update_clock({"9": "03fc14"})
+        self.clock.update_clock({"9": "fcca03"})
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.clock.next_deadline(), 1001)
+
+        self.time.now = 1001
+        self.clock.flush()
+        self.assertEqual(self.pushed_colors(), [["a83632"], ["fcca03"]])
+
+    def test_heartbeat(self):
+        self.clock.update_clock({"9": "a83632"})
+        self.assertEqual(self.clock.next_deadline(), 1300)
+        self.time.now = 1299
+        self.clock.flush()
+        self.assertEqual(self.session.post.call_count, 1)
+        self.time.now = 1300
+        self.clock.update_clock({"9": "a83632"})
+        self.assertEqual(self.session.post.call_count, 2)
+
+        self.clock.heartbeat = 0
+        self.assertIsNone(self.clock.next_deadline())
+
+    def test_failed_push_is_retried(self):
+        self.session.post.side_effect = requests.exceptions.ConnectionError("down")
+        self.assertFalse(self.clock.update_clock({"9": "a83632"}))
+        self.assertEqual(self.clock.next_deadline(), 1020)
+
+        # Not retried before the retry interval, even for unchanged colours
+        self.time.now += 5
+        self.assertFalse(self.clock.update_clock({"9": "a83632"}))
+        self.assertEqual(self.session.post.call_count, 1)
+
+        self.session.post.side_effect = None
+        self.time.now = 1020
+        self.assertTrue(self.clock.flush())
+        self.assertEqual(self.session.post.call_count, 2)
+        self.assertEqual(self.clock.next_deadline(), 1320)
+
+    def test_rejected_push_is_retried(self):
+        self.session.post.return_value.status_code = 500
+        self.assertFalse(self.clock.update_clock({"9": "a83632"}))
+        self.session.post.return_value.status_code = 200
+        self.time.now = 1020
+        self.assertTrue(self.clock.update_clock({"9": "a83632"}))
+        self.assertEqual(self.session.post.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import threading
+import unittest
+from tramtrix.departure_cache import DepartureCache, FetchWorker, FRESH, STALE, EXPIRED, MISSING
+from tramtrix.main import run
+from tramtrix.routes import Clock, Query
+from tramtrix.scheduler import FetchPolicy
+from helpers import T0, FakeClock, FakeOJPClient, StopLoop, at
+
+class BlockingOJPClient:
+    """
+    Never answers until released, like an API that hangs.
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.called = threading.Event()
+
+    def get_departures(self, stop_ref_origin, stop_ref_destination, mode="trip"):
+        self.called.set()
+        self.release.wait(5)
+        return {}
+
+def query():
+    return Query("A", "B", [Clock("kitchen", "http://kitchen", "r", ["9"])])
+
+class TestDepartureCache(unittest.TestCase):
+    def test_freshness(self):
+        cache = DepartureCache(fresh_for=60, stale_for=600, clock=lambda: T0)
+        self.assertEqual(cache.get("q"), (None, MISSING))
+        cache.put("q", {"9": [T0 + 300]}, now=T0)
+
+        entry, state = cache.get("q", T0 + 60)
+        self.assertEqual(state, FRESH)
+        self.assertEqual(entry.results, {"9": [T0 + 300]})
+        self.assertEqual(entry.fetched_at, T0)
+        # Stale departures are still served
+        entry, state = cache.get("q", T0 + 61)
+        self.assertEqual(state, STALE)
+        self.assertIsNotNone(entry)
+        # Expired ones are not
+        self.assertEqual(cache.get("q", T0 + 601), (None, EXPIRED))
+        self.assertEqual(cache.revalidate_at("q"), T0 + 60)
+        self.assertIsNone(cache.revalidate_at("other"))
+
+    def test_max_entries(self):
+        cache = DepartureCache(fresh_for=60, clock=lambda: T0, max_entries=2)
+        for key in ("a", "b", "a", "c"):
+            cache.put(key, {}, now=T0)
+        # "b" was fetched longest ago
+        self.assertEqual([cache.state(key) for key in ("a", "b", "c")], [FRESH, MISSING, FRESH])
+
+class TestFetchWorker(unittest.TestCase):
+    def test_fetch_into_cache(self):
+        cache = DepartureCache(fresh_for=120, stale_for=600)
+        client = FakeOJPClient({"9": {at(45)}})
+        worker = FetchWorker(client, query(), cache, FetchPolicy(interval=60, min_interval=20, max_interval=600))
+
+        # Nothing is due for half an hour, but the departures are revalidated before going stale
+        self.assertEqual(worker.fetch_if_due(T0), T0 + 120)
+        entry, state = cache.get(worker.query, T0)
+        self.assertEqual(state, FRESH)
+        self.assertEqual(entry.results, {"9": {at(45)}})
+        self.assertIn("9", entry.timelines)
+
+        self.assertEqual(worker.fetch_if_due(T0 + 60), T0 + 120)
+        self.assertEqual(client.calls, 1)
+
+    def test_failures_keep_cached_departures(self):
+        cache = DepartureCache(fresh_for=120, stale_for=600)
+        client = FakeOJPClient({"9": {at(45)}})
+        worker = FetchWorker(client, query(), cache, FetchPolicy(interval=60, min_interval=20, max_interval=600))
+        worker.fetch_if_due(T0)
+
+        client.error = Exception("API call failed with status code 503")
+        next_fetch_at = worker.fetch_if_due(T0 + 120)
+        self.assertGreater(next_fetch_at, T0 + 120)
+        entry, state = cache.get(worker.query, T0 + 130)
+        self.assertEqual(state, STALE)
+        self.assertEqual(entry.results, {"9": {at(45)}})
+
+    def test_hanging_api_does_not_hold_up_the_clock(self):
+        client = BlockingOJPClient()
+        clock = FakeClock()
+        renders = []
+
+        def sleep(seconds):
+            renders.append(seconds)
+            if len(renders) >= 3:
+                raise StopLoop()
+
+        with self.assertRaises(StopLoop):
+            run(client, {"kitchen": clock}, [query()], render_interval=0, sleep=sleep)
+        client.release.set()
+
+        # The clock was updated on every render while the fetch was still hanging
+        self.assertTrue(client.called.wait(1))
+        self.assertEqual(len(clock.updates), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+from array import array
+from datetime import datetime, timezone
+from tramtrix import departures
+from tramtrix.departures import Departure, Departures, KnownDepartures, journey_key, parse_iso8601
+
+class TestParseISO8601(unittest.TestCase):
+    def test_matches_fromisoformat(self):
+        samples = [
+            "2026-01-06T12:00:00Z",
+            "2026-01-06T12:00:00+01:00",
+            "2026-01-06T12:00:00-05:30",
+            "2024-02-29T23:59:59Z",
+            "2000-03-01T00:00:00Z",
+            "1969-12-31T23:59:59Z",
+            "2100-12-31T12:34:56+14:00",
+        ]
+        for text in samples:
+            expected = int(datetime.fromisoformat(text.replace("Z", "+00:00")).timestamp())
+            self.assertEqual(parse_iso8601(text), expected, text)
+
+    def test_fractions_are_dropped(self):
+        for text in ["2026-01-06T12:00:00.5Z", "2026-01-06T12:00:00.123456Z", "2026-01-06T13:00:00.999999999+01:00",
+                     "2026-01-06T12:00:00.25"]:
+            self.assertEqual(parse_iso8601(text), 1767700800, text)
+
+    def test_without_offset_is_utc(self):
+        self.assertEqual(parse_iso8601("2026-01-06T12:00:00"), datetime(2026, 1, 6, 12, tzinfo=timezone.utc).timestamp())
+
+    def test_other_layouts(self):
+        self.assertEqual(parse_iso8601("2026-01-06 12:00:00+00:00"), parse_iso8601("2026-01-06T12:00:00Z"))
+
+    def test_fixed_layout_matches_fromisoformat(self):
+        # Sliced apart instead of parsed by fromisoformat
+        for text in ["2026-01-06T12:00:00Z", "2026-01-06T12:00:00-05:30", "2024-02-29T23:59:59.999+14:00",
+                     "1969-12-31T23:59:59Z", "2026-01-06T12:00:00"]:
+            self.assertIsNotNone(departures._parse_fixed(text), text)
+        # Left to fromisoformat
+        for text in ["2026-01-06 12:00:00+00:00", "2026-01-06T12:00+01:00", "2026-01-06T12:00:00+01:00:30"]:
+            self.assertIsNone(departures._parse_fixed(text), text)
+            self.assertEqual(parse_iso8601(text), int(datetime.fromisoformat(text).timestamp()), text)
+
+    def test_cached(self):
+        parse_iso8601.cache_clear()
+        self.assertEqual(parse_iso8601("2026-01-06T12:00:00Z"), parse_iso8601("2026-01-06T12:00:00Z"))
+        self.assertEqual(parse_iso8601.cache_info().hits, 1)
+        self.assertEqual(parse_iso8601.cache_info().maxsize, 8192)
+
+    def test_invalid(self):
+        for text in ["", "not a time", "2026-13-06T12:00:00Z", "2026-02-29T12:00:00Z", "2026-01-06T24:00:00Z",
+                     "2026-01-06T12:00:00+1Z", "2026-01-06T1 :00:00Z"]:
+            with self.assertRaises(ValueError):
+                parse_iso8601(text)
+
+class TestDepartures(unittest.TestCase):
+    def test_sorted_arrays_by_line(self):
+        departures = Departures([
+            Departure("9", 300, planned_time=240, journey_ref="J2"),
+            Departure("9", 100, journey_ref="J1"),
+            Departure("14", 200),
+            Departure("9", 300, journey_ref="J3"),
+        ])
+        self.assertEqual(set(departures), {"9", "14"})
+        self.assertEqual(departures["9"], array("q", [100, 300]))
+        self.assertEqual(departures.get("2", ()), ())
+        # Repeated times on a line are only kept once, the first one wins
+        self.assertEqual([d.journey_ref for d in departures.details("9")], ["J1", "J2"])
+        self.assertEqual(departures.details("9")[1].delay, 60)
+        self.assertIsNone(departures.details("9")[0].delay)
+        self.assertEqual(departures.details("2"), [])
+
+    def test_departure_uses_slots(self):
+        departure = Departure("9", 100)
+        with self.assertRaises(AttributeError):
+            departure.extra = True
+        self.assertEqual(departure, Departure("9", 100))
+        self.assertNotEqual(departure, Departure("9", 101))
+
+class TestKnownDepartures(unittest.TestCase):
+    def test_journey_key(self):
+        self.assertEqual(journey_key(Departure("9", 130, planned_time=100, journey_ref="J1", operating_day="D")), ("J1", "D"))
+        self.assertEqual(journey_key(Departure("9", 130, planned_time=100)), ("9", 100))
+        self.assertEqual(journey_key(Departure("9", 130)), ("9", 130))
+
+    def test_merge_updates_by_journey(self):
+        known = KnownDepartures()
+        self.assertIsNone(known.horizon)
+        self.assertEqual(known.merge([Departure("9", 100, journey_ref="J1"), Departure("9", 400, journey_ref="J2")]), 2)
+        self.assertEqual(known.horizon, 400)
+
+        # J1 is delayed, J2 is beyond the refreshed window and kept as it is
+        self.assertEqual(known.merge([Departure("9", 160, journey_ref="J1")], window_start=50), 1)
+        self.assertEqual(list(known.departures()["9"]), [160, 400])
+        self.assertEqual(known.merge([Departure("9", 160, journey_ref="J1")], window_start=50), 0)
+
+        # Trips after the horizon are added
+        known.merge([Departure("9", 400, journey_ref="J2"), Departure("14", 700, journey_ref="J3")], window_start=400)
+        self.assertEqual(known.horizon, 700)
+        self.assertEqual(len(known), 3)
+
+    def test_merge_drops_journeys_missing_from_window(self):
+        known = KnownDepartures()
+        known.merge([Departure("9", t, journey_ref=f"J{t}") for t in (100, 200, 300, 400)])
+        # J200 is no longer running, J400 was not asked for
+        self.assertEqual(known.merge([Departure("9", 100, journey_ref="J100"), Departure("9", 300, journey_ref="J300")], window_start=50), 1)
+        self.assertEqual(list(known.departures()["9"]), [100, 300, 400])
+        # An empty response says nothing about the window
+        self.assertEqual(known.merge([], window_start=50), 0)
+        self.assertEqual(len(known), 3)
+
+    def test_evict(self):
+        known = KnownDepartures()
+        known.merge([Departure("9", t, journey_ref=f"J{t}") for t in (100, 200, 300)])
+        self.assertEqual(known.evict(200), 1)
+        self.assertEqual(list(known.departures()["9"]), [200, 300])
+
+if __name__ == '__main__':
+    unittest.main()
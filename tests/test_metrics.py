@@ -0,0 +1,252 @@
+import io
+import json
+import asyncio
+import logging
+import socket
+import sys
+import unittest
+from unittest.mock import patch
+import requests
+from tramtrix import aio, main, server
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.departure_cache import report_fetched, report_fetch_failed
+from tramtrix.log import JsonFormatter, configure_logging
+from tramtrix.metrics import (
+    REGISTRY, Registry, MetricsServer, serve_metrics, CONTENT_TYPE, OJP_REQUESTS, OJP_REQUEST_SECONDS, OJP_PARSE_SECONDS,
+    AWTRIX_PUSHES, AWTRIX_PUSH_SECONDS, FETCH_ERRORS, OJP_TRANSFERRED_BYTES, OJP_RESPONSE_BYTES, OJP_PARSE_SKIPS
+)
+from tramtrix.ojp import OJPApiClient, OJPApiError, CircuitBreaker, MODE_TRIP
+from tramtrix.routes import Query, RoutesConfig
+from tramtrix.session import create_session
+from tramtrix.standins import AwtrixStandIn, Faults, OJPStandIn
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.enable()
+
+    def test_counter_and_gauge(self):
+        requests_total = self.registry.counter("requests_total", "Requests.", ("kind", "outcome"))
+        requests_total.inc(kind="trip", outcome="200")
+        requests_total.inc(2, kind="trip", outcome="200")
+        requests_total.inc(kind="location", outcome="error")
+        waiting = self.registry.gauge("waiting_seconds", "Waiting.")
+        waiting.set(1.5)
+        self.assertEqual(requests_total.value(kind="trip", outcome="200"), 3)
+        self.assertEqual(self.registry.render(), (
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{kind="location",outcome="error"} 1\n'
+            'requests_total{kind="trip",outcome="200"} 3\n'
+            "# HELP waiting_seconds Waiting.\n"
+            "# TYPE waiting_seconds gauge\n"
+            "waiting_seconds 1.5\n"
+        ))
+        with self.assertRaises(ValueError):
+            requests_total.inc(kind="trip")
+        with self.assertRaises(ValueError):
+            self.registry.counter("requests_total", "Again.")
+
+    def test_histogram(self):
+        seconds = self.registry.histogram("parse_seconds", "Parsing.", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            seconds.observe(value)
+        with seconds.time():
+            pass
+        self.assertEqual(seconds.count(), 5)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:5], [
+            'parse_seconds_bucket{le="0.1"} 3',
+            'parse_seconds_bucket{le="1"} 4',
+            'parse_seconds_bucket{le="+Inf"} 5',
+        ])
+        self.assertTrue(lines[5].startswith("parse_seconds_sum 3.65"))
+        self.assertEqual(lines[6], "parse_seconds_count 5")
+
+    def test_disabled_registry_records_nothing(self):
+        registry = Registry()
+        counter = registry.counter("c_total", "C.", ("kind",))
+        histogram = registry.histogram("h_seconds", "H.")
+        counter.inc(kind="trip")
+        with histogram.time():
+            pass
+        self.assertEqual(counter.value(kind="trip"), 0)
+        self.assertEqual(histogram.count(), 0)
+        self.assertEqual(registry.render(), "# HELP c_total C.\n# TYPE c_total counter\n"
+                                            "# HELP h_seconds H.\n# TYPE h_seconds histogram\n")
+
+    def test_metrics_server(self):
+        self.registry.counter("c_total", "C.").inc()
+        with MetricsServer(("127.0.0.1", 0), self.registry) as metrics_server:
+            url = f"http://127.0.0.1:{metrics_server.server_address[1]}"
+            response = requests.get(url + "/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Content-Type"], CONTENT_TYPE)
+            self.assertIn("c_total 1\n", response.text)
+            self.assertEqual(requests.get(url + "/").status_code, 404)
+
+
+    def test_started_server_as_context_manager(self):
+        with serve_metrics(0, registry=self.registry) as metrics_server:
+            url = f"http://127.0.0.1:{metrics_server.server_address[1]}/metrics"
+            self.assertEqual(requests.get(url).status_code, 200)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestEntryPoints(unittest.TestCase):
+    """
+    Every daemon serves the metrics while it runs when METRICS_PORT is set.
+    """
+
+    def setUp(self):
+        self.port = free_port()
+        self.scraped = []
+        for module in (main, aio, server):
+            for name, value in (("OJP_API_KEY", "test"), ("METRICS_PORT", self.port), ("METRICS_HOST", "127.0.0.1"),
+                                ("STOP_CACHE_FILE", ""), ("RECORD_FILE", None), ("configure_logging", lambda: None)):
+                patcher = patch.object(module, name, value)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+        self.addCleanup(REGISTRY.enable, False)
+
+    def scrape(self, *args, **kwargs):
+        response = requests.get(f"http://127.0.0.1:{self.port}/metrics", timeout=5)
+        self.scraped.append(response.status_code)
+
+    def test_main(self):
+        with patch.object(main, "configured_routes", return_value=RoutesConfig([], [])), \
+                patch.object(main, "run", self.scrape):
+            main.main()
+        self.assertEqual(self.scraped, [200])
+
+    def test_aio(self):
+        async def run(*args, **kwargs):
+            await asyncio.get_running_loop().run_in_executor(None, self.scrape)
+
+        with patch.object(aio, "configured_routes", return_value=RoutesConfig([], [])), patch.object(aio, "run", run):
+            aio.main()
+        self.assertEqual(self.scraped, [200])
+
+    def test_server(self):
+        scrape = self.scrape
+
+        class Server(server.TramtrixServer):
+            def __init__(self, service):
+                super().__init__(service, ("127.0.0.1", 0))
+
+            def serve_forever(self, *args):
+                scrape()
+
+        with patch.object(server, "TramtrixServer", Server), self.assertLogs("tramtrix.server"):
+            server.main()
+        self.assertEqual(self.scraped, [200])
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        REGISTRY.clear()
+        REGISTRY.enable()
+
+    def tearDown(self):
+        REGISTRY.enable(False)
+        REGISTRY.clear()
+
+    def test_ojp_requests(self):
+        with OJPStandIn() as server, OJPApiClient(
+                api_key="test", url=server.url, session=create_session(retries=0),
+                breaker=CircuitBreaker(failure_threshold=100)) as client:
+            origin = client.resolve_stop_ref("Zürich, Heuried")
+            client.get_trip_results(origin, "8591381")
+            server.faults = Faults(error_rate=1)
+            with self.assertRaises(OJPApiError):
+                client.get_trip_results(origin, "8591381")
+        self.assertEqual(OJP_REQUESTS.value(kind="location", outcome="200"), 1)
+        self.assertEqual(OJP_REQUESTS.value(kind=MODE_TRIP, outcome="200"), 1)
+        self.assertEqual(OJP_REQUESTS.value(kind=MODE_TRIP, outcome="503"), 1)
+        self.assertEqual(OJP_REQUEST_SECONDS.count(kind=MODE_TRIP), 2)
+        self.assertEqual(OJP_PARSE_SECONDS.count(kind=MODE_TRIP), 1)
+        self.assertIn('tramtrix_ojp_requests_total{kind="trip",outcome="503"} 1', REGISTRY.render())
+
+    def test_compressed_and_unchanged_responses(self):
+        now = [1767700800]
+        with OJPStandIn(clock=lambda: now[0], compress=True) as server, OJPApiClient(
+                api_key="test", url=server.url, session=create_session(retries=0), clock=lambda: 1767700800) as client:
+            results = client.get_trip_results("8591190", "8591381")
+            # Answered again with a new timestamp, but the same departures
+            now[0] += 10
+            self.assertIs(client.get_trip_results("8591190", "8591381"), results)
+            # A minute later the delays changed
+            now[0] += 60
+            self.assertNotEqual(client.get_trip_results("8591190", "8591381"), results)
+        self.assertEqual(OJP_PARSE_SKIPS.value(kind=MODE_TRIP), 1)
+        self.assertEqual(OJP_PARSE_SECONDS.count(kind=MODE_TRIP), 2)
+        self.assertLess(OJP_TRANSFERRED_BYTES.value(kind=MODE_TRIP), OJP_RESPONSE_BYTES.value(kind=MODE_TRIP) / 3)
+
+    def test_awtrix_pushes(self):
+        with AwtrixStandIn() as server, AwtrixClient(server.clock_url("kitchen"), min_interval=0,
+                                                     session=create_session(retries=0)) as clock:
+            self.assertTrue(clock.update_clock({"9": "a83632"}))
+            server.faults = Faults(error_rate=1)
+            with self.assertLogs("tramtrix.awtrix", "WARNING"):
+                self.assertFalse(clock.update_clock({"9": "03fc14"}))
+        self.assertEqual(AWTRIX_PUSHES.value(transport="http", outcome="ok"), 1)
+        self.assertEqual(AWTRIX_PUSHES.value(transport="http", outcome="failed"), 1)
+        self.assertEqual(AWTRIX_PUSH_SECONDS.count(transport="http"), 2)
+
+    def test_fetch_errors(self):
+        query = Query("8591190", "8591381")
+        with self.assertLogs("tramtrix.departure_cache", "WARNING") as logs:
+            report_fetch_failed(query, RuntimeError("timeout"), 30)
+            report_fetch_failed(query, RuntimeError("timeout"), 60)
+        self.assertEqual(FETCH_ERRORS.value(origin="8591190", destination="8591381"), 2)
+        self.assertEqual(logs.records[1].retry_in, 60)
+
+
+class TestLogging(unittest.TestCase):
+    def tearDown(self):
+        for name in ("__main__", "tramtrix"):
+            logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+            logger.propagate = True
+
+    def test_json_lines_with_extra_fields(self):
+        stream = io.StringIO()
+        configure_logging("INFO", "json", stream)
+        query = Query("8591190", "8591381", mode=MODE_TRIP)
+        report_fetched(query, {"9": [1, 2], "14": [3]}, 0.25, 60)
+        logging.getLogger("tramtrix.main").debug("Not shown")
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(entries), 1)
+        entry = entries[0]
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "tramtrix.departure_cache")
+        self.assertEqual(entry["message"], "Fetched 3 departures (8591190 -> 8591381) in 0.25s, next fetch in 60s")
+        self.assertEqual((entry["origin"], entry["departures"], entry["seconds"], entry["next_fetch_in"]),
+                         ("8591190", 3, 0.25, 60))
+        self.assertTrue(entry["time"].endswith("Z"))
+
+    def test_exception_and_text_format(self):
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            record = logging.makeLogRecord({"msg": "failed", "levelname": "ERROR", "exc_info": sys.exc_info()})
+        self.assertIn("RuntimeError: boom", json.loads(JsonFormatter().format(record))["exception"])
+
+        stream = io.StringIO()
+        configure_logging("debug", "text", stream)
+        logging.getLogger("tramtrix.main").debug("Updating clock %s...", "kitchen")
+        self.assertRegex(stream.getvalue(), r"DEBUG\s+Updating clock kitchen\.\.\.\n$")
+        with self.assertRaises(ValueError):
+            configure_logging(format="xml")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,26 @@
+import json
 import unittest
+import xml.etree.ElementTree as ET
 from unittest.mock import patch, MagicMock
-from tramtrix.ojp import OJPApiClient
-from datetime import datetime
+import requests
+from requests.structures import CaseInsensitiveDict
+from tramtrix.ojp import (
+    OJPApiClient, OJPApiError, OJPRateLimitError, OJPCircuitOpenError,
+    TokenBucket, CircuitBreaker, backoff_delay, _retry_after
+)
+from datetime import datetime, timezone
+from helpers import T0, FakeTime
+
+NAMESPACES = {
+    "ojp": "http://www.vdv.de/ojp",
+    "siri": "http://www.siri.org.uk/siri",
+}
 
 class TestOJPApiClient(unittest.TestCase):
     def setUp(self):
         self.client = OJPApiClient(api_key="test_key", url="http://test.url")
 
-    @patch("tramtrix.ojp.requests.post")
+    @patch("requests.Session.post")
     def test_resolve_stop_ref_success_stop_point(self, mock_post):
         # Mock XML response with StopPointRef
         mock_response = MagicMock()
@@ -38,7 +51,7 @@ class TestOJPApiClient(unittest.TestCase):
         self.assertEqual(result, "8591341")
         mock_post.assert_called_once()
     
-    @patch("tramtrix.ojp.requests.post")
+    @patch("requests.Session.post")
     def test_resolve_stop_ref_success_stop_place(self, mock_post):
         # Mock XML response with StopPlaceRef (alternative)
         mock_response = MagicMock()
@@ -65,7 +78,7 @@ class TestOJPApiClient(unittest.TestCase):
         result = self.client.resolve_stop_ref("Stauffacher")
         self.assertEqual(result, "8591381")
 
-    @patch("tramtrix.ojp.requests.post")
+    @patch("requests.Session.post")
     def test_resolve_stop_ref_not_found(self, mock_post):
         # Mock empty/invalid response
         mock_response = MagicMock()
@@ -78,7 +91,7 @@ class TestOJPApiClient(unittest.TestCase):
         
         self.assertIn("Could not resolve stop reference", str(context.exception))
 
-    @patch("tramtrix.ojp.requests.post")
+    @patch("requests.Session.post")
     def test_resolve_stop_ref_api_error(self, mock_post):
         # Mock 500 status
         mock_response = MagicMock()
@@ -91,12 +104,10 @@ class TestOJPApiClient(unittest.TestCase):
         
         self.assertIn("API call failed", str(context.exception))
 
-    @patch("tramtrix.ojp.requests.post")
+    @patch("requests.Session.post")
     def test_get_trip_results_success(self, mock_post):
         # Mock TripRequest response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.text = """
+        mock_response = response(200, """
         <OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">
             <OJPResponse>
                 <siri:ServiceDelivery>
@@ -137,7 +148,7 @@ class TestOJPApiClient(unittest.TestCase):
                 </siri:ServiceDelivery>
             </OJPResponse>
         </OJP>
-        """
+        """)
         mock_post.return_value = mock_response
 
         results = self.client.get_trip_results("REF_A", "REF_B")
@@ -146,10 +157,361 @@ class TestOJPApiClient(unittest.TestCase):
         self.assertIn("9", results)
         self.assertIn("14", results)
         
-        # Check parsed time (should be datetime)
+        # Check parsed time (should be epoch seconds)
         self.assertEqual(len(results["9"]), 1)
-        dt_9 = list(results["9"])[0]
-        self.assertIsInstance(dt_9, datetime)
+        epoch_9 = results["9"][0]
+        self.assertIsInstance(epoch_9, int)
         # 12:00 UTC
-        self.assertEqual(dt_9.hour, 12)
-        self.assertEqual(dt_9.minute, 0)
+        self.assertEqual(epoch_9, datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc).timestamp())
+
+def response(status_code, text="", headers=None):
+    mock_response = requests.Response()
+    mock_response.status_code = status_code
+    mock_response._content = text.encode("utf-8")
+    mock_response.encoding = "utf-8"
+    mock_response.headers = CaseInsensitiveDict(headers or {})
+    return mock_response
+
+TRIP_DELIVERY = """
+<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">
+    <ojp:TripResult>
+        <ojp:Leg>
+            <ojp:PublishedServiceName><ojp:Text>9</ojp:Text></ojp:PublishedServiceName>
+            <ojp:EstimatedTime>2026-01-06T12:00:00Z</ojp:EstimatedTime>
+        </ojp:Leg>
+    </ojp:TripResult>
+</OJP>
+"""
+
+STOP_EVENT_DELIVERY = """
+<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">
+    <ojp:StopEventResult>
+        <ojp:StopEvent>
+            <ojp:ThisCall>
+                <ojp:CallAtStop>
+                    <ojp:ServiceDeparture>
+                        <ojp:EstimatedTime>2026-01-06T12:00:00Z</ojp:EstimatedTime>
+                    </ojp:ServiceDeparture>
+                </ojp:CallAtStop>
+            </ojp:ThisCall>
+            <ojp:OnwardCall>
+                <siri:StopPointRef>ch:1:sloid:91381:1:2</siri:StopPointRef>
+            </ojp:OnwardCall>
+            <ojp:Service>
+                <ojp:PublishedServiceName><ojp:Text>9</ojp:Text></ojp:PublishedServiceName>
+            </ojp:Service>
+        </ojp:StopEvent>
+    </ojp:StopEventResult>
+</OJP>
+"""
+
+def trip_delivery(*trips):
+    """
+    A TripDelivery with a single leg TripResult for each (line, journey ref, minutes after T0).
+    """
+    results = "".join(f"""
+    <ojp:TripResult>
+        <ojp:Leg>
+            <ojp:Service>
+                <ojp:OperatingDayRef>2026-01-06</ojp:OperatingDayRef>
+                <ojp:JourneyRef>{journey_ref}</ojp:JourneyRef>
+                <ojp:PublishedServiceName><ojp:Text>{line}</ojp:Text></ojp:PublishedServiceName>
+            </ojp:Service>
+            <ojp:EstimatedTime>{datetime.fromtimestamp(T0 + minutes * 60, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</ojp:EstimatedTime>
+        </ojp:Leg>
+    </ojp:TripResult>""" for line, journey_ref, minutes in trips)
+    return f'<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">{results}</OJP>'
+
+class TestBackoff(unittest.TestCase):
+    def test_backoff_delay(self):
+        self.assertEqual(backoff_delay(1, 10, 100, random=lambda: 1.0), 10)
+        self.assertEqual(backoff_delay(2, 10, 100, random=lambda: 1.0), 20)
+        self.assertEqual(backoff_delay(2, 10, 100, random=lambda: 0.0), 10)
+        self.assertEqual(backoff_delay(20, 10, 100, random=lambda: 1.0), 100)
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate_and_burst(self):
+        clock = FakeTime()
+        bucket = TokenBucket(rate=0.5, capacity=2, clock=clock, sleep=clock.sleep)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.wait_time(), 2)
+        clock.now += 2
+        self.assertTrue(bucket.try_acquire())
+        # Waits for the next token
+        self.assertTrue(bucket.acquire())
+        self.assertAlmostEqual(clock.now, 1004)
+        self.assertFalse(bucket.acquire(timeout=1))
+
+    def test_daily_quota(self):
+        bucket = TokenBucket.for_daily_quota(quota=8640, burst=5)
+        self.assertAlmostEqual(bucket.rate, 0.1)
+        self.assertEqual(bucket.capacity, 5)
+
+    def test_pause(self):
+        clock = FakeTime()
+        bucket = TokenBucket(rate=1, capacity=5, clock=clock, sleep=clock.sleep)
+        bucket.pause(30)
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.wait_time(), 30)
+        clock.now += 30
+        self.assertTrue(bucket.try_acquire())
+
+    def test_snapshot(self):
+        clock = FakeTime()
+        bucket = TokenBucket(rate=0.5, capacity=5, clock=clock, sleep=clock.sleep)
+        for _ in range(5):
+            bucket.try_acquire()
+        bucket.pause(10)
+        snapshot = json.loads(json.dumps(bucket.snapshot()))
+        # The next process goes on with an empty, paused bucket
+        clock.now += 4
+        restored = TokenBucket(rate=0.5, capacity=5, clock=clock, sleep=clock.sleep)
+        restored.restore(snapshot)
+        self.assertAlmostEqual(restored.wait_time(), 6)
+        clock.now += 6
+        for _ in range(5):
+            self.assertTrue(restored.try_acquire())
+        self.assertFalse(restored.try_acquire())
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_and_recovers(self):
+        clock = FakeTime()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, max_reset_timeout=100, clock=clock, random=lambda: 1.0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertAlmostEqual(breaker.retry_after(), 10)
+
+        # One trial request once the timeout has passed
+        clock.now += 10
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # It failed, so the circuit opens for twice as long
+        breaker.record_failure()
+        self.assertAlmostEqual(breaker.retry_after(), 20)
+
+        clock.now += 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_skipped_trial(self):
+        clock = FakeTime()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now += 10
+        self.assertTrue(breaker.allow())
+        breaker.record_skipped()
+        self.assertTrue(breaker.allow())
+
+    def test_snapshot(self):
+        clock = FakeTime()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, max_reset_timeout=100, clock=clock,
+                                 random=lambda: 1.0)
+        breaker.record_failure()
+        restored = CircuitBreaker(failure_threshold=1, reset_timeout=10, max_reset_timeout=100, clock=clock,
+                                  random=lambda: 1.0)
+        restored.restore(json.loads(json.dumps(breaker.snapshot())))
+        self.assertFalse(restored.allow())
+        self.assertAlmostEqual(restored.retry_after(), 10)
+        clock.now += 10
+        self.assertTrue(restored.allow())
+        # Still backing off from the failures of the last process
+        restored.record_failure()
+        self.assertAlmostEqual(restored.retry_after(), 20)
+
+class TestQuota(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeTime()
+        self.bucket = TokenBucket(rate=0.1, capacity=2, clock=self.clock, sleep=self.clock.sleep)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock, random=lambda: 1.0)
+        self.client = OJPApiClient(api_key="test_key", url="http://test.url", rate_limiter=self.bucket, breaker=self.breaker)
+
+    @patch("requests.Session.post")
+    def test_rate_limited_serves_last_departures(self, mock_post):
+        mock_post.return_value = response(200, TRIP_DELIVERY)
+        self.client.get_trip_results("A", "B")
+        results = self.client.get_trip_results("A", "B")
+        # The bucket is empty, no request is sent
+        self.assertIs(self.client.get_trip_results("A", "B"), results)
+        self.assertEqual(mock_post.call_count, 2)
+        with self.assertRaises(OJPRateLimitError) as context:
+            self.client.get_trip_results("A", "C")
+        self.assertAlmostEqual(context.exception.retry_after, 10)
+        with self.assertRaises(OJPRateLimitError):
+            self.client.get_trip_results("A", "B", allow_stale=False)
+
+    @patch("requests.Session.post")
+    def test_429_retry_after(self, mock_post):
+        mock_post.return_value = response(429, "Too Many Requests", {"Retry-After": "120"})
+        with self.assertRaises(OJPRateLimitError) as context:
+            self.client.get_trip_results("A", "B")
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertAlmostEqual(context.exception.retry_after, 120)
+        self.assertIn("API call failed", str(context.exception))
+        # Nothing is sent until then, and a rate limit doesn't count as the API failing
+        self.assertFalse(self.bucket.try_acquire())
+        self.assertEqual(self.breaker.failures, 0)
+
+    @patch("requests.Session.post")
+    def test_circuit_opens_on_server_errors(self, mock_post):
+        mock_post.return_value = response(200, TRIP_DELIVERY)
+        self.bucket.capacity = self.bucket._tokens = 10
+        results = self.client.get_trip_results("A", "B")
+
+        mock_post.return_value = response(503, "Service Unavailable")
+        for _ in range(2):
+            with self.assertRaises(OJPApiError) as context:
+                self.client.get_trip_results("A", "B")
+            self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(mock_post.call_count, 3)
+
+        # Open: the last departures are served without calling the API
+        self.assertIs(self.client.get_trip_results("A", "B"), results)
+        with self.assertRaises(OJPCircuitOpenError) as context:
+            self.client.get_trip_results("A", "C")
+        self.assertAlmostEqual(context.exception.retry_after, 30)
+        self.assertEqual(mock_post.call_count, 3)
+
+    @patch("requests.Session.post")
+    def test_connection_errors_count_as_failures(self, mock_post):
+        mock_post.side_effect = requests.ConnectionError("refused")
+        with self.assertRaises(OJPApiError):
+            self.client.get_trip_results("A", "B")
+        self.assertEqual(self.breaker.failures, 1)
+
+    @patch("requests.Session.post")
+    def test_stop_events_mode(self, mock_post):
+        mock_post.return_value = response(200, STOP_EVENT_DELIVERY)
+        results = self.client.get_departures("8591190", "8591381", mode="stop_event")
+        self.assertEqual({line: list(times) for line, times in results.items()}, {"9": [int(T0)]})
+        self.assertIn(b"<OJPStopEventRequest>", mock_post.call_args.kwargs["data"])
+
+        # Served from the last stop events while the quota is used up, not from trips
+        self.bucket._tokens = 0
+        self.assertIs(self.client.get_departures("8591190", "8591381", mode="stop_event"), results)
+        with self.assertRaises(OJPRateLimitError):
+            self.client.get_departures("8591190", "8591381", mode="trip")
+        with self.assertRaises(ValueError):
+            self.client.get_departures("8591190", "8591381", mode="teleport")
+
+    @patch("requests.Session.post")
+    def test_unchanged_response_is_not_parsed_again(self, mock_post):
+        self.client.rate_limiter = TokenBucket(rate=1, capacity=100)
+        timestamped = TRIP_DELIVERY.replace(
+            "<ojp:TripResult>", "<siri:ResponseTimestamp>{}</siri:ResponseTimestamp><ojp:TripResult>"
+        )
+        mock_post.return_value = response(200, timestamped.format("2026-01-06T12:00:00Z"))
+        results = self.client.get_trip_results("A", "B")
+        mock_post.return_value = response(200, timestamped.format("2026-01-06T12:00:30Z"))
+        with patch("tramtrix.ojp.parse_trip_results") as parse:
+            self.assertIs(self.client.get_trip_results("A", "B"), results)
+            parse.assert_not_called()
+            # Another route, or other departures, are parsed
+            self.client.get_trip_results("A", "C")
+            later = timestamped.replace("12:00:00Z", "12:01:00Z")
+            mock_post.return_value = response(200, later.format("2026-01-06T12:01:00Z"))
+            self.client.get_trip_results("A", "B")
+            self.assertEqual(parse.call_count, 2)
+        self.assertIn("gzip", self.client.headers["Accept-Encoding"])
+
+    def test_retry_after_header(self):
+        self.assertEqual(_retry_after(response(429, headers={"Retry-After": "5"}), 0), 5)
+        self.assertAlmostEqual(_retry_after(response(429, headers={"Retry-After": "Tue, 06 Jan 2026 12:01:00 GMT"}), T0), 60)
+        self.assertIsNone(_retry_after(response(429, headers={"Retry-After": "soon"}), T0))
+        self.assertIsNone(_retry_after(response(429), T0))
+
+class TestIncrementalTrips(unittest.TestCase):
+    def setUp(self):
+        self.client = OJPApiClient(api_key="test_key", url="http://test.url", rate_limiter=TokenBucket(rate=1, capacity=100))
+
+    def requested(self, mock_post):
+        bodies = [ET.fromstring(call.kwargs["data"]) for call in mock_post.call_args_list]
+        return [
+            (body.findtext(".//ojp:Origin/ojp:DepArrTime", namespaces=NAMESPACES),
+             body.findtext(".//ojp:Params/ojp:NumberOfResults", namespaces=NAMESPACES))
+            for body in bodies
+        ]
+
+    @patch("tramtrix.ojp.TRIP_LOOKAHEAD", 30)
+    @patch("requests.Session.post")
+    def test_refreshes_near_term_and_extends_horizon(self, mock_post):
+        mock_post.side_effect = [
+            response(200, trip_delivery(("9", "J1", 2), ("14", "J2", 5), ("9", "J3", 12))),
+            response(200, trip_delivery(("9", "J3", 12), ("9", "J4", 40))),
+        ]
+        results = self.client.get_trip_results_incremental("A", "B", now=T0)
+        # The first fetch asks for the full window, then for the trips after 12:12 as less than 30 minutes are known
+        self.assertEqual(self.requested(mock_post), [("2026-01-06T12:00:00Z", "10"), ("2026-01-06T12:12:00Z", "10")])
+        self.assertEqual({line: list(times) for line, times in results.items()},
+                         {"9": [int(T0) + 120, int(T0) + 720, int(T0) + 2400], "14": [int(T0) + 300]})
+
+        # Three minutes later J1 has left, J2 is delayed and J3 cancelled: only the near-term window is asked for
+        mock_post.reset_mock()
+        mock_post.side_effect = [response(200, trip_delivery(("14", "J2", 7), ("9", "J5", 20)))]
+        results = self.client.get_trip_results_incremental("A", "B", now=T0 + 180)
+        self.assertEqual(self.requested(mock_post), [("2026-01-06T12:03:00Z", "4")])
+        self.assertEqual({line: list(times) for line, times in results.items()},
+                         {"9": [int(T0) + 1200, int(T0) + 2400], "14": [int(T0) + 420]})
+
+    @patch("tramtrix.ojp.TRIP_LOOKAHEAD", 30)
+    @patch("requests.Session.post")
+    def test_snapshot_carries_known_departures(self, mock_post):
+        mock_post.side_effect = [
+            response(200, trip_delivery(("9", "J1", 2), ("14", "J2", 5), ("9", "J3", 40))),
+            response(200, trip_delivery(("9", "J1", 2), ("14", "J2", 6))),
+        ]
+        self.client.get_trip_results_incremental("A", "B", now=T0)
+        snapshot = json.loads(json.dumps(self.client.snapshot()))
+
+        # A client in the next process only refreshes the near-term trips
+        client = OJPApiClient(api_key="test_key", url="http://test.url", rate_limiter=TokenBucket(rate=1, capacity=100))
+        client.restore(snapshot)
+        results = client.get_trip_results_incremental("A", "B", now=T0 + 60)
+        self.assertEqual(self.requested(mock_post), [("2026-01-06T12:00:00Z", "10"), ("2026-01-06T12:01:00Z", "4")])
+        self.assertEqual({line: list(times) for line, times in results.items()},
+                         {"9": [int(T0) + 120, int(T0) + 2400], "14": [int(T0) + 360]})
+        with self.assertRaises(KeyError):
+            client.restore({})
+
+    @patch("tramtrix.ojp.FETCH_INTERVAL_MAX", 300)
+    @patch("requests.Session.post")
+    def test_no_extension_past_the_last_departure(self, mock_post):
+        # The last tram of the day, nothing runs after it
+        mock_post.side_effect = lambda *args, **kwargs: response(200, trip_delivery(("9", "J1", 10)))
+        self.client.get_trip_results_incremental("A", "B", now=T0)
+        self.assertEqual(mock_post.call_count, 2)
+        self.client.get_trip_results_incremental("A", "B", now=T0 + 60)
+        self.assertEqual(mock_post.call_count, 3)
+        # Asked again after a while
+        self.client.get_trip_results_incremental("A", "B", now=T0 + 300)
+        self.assertEqual(mock_post.call_count, 5)
+
+    @patch("requests.Session.post")
+    def test_mode_and_stale_fallback(self, mock_post):
+        self.client.clock = lambda: T0
+        mock_post.return_value = response(200, trip_delivery(("9", "J1", 2), ("9", "J2", 90)))
+        results = self.client.get_departures("A", "B", mode="trip_incremental")
+        self.assertEqual(mock_post.call_count, 1)
+
+        # While the quota is used up the known departures are served, without trying to extend them
+        self.client.rate_limiter._tokens = 0
+        self.client.rate_limiter.rate = 1e-9
+        self.assertIs(self.client.get_departures("A", "B", mode="trip_incremental"), results)
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch("tramtrix.ojp.TRIP_LOOKAHEAD", 30)
+    @patch("requests.Session.post")
+    def test_failed_extension_keeps_refreshed_departures(self, mock_post):
+        mock_post.side_effect = [response(200, trip_delivery(("9", "J1", 2))), response(500, "Error")]
+        with self.assertLogs("tramtrix.ojp", "WARNING"):
+            results = self.client.get_trip_results_incremental("A", "B", now=T0)
+        self.assertEqual(list(results["9"]), [int(T0) + 120])
+        self.assertEqual(mock_post.call_count, 2)
+
@@ -1,5 +1,6 @@
 import unittest
 import os
+from collections.abc import Mapping
 from tramtrix.ojp import OJPApiClient
 from tramtrix.config import OJP_API_KEY
 
@@ -31,13 +32,22 @@ class TestOJPApiClientIntegration(unittest.TestCase):
         results = self.client.get_trip_results(stop_ref_origin, stop_ref_destination)
         
         # We can't guarantee there are trams running (e.g. at 3 AM), but we can check the structure
-        # If it returns a dict (empty or not), the parsing succeeded.
-        self.assertIsInstance(results, dict)
+        # If it returns a mapping (empty or not), the parsing succeeded.
+        self.assertIsInstance(results, Mapping)
         
         if results:
             print(f"[Integration] Found trips for lines: {list(results.keys())}")
         else:
             print("[Integration] No trips found (might be late night).")
 
+    def test_get_stop_events_real_api(self):
+        """
+        Integration test: Actually calls the API for the departure board at Heuried towards Stauffacher.
+        """
+        print("\n[Integration] Fetching stop events...")
+        results = self.client.get_stop_events("8591190", "8591381")
+        self.assertIsInstance(results, Mapping)
+        print(f"[Integration] Found departures for lines: {list(results.keys())}")
+
 if __name__ == "__main__":
     unittest.main()
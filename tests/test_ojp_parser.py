@@ -0,0 +1,238 @@
+import io
+import unittest
+from datetime import datetime, timezone
+from tramtrix.departures import Departures
+from tramtrix.ojp_parser import iter_departures, lxml_etree, parse_trip_results, parse_stop_events, stop_key
+
+TRIP_DELIVERY = """<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <OJPTripDelivery>
+                <TripResult>
+                    <Trip>
+                        <Leg>
+                            <TimedLeg>
+                                <LegBoard>
+                                    <ServiceDeparture>
+                                        <TimetabledTime>2026-01-06T11:59:00Z</TimetabledTime>
+                                        <EstimatedTime>2026-01-06T12:00:00Z</EstimatedTime>
+                                    </ServiceDeparture>
+                                </LegBoard>
+                                <LegAlight>
+                                    <ServiceArrival>
+                                        <EstimatedTime>2026-01-06T12:04:00Z</EstimatedTime>
+                                    </ServiceArrival>
+                                </LegAlight>
+                                <Service>
+                                    <PublishedServiceName>
+                                        <Text xml:lang="de">9</Text>
+                                    </PublishedServiceName>
+                                </Service>
+                            </TimedLeg>
+                        </Leg>
+                        <Leg>
+                            <TransferLeg>
+                                <EstimatedTime>2026-01-06T12:05:00Z</EstimatedTime>
+                            </TransferLeg>
+                        </Leg>
+                        <Leg>
+                            <TimedLeg>
+                                <Service>
+                                    <PublishedServiceName>
+                                        <Text xml:lang="de">14</Text>
+                                    </PublishedServiceName>
+                                </Service>
+                            </TimedLeg>
+                        </Leg>
+                    </Trip>
+                </TripResult>
+                <TripResult>
+                    <Trip>
+                        <Leg>
+                            <TimedLeg>
+                                <LegBoard>
+                                    <ServiceDeparture>
+                                        <EstimatedTime>2026-01-06T12:07:30+01:00</EstimatedTime>
+                                    </ServiceDeparture>
+                                </LegBoard>
+                                <Service>
+                                    <PublishedServiceName>
+                                        <Text xml:lang="de">14</Text>
+                                    </PublishedServiceName>
+                                </Service>
+                            </TimedLeg>
+                        </Leg>
+                    </Trip>
+                </TripResult>
+                <Leg>
+                    <Service>
+                        <PublishedServiceName>
+                            <Text>99</Text>
+                        </PublishedServiceName>
+                    </Service>
+                    <EstimatedTime>2026-01-06T12:00:00Z</EstimatedTime>
+                </Leg>
+            </OJPTripDelivery>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+EXPECTED = {
+    "9": [int(datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc).timestamp())],
+    "14": [int(datetime(2026, 1, 6, 11, 7, 30, tzinfo=timezone.utc).timestamp())],
+}
+
+STOP_EVENT_DELIVERY = """<?xml version="1.0" encoding="UTF-8"?>
+<OJP xmlns="http://www.vdv.de/ojp" xmlns:siri="http://www.siri.org.uk/siri" version="2.0">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <OJPStopEventDelivery>
+                <StopEventResult>
+                    <StopEvent>
+                        <ThisCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:91190:0:1</siri:StopPointRef>
+                                <ServiceArrival>
+                                    <TimetabledTime>2026-01-06T11:58:00Z</TimetabledTime>
+                                    <EstimatedTime>2026-01-06T11:59:00Z</EstimatedTime>
+                                </ServiceArrival>
+                                <ServiceDeparture>
+                                    <TimetabledTime>2026-01-06T11:59:00Z</TimetabledTime>
+                                    <EstimatedTime>2026-01-06T12:00:00Z</EstimatedTime>
+                                </ServiceDeparture>
+                            </CallAtStop>
+                        </ThisCall>
+                        <OnwardCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:91381:1:2</siri:StopPointRef>
+                                <ServiceArrival>
+                                    <EstimatedTime>2026-01-06T12:06:00Z</EstimatedTime>
+                                </ServiceArrival>
+                            </CallAtStop>
+                        </OnwardCall>
+                        <Service>
+                            <OperatingDayRef>2026-01-06</OperatingDayRef>
+                            <JourneyRef>ch:1:sjyid:100001:9-1</JourneyRef>
+                            <PublishedServiceName>
+                                <Text xml:lang="de">9</Text>
+                            </PublishedServiceName>
+                        </Service>
+                    </StopEvent>
+                </StopEventResult>
+                <StopEventResult>
+                    <StopEvent>
+                        <ThisCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:91190:0:2</siri:StopPointRef>
+                                <ServiceDeparture>
+                                    <EstimatedTime>2026-01-06T12:02:00Z</EstimatedTime>
+                                </ServiceDeparture>
+                            </CallAtStop>
+                        </ThisCall>
+                        <OnwardCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:91100:0:1</siri:StopPointRef>
+                            </CallAtStop>
+                        </OnwardCall>
+                        <Service>
+                            <PublishedServiceName>
+                                <Text xml:lang="de">9</Text>
+                            </PublishedServiceName>
+                        </Service>
+                    </StopEvent>
+                </StopEventResult>
+                <StopEventResult>
+                    <StopEvent>
+                        <ThisCall>
+                            <CallAtStop>
+                                <siri:StopPointRef>ch:1:sloid:91190:0:1</siri:StopPointRef>
+                                <ServiceDeparture>
+                                    <TimetabledTime>2026-01-06T12:04:00Z</TimetabledTime>
+                                </ServiceDeparture>
+                            </CallAtStop>
+                        </ThisCall>
+                        <Service>
+                            <PublishedServiceName>
+                                <Text xml:lang="de">14</Text>
+                            </PublishedServiceName>
+                        </Service>
+                    </StopEvent>
+                </StopEventResult>
+            </OJPStopEventDelivery>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+T12 = int(datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc).timestamp())
+
+def as_lists(results):
+    return {line: list(times) for line, times in results.items()}
+
+class TestOJPParser(unittest.TestCase):
+    def test_parse_trip_results(self):
+        # First EstimatedTime of each leg, legs without a line or a time and legs
+        # outside a TripResult are ignored
+        results = parse_trip_results(TRIP_DELIVERY, use_lxml=False)
+        self.assertIsInstance(results, Departures)
+        self.assertEqual(as_lists(results), EXPECTED)
+
+        details = results.details("9")[0]
+        self.assertEqual(details.planned_time, EXPECTED["9"][0] - 60)
+        self.assertEqual(details.delay, 60)
+
+    def test_accepts_bytes_and_streams(self):
+        data = TRIP_DELIVERY.encode("utf-8")
+        self.assertEqual(as_lists(parse_trip_results(data, use_lxml=False)), EXPECTED)
+        self.assertEqual(as_lists(parse_trip_results(io.BytesIO(data), use_lxml=False)), EXPECTED)
+
+    def test_iter_departures_is_lazy(self):
+        departures = iter_departures(TRIP_DELIVERY, use_lxml=False)
+        self.assertEqual(next(departures).line, "9")
+        self.assertEqual([(d.line, d.time, d.planned_time) for d in departures], [("14", EXPECTED["14"][0], None)])
+
+    def test_empty_delivery(self):
+        self.assertEqual(len(parse_trip_results("<OJP></OJP>", use_lxml=False)), 0)
+
+    @unittest.skipIf(lxml_etree is None, "lxml not installed")
+    def test_lxml_matches_etree(self):
+        self.assertEqual(as_lists(parse_trip_results(TRIP_DELIVERY, use_lxml=True)), EXPECTED)
+        self.assertEqual(as_lists(parse_trip_results(TRIP_DELIVERY.encode("utf-8"), use_lxml=True)), EXPECTED)
+
+class TestStopEventParser(unittest.TestCase):
+    def test_parse_stop_events(self):
+        # Times are those of the departure, not the arrival before it, and events without
+        # an estimated departure time are skipped, like legs of a trip
+        results = parse_stop_events(STOP_EVENT_DELIVERY, use_lxml=False)
+        self.assertEqual(as_lists(results), {"9": [T12, T12 + 120]})
+
+        details = results.details("9")[0]
+        self.assertEqual(details.stop_ref, "ch:1:sloid:91190:0:1")
+        self.assertEqual(details.planned_time, T12 - 60)
+        self.assertEqual(details.journey_ref, "ch:1:sjyid:100001:9-1")
+        self.assertEqual(details.operating_day, "2026-01-06")
+
+    def test_filter_by_destination(self):
+        # Only the tram calling at Stauffacher later on, whichever form its ref takes
+        for destination in ("8591381", "ch:1:sloid:91381", "ch:1:sloid:91381:1:2"):
+            results = parse_stop_events(STOP_EVENT_DELIVERY, destination=destination, use_lxml=False)
+            self.assertEqual(as_lists(results), {"9": [T12]}, destination)
+        self.assertEqual(len(parse_stop_events(STOP_EVENT_DELIVERY, destination="8500000", use_lxml=False)), 0)
+
+    def test_stop_key(self):
+        self.assertEqual(stop_key("8591381"), "91381")
+        self.assertEqual(stop_key("ch:1:sloid:91381:1:2"), "91381")
+        self.assertEqual(stop_key("de:08111:6115"), "de:08111:6115")
+
+    @unittest.skipIf(lxml_etree is None, "lxml not installed")
+    def test_lxml_matches_etree(self):
+        for destination in (None, "8591381"):
+            self.assertEqual(
+                as_lists(parse_stop_events(STOP_EVENT_DELIVERY, destination=destination, use_lxml=True)),
+                as_lists(parse_stop_events(STOP_EVENT_DELIVERY, destination=destination, use_lxml=False)),
+            )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import xml.etree.ElementTree as ET
+from tramtrix.ojp_requests import (
+    trip_request, stop_event_request, location_information_request, next_message_id, request_timestamp
+)
+
+NAMESPACES = {
+    "ojp": "http://www.vdv.de/ojp",
+    "siri": "http://www.siri.org.uk/siri",
+}
+
+class TestRequests(unittest.TestCase):
+    def test_trip_request(self):
+        body, message_id = trip_request("8591341", "8591381", now=1767700800)
+        root = ET.fromstring(body)
+        self.assertEqual(root.findtext(".//siri:MessageIdentifier", namespaces=NAMESPACES), message_id)
+        self.assertEqual(root.findtext(".//siri:RequestTimestamp", namespaces=NAMESPACES), "2026-01-06T12:00:00Z")
+        refs = [e.text for e in root.iterfind(".//siri:StopPointRef", NAMESPACES)]
+        self.assertEqual(refs, ["8591341", "8591381"])
+
+    def test_stop_event_request(self):
+        body, message_id = stop_event_request("8591190", now=1767700800)
+        root = ET.fromstring(body)
+        self.assertTrue(message_id.startswith("SER-"))
+        self.assertEqual(root.findtext(".//ojp:Location/ojp:PlaceRef/siri:StopPointRef", namespaces=NAMESPACES), "8591190")
+        self.assertEqual(root.findtext(".//ojp:Location/ojp:DepArrTime", namespaces=NAMESPACES), "2026-01-06T12:00:00Z")
+        self.assertEqual(root.findtext(".//ojp:Params/ojp:StopEventType", namespaces=NAMESPACES), "departure")
+        self.assertEqual(root.findtext(".//ojp:Params/ojp:IncludeOnwardCalls", namespaces=NAMESPACES), "true")
+        root = ET.fromstring(stop_event_request("8591190", onward_calls=False)[0])
+        self.assertEqual(root.findtext(".//ojp:Params/ojp:IncludeOnwardCalls", namespaces=NAMESPACES), "false")
+
+    def test_refs_are_escaped(self):
+        root = ET.fromstring(trip_request("A&B", "<C>", now=1767700800)[0])
+        refs = [e.text for e in root.iterfind(".//siri:StopPointRef", NAMESPACES)]
+        self.assertEqual(refs, ["A&B", "<C>"])
+
+    def test_location_information_request_escapes_name(self):
+        body, _ = location_information_request("Zürich, Bahnhof <Enge> & Co", message_id="LIR-1")
+        root = ET.fromstring(body)
+        self.assertEqual(root.findtext(".//ojp:InitialInput/ojp:Name", namespaces=NAMESPACES), "Zürich, Bahnhof <Enge> & Co")
+        self.assertEqual(root.findtext(".//siri:MessageIdentifier", namespaces=NAMESPACES), "LIR-1")
+
+    def test_message_ids_are_unique(self):
+        ids = {next_message_id("TR") for _ in range(100)}
+        self.assertEqual(len(ids), 100)
+        self.assertTrue(all(i.startswith("TR-") for i in ids))
+        self.assertNotEqual(trip_request("A", "B")[1], trip_request("A", "B")[1])
+
+    def test_request_timestamp_defaults_to_now(self):
+        self.assertRegex(request_timestamp(), r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$")
+        self.assertEqual(request_timestamp(1767700800.9), "2026-01-06T12:00:00Z")
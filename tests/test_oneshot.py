@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+import tramtrix
+from tramtrix.config import OJP_URL, load_dotenv_snapshot
+from tramtrix.ojp import CircuitBreaker, OJPApiClient, TokenBucket
+from tramtrix.oneshot import OneShotState, run_once
+from tramtrix.routes import Clock, Route, RoutesConfig
+from tramtrix.scheduler import FetchPolicy
+from tramtrix.standins import AwtrixStandIn, OJPStandIn
+from tramtrix.stop_cache import StopRefCache
+from helpers import T0, FakeClock, FakeOJPClient
+
+# Seconds `import tramtrix.oneshot` may take, measured with -X importtime. The daemon's
+# tramtrix.main takes about 200ms, mostly requests and the XML parsers
+ONESHOT_IMPORT_BUDGET = 0.15
+
+# What a one-shot run must not import unless it fetches or pushes
+HEAVY_MODULES = ("requests", "urllib3", "dotenv", "http.server", "xml.etree.ElementTree", "lxml")
+
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)$", re.MULTILINE)
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(tramtrix.__file__)))
+
+
+class TestRunOnce(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.tmp_dir.name, "oneshot.json")
+        self.routes = RoutesConfig([Route("r", "A", "B")], [Clock("kitchen", "http://kitchen/api/custom?name=tram", "r", ["9"])])
+        self.stop_cache = StopRefCache(os.path.join(self.tmp_dir.name, "stop_refs.json"))
+        self.stop_cache.set(OJP_URL, "A", "8500001")
+        self.stop_cache.set(OJP_URL, "B", "8500002")
+        self.policy = FetchPolicy(interval=60, min_interval=20, max_interval=600)
+        # Green for the next minute and a half, then amber
+        self.ojp = FakeOJPClient({"9": [T0 + 300]}, stop_refs={"A": "8500001", "B": "8500002"})
+        self.clock = FakeClock()
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_at(self, now, **kwargs):
+        """
+        One run, with the state read from and written to disk like tramtrix-once does.
+        """
+        def ojp_client():
+            self.calls.append("ojp")
+            return self.ojp
+
+        def awtrix_client(url):
+            self.calls.append(url)
+            return self.clock
+
+        state = OneShotState.load(self.state_path)
+        ok = run_once(self.routes, state, ojp_client, awtrix_client, stop_cache=self.stop_cache,
+                      policy=self.policy, now=now, **kwargs)
+        state.save()
+        return ok
+
+    def test_only_fetches_and_pushes_what_is_due(self):
+        self.assertTrue(self.run_at(T0))
+        self.assertEqual((self.ojp.calls, self.clock.updates), (1, [{"9": "03fc14"}]))
+
+        # Not due yet, the clients aren't even created
+        self.calls.clear()
+        self.assertTrue(self.run_at(T0 + 30))
+        self.assertEqual(self.calls, [])
+
+        # Fetched again shortly before the tram turns amber, the colours didn't change yet
+        self.assertTrue(self.run_at(T0 + 100))
+        self.assertEqual((self.ojp.calls, len(self.clock.updates)), (2, 1))
+
+        # The tram is now in the amber window
+        self.assertTrue(self.run_at(T0 + 150))
+        self.assertEqual(self.clock.updates[-1], {"9": "fcca03"})
+
+        # Heartbeat
+        self.calls.clear()
+        self.run_at(T0 + 150 + 300)
+        self.assertIn("http://kitchen/api/custom?name=tram", self.calls)
+        self.assertEqual(self.ojp.resolved, [])
+
+    def test_resolves_missing_stops_through_the_client(self):
+        self.stop_cache = None
+        self.run_at(T0)
+        self.assertEqual(self.ojp.resolved, ["A", "B"])
+
+    def test_failed_fetch_keeps_departures_and_backs_off(self):
+        self.run_at(T0)
+        self.ojp.error = RuntimeError("timeout")
+        with self.assertLogs("tramtrix.departure_cache", "WARNING"):
+            self.assertFalse(self.run_at(T0 + 100))
+        entry = next(iter(OneShotState.load(self.state_path).queries.values()))
+        self.assertEqual(entry["departures"], {"9": [T0 + 300]})
+        self.assertEqual((entry["fetched_at"], entry["failures"]), (T0, 1))
+        self.assertGreater(entry["next_fetch_at"], T0 + 100)
+        self.assertEqual(len(self.clock.updates), 1)
+
+    def test_failed_push_is_retried(self):
+        self.clock.ok = False
+        self.assertFalse(self.run_at(T0))
+        self.clock.ok = True
+        self.assertTrue(self.run_at(T0 + 10))
+        self.assertEqual(len(self.clock.updates), 2)
+        self.run_at(T0 + 20)
+        self.assertEqual(len(self.clock.updates), 2)
+
+    def test_stale_departures_are_not_shown(self):
+        self.run_at(T0)
+        self.ojp.error = RuntimeError("timeout")
+        with self.assertLogs("tramtrix.departure_cache", "WARNING"):
+            self.run_at(T0 + 120, stale_for=100)
+        self.assertEqual(self.clock.updates[-1], {"9": "a83632"})
+
+    def test_force(self):
+        self.run_at(T0)
+        self.run_at(T0 + 1, force=True)
+        self.assertEqual((self.ojp.calls, len(self.clock.updates)), (2, 2))
+
+    def test_corrupt_state_starts_again(self):
+        with open(self.state_path, "w") as f:
+            f.write("{")
+        self.assertEqual(OneShotState.load(self.state_path).queries, {})
+        self.assertTrue(self.run_at(T0))
+        self.assertEqual(self.ojp.calls, 1)
+
+    def test_client_goes_on_in_the_next_run(self):
+        clock = [float(T0)]
+        def client():
+            return OJPApiClient(api_key="key", rate_limiter=TokenBucket(rate=0.01, capacity=3, clock=lambda: clock[0]),
+                                breaker=CircuitBreaker(failure_threshold=1, clock=lambda: clock[0]))
+        first = client()
+        first.rate_limiter.try_acquire()
+        first.breaker.record_failure()
+        state = OneShotState.load(self.state_path)
+        state.keep_client(first)
+        state.save()
+
+        clock[0] += 1
+        second = client()
+        OneShotState.load(self.state_path).restore_client(second)
+        self.assertFalse(second.breaker.allow())
+        self.assertEqual([second.rate_limiter.try_acquire() for _ in range(3)], [True, True, False])
+
+        # A snapshot the client can't use only costs the quota and departures it kept
+        state = OneShotState(self.state_path, client={"breaker": {}})
+        with self.assertLogs("tramtrix.oneshot", "WARNING"):
+            state.restore_client(client())
+
+
+class TestDotenvSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dotenv_path = os.path.join(self.tmp_dir.name, ".env")
+        self.snapshot_path = os.path.join(self.tmp_dir.name, "cache", "dotenv.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_dotenv(self, text):
+        with open(self.dotenv_path, "w") as f:
+            f.write(text)
+
+    def test_parses_once_until_the_file_changes(self):
+        self.write_dotenv("TRAMTRIX_TEST_A=1\nTRAMTRIX_TEST_B='two words'\n")
+        with patch.dict(os.environ, {"TRAMTRIX_TEST_B": "set"}):
+            values = load_dotenv_snapshot(self.snapshot_path, self.dotenv_path)
+            self.assertEqual(values, {"TRAMTRIX_TEST_A": "1", "TRAMTRIX_TEST_B": "two words"})
+            self.assertEqual((os.environ["TRAMTRIX_TEST_A"], os.environ["TRAMTRIX_TEST_B"]), ("1", "set"))
+
+        with patch("dotenv.dotenv_values", side_effect=AssertionError("parsed again")), patch.dict(os.environ):
+            self.assertEqual(load_dotenv_snapshot(self.snapshot_path, self.dotenv_path)["TRAMTRIX_TEST_A"], "1")
+
+        self.write_dotenv("TRAMTRIX_TEST_A=10\n")
+        with patch.dict(os.environ):
+            self.assertEqual(load_dotenv_snapshot(self.snapshot_path, self.dotenv_path), {"TRAMTRIX_TEST_A": "10"})
+
+    @unittest.skipUnless(os.name == "posix", "file modes")
+    def test_snapshot_is_private(self):
+        self.write_dotenv("OJP_API_KEY=secret\n")
+        os.makedirs(os.path.dirname(self.snapshot_path))
+        with open(self.snapshot_path, "w") as f:
+            f.write("{}")
+        os.chmod(self.snapshot_path, 0o644)
+        with patch.dict(os.environ):
+            load_dotenv_snapshot(self.snapshot_path, self.dotenv_path)
+        self.assertEqual(os.stat(self.snapshot_path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(os.path.dirname(self.snapshot_path)), ["dotenv.json"])
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.env = dict(
+            os.environ, PYTHONPATH=SRC, XDG_CACHE_HOME=self.tmp_dir.name, OJP_API_KEY="test",
+            STOP_CACHE_FILE=os.path.join(self.tmp_dir.name, "stop_refs.json"),
+            STOP_INDEX_FILE=os.path.join(self.tmp_dir.name, "stops.idx"),
+            ONESHOT_STATE_FILE=os.path.join(self.tmp_dir.name, "oneshot.json"),
+            ROUTES_CONFIG_FILE="", TRAM_LINES="9,14", LOG_FORMAT="text",
+        )
+        self.env.pop("DOTENV_SNAPSHOT_FILE", None)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def python(self, *args):
+        return subprocess.run([sys.executable, *args], env=self.env, capture_output=True, text=True, timeout=60)
+
+    def test_import_budget(self):
+        # As tramtrix-once sets it, the first import writes the .env snapshot the others read
+        self.env["DOTENV_SNAPSHOT_FILE"] = os.path.join(self.tmp_dir.name, "dotenv.json")
+        self.python("-c", "import tramtrix.oneshot")
+        timings = []
+        for _ in range(3):
+            result = self.python("-X", "importtime", "-c", "import tramtrix.oneshot")
+            # import time: self [us] | cumulative | imported package
+            modules = {match.group(2): int(match.group(1)) for match in IMPORT_TIME.finditer(result.stderr)}
+            for module in HEAVY_MODULES:
+                self.assertNotIn(module, modules)
+            timings.append(modules["tramtrix.oneshot"] / 1e6)
+        self.assertLess(min(timings), ONESHOT_IMPORT_BUDGET)
+
+    def test_invalid_log_format(self):
+        self.env["LOG_FORMAT"] = "xml"
+        for module in ("tramtrix.once", "tramtrix.main", "tramtrix.aio", "tramtrix.server"):
+            result = self.python("-m", module)
+            self.assertEqual(result.returncode, 1, module)
+            self.assertIn("Unknown log format 'xml'", result.stderr)
+            self.assertNotIn("Traceback", result.stderr)
+
+    def test_warm_run_skips_the_http_clients(self):
+        with OJPStandIn() as ojp, AwtrixStandIn() as awtrix:
+            self.env.update(OJP_URL=ojp.url, AWTRIX_URL=awtrix.clock_url("tram"))
+            result = self.python("-m", "tramtrix.once")
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn("Updating clock default", result.stderr)
+            self.assertEqual(awtrix.updates, {"tram": 1})
+
+            result = self.python("-c", "import sys; from tramtrix.once import main; code = main([]); "
+                                       f"print(sorted(set({HEAVY_MODULES!r}) & set(sys.modules))); sys.exit(code)")
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.strip(), "[]")
+            self.assertEqual(awtrix.updates, {"tram": 1})
+            self.assertEqual(ojp.stats()["requests"], 3)
+        with open(self.env["ONESHOT_STATE_FILE"]) as f:
+            self.assertEqual(list(json.load(f)["clocks"]), ["default"])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, "tramtrix", "dotenv.json")))
+
+    def test_import_leaves_the_environment_alone(self):
+        result = self.python("-c", "import os, tramtrix.oneshot; print(os.getenv('DOTENV_SNAPSHOT_FILE'))")
+        self.assertEqual(result.stdout.strip(), "None", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,312 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+import requests
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.ojp import OJPApiClient, OJPApiError
+from tramtrix.ojp_requests import trip_request, location_information_request
+from tramtrix.replay import (
+    Recorder, Recording, ReplayAdapter, SimulatedTime, ReplayFinished, replay, replay_session, request_key,
+    main as replay_main,
+)
+from tramtrix.routes import RoutesConfig, Route, Clock
+from tramtrix.scheduler import FetchPolicy
+from tramtrix.session import create_session
+from tramtrix.standins import OJPStandIn
+
+T0 = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc).timestamp()
+
+STOP_REFS = {"Zürich, Heuried": "8591190", "Zürich, Stauffacher": "8591381"}
+
+
+def location_response(stop_ref):
+    return f"""<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">
+    <ojp:PlaceResult><ojp:Place><ojp:StopPoint><ojp:StopPointRef>{stop_ref}</ojp:StopPointRef></ojp:StopPoint></ojp:Place></ojp:PlaceResult>
+</OJP>"""
+
+
+def trip_response(*departures):
+    results = "".join(f"""
+    <ojp:TripResult>
+        <ojp:Leg>
+            <ojp:Service><ojp:PublishedServiceName><ojp:Text>{line}</ojp:Text></ojp:PublishedServiceName></ojp:Service>
+            <ojp:EstimatedTime>{datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}</ojp:EstimatedTime>
+        </ojp:Leg>
+    </ojp:TripResult>""" for line, t in departures)
+    return f'<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">{results}</OJP>'
+
+
+def entry(t, body, response, service="ojp", url="http://ojp/", status=200, latency=0.5):
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    return {"service": service, "t": t, "latency": latency, "method": "POST", "url": url, "request": body,
+            "status": status, "headers": {"Content-Type": "application/xml"}, "response": response}
+
+
+def recorded_day():
+    """
+    Half an hour of a tram 9 every ten minutes, fetched every minute, and the stop lookups.
+    """
+    entries = [
+        entry(T0 - 5, location_information_request(name, now=T0 - 5)[0], location_response(ref))
+        for name, ref in STOP_REFS.items()
+    ]
+    for minute in range(30):
+        t = T0 + minute * 60
+        next_tram = T0 + (minute // 10 + 1) * 600
+        entries.append(entry(t, trip_request("8591190", "8591381", now=t)[0],
+                             trip_response(("9", next_tram), ("9", next_tram + 600))))
+        entries.append(entry(t + 1, "{}", "", service="awtrix", url="http://kitchen/api/custom?name=tram"))
+    return entries
+
+
+class _OJPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = location_response("8591190").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "session=abc")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "nested", "recording.jsonl.gz")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _OJPHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/ojp20"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_records_exchanges_without_credentials(self):
+        with Recorder(self.path, clock=lambda: T0) as recorder:
+            with OJPApiClient(api_key="secret-key", url=self.url, recorder=recorder, clock=lambda: T0) as client:
+                self.assertEqual(client.resolve_stop_ref("Zürich, Heuried"), "8591190")
+
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            text = f.read()
+        self.assertNotIn("secret-key", text)
+        self.assertNotIn("session=abc", text)
+        recorded = json.loads(text)
+        self.assertEqual((recorded["service"], recorded["t"], recorded["method"], recorded["url"], recorded["status"]),
+                         ("ojp", T0, "POST", self.url, 200))
+        self.assertIn("Zürich, Heuried", recorded["request"])
+        self.assertEqual(recorded["response"], location_response("8591190"))
+        self.assertEqual(recorded["headers"], {"Content-Type": "application/xml; charset=utf-8"})
+        self.assertGreaterEqual(recorded["latency"], 0)
+
+    def test_records_connection_errors_and_appends(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in range(2):
+            with Recorder(self.path) as recorder, OJPApiClient(api_key="key", url=self.url, recorder=recorder,
+                                                               session=create_session(retries=0)) as client:
+                with self.assertRaises(OJPApiError):
+                    client.resolve_stop_ref("Zürich, Heuried")
+        recording = Recording.load(self.path)
+        self.assertEqual(len(recording), 2)
+        self.assertTrue(all("error" in e and "status" not in e for e in recording.entries))
+
+    def test_load_tolerates_truncated_recording(self):
+        with Recorder(self.path) as recorder:
+            for i in range(50):
+                recorder.write(entry(T0 + i, "{}", "x" * 100, service="awtrix"))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:len(data) // 2])
+        recording = Recording.load(self.path)
+        self.assertTrue(0 < len(recording) < 50)
+        self.assertEqual(recording.start, T0)
+
+
+class FakeSleep:
+    def __init__(self):
+        self.slept = []
+
+    def __call__(self, seconds):
+        self.slept.append(seconds)
+
+
+class TestReplayAdapter(unittest.TestCase):
+    def setUp(self):
+        self.recording = Recording(recorded_day())
+        self.now = T0
+        self.sleep = FakeSleep()
+
+    def client(self, **kwargs):
+        adapter = ReplayAdapter(self.recording, clock=lambda: self.now, sleep=self.sleep, **kwargs)
+        return adapter, OJPApiClient(api_key="key", url="http://ojp/", session=replay_session(adapter),
+                                     clock=lambda: self.now)
+
+    def test_request_key_masks_volatile_values(self):
+        first, _ = trip_request("8591190", "8591381", now=T0)
+        second, _ = trip_request("8591190", "8591381", now=T0 + 3600)
+        self.assertNotEqual(first, second)
+        self.assertEqual(request_key("POST", "http://ojp/", first), request_key("POST", "http://ojp/", second))
+        other, _ = trip_request("8591190", "8503000", now=T0)
+        self.assertNotEqual(request_key("POST", "http://ojp/", first), request_key("POST", "http://ojp/", other))
+        self.assertEqual(request_key("POST", "http://clock/", '{"text": 1}'), ("POST", "http://clock/", None))
+
+    def test_serves_recorded_response_for_the_time(self):
+        adapter, client = self.client()
+        self.assertEqual(client.resolve_stop_ref("Zürich, Stauffacher"), "8591381")
+        self.now = T0 + 15 * 60 + 30
+        departures = client.get_trip_results("8591190", "8591381")
+        self.assertEqual(list(departures["9"]), [T0 + 1200, T0 + 1800])
+        # Before the recording started, the first recorded response is served
+        self.now = T0 - 3600
+        self.assertEqual(list(client.get_trip_results("8591190", "8591381")["9"]), [T0 + 600, T0 + 1200])
+        self.assertEqual(len(adapter.sent), 3)
+        self.assertEqual(self.sleep.slept, [0.5] * 3)
+
+    def test_latency_scale(self):
+        _, client = self.client(latency_scale=0.1)
+        client.get_trip_results("8591190", "8591381")
+        _, client = self.client(latency_scale=0)
+        client.get_trip_results("8591190", "8591381")
+        self.assertEqual(self.sleep.slept, [0.05])
+
+    def test_unrecorded_request(self):
+        adapter, client = self.client()
+        with self.assertRaises(OJPApiError):
+            client.resolve_stop_ref("Basel SBB")
+        self.assertEqual(adapter.missed, 1)
+
+        adapter = ReplayAdapter(self.recording, clock=lambda: self.now, default_status=200)
+        with AwtrixClient("http://office/api/custom?name=tram", session=replay_session(adapter),
+                          clock=lambda: self.now) as clock:
+            self.assertTrue(clock.update_clock({"9": "a83632"}))
+        self.assertEqual(adapter.sent[0][2], "http://office/api/custom?name=tram")
+
+    def test_recorded_error(self):
+        body, _ = location_information_request("Zürich, Heuried", now=T0)
+        failing = {"service": "ojp", "t": T0, "latency": 2.0, "method": "POST", "url": "http://ojp/",
+                   "request": body, "error": "Read timed out"}
+        adapter = ReplayAdapter(Recording([failing]), clock=lambda: T0, sleep=self.sleep)
+        with self.assertRaises(requests.ConnectionError) as context:
+            replay_session(adapter).post("http://ojp/", data=body)
+        self.assertIn("Read timed out", str(context.exception))
+        self.assertEqual(self.sleep.slept, [2.0])
+
+
+class TestSimulatedTime(unittest.TestCase):
+    def test_sleep_advances_until_the_end(self):
+        simulated = SimulatedTime(T0, until=T0 + 60)
+        simulated.sleep(30)
+        self.assertEqual(simulated.time(), T0 + 30)
+        with self.assertRaises(ReplayFinished):
+            simulated.sleep(45)
+        self.assertEqual(simulated.time(), T0 + 60)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "day.jsonl.gz")
+        with Recorder(self.path) as recorder:
+            for recorded in recorded_day():
+                recorder.write(recorded)
+        self.routes = RoutesConfig(
+            [Route("tram", "Zürich, Heuried", "Zürich, Stauffacher", mode="trip")],
+            [Clock("kitchen", "http://kitchen/api/custom?name=tram", "tram", ["9"]),
+             Clock("office", "mqtt://broker/awtrix_office/custom/tram", "tram", ["9"])],
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_replays_recorded_day_deterministically(self):
+        summaries = []
+        for _ in range(2):
+            summaries.append(replay(self.path, routes=self.routes, latency_scale=0))
+        summary = summaries[0]
+        self.assertEqual(summary["simulated_seconds"], 29 * 60 + 6)
+        self.assertLess(summary["real_seconds"], 10)
+        self.assertEqual(summary["ojp_missed"], 0)
+        self.assertGreater(summary["ojp_requests"], 2)
+        self.assertEqual(set(summary["clock_updates"]),
+                         {"http://kitchen/api/custom?name=tram", "http://office/api/custom?name=tram"})
+        self.assertEqual(summary["recorded_clock_updates"], {"http://kitchen/api/custom?name=tram": 30})
+        for key in ("simulated_seconds", "ojp_requests", "ojp_missed", "clock_updates"):
+            self.assertEqual(summaries[1][key], summary[key])
+
+    def test_hours_limits_the_replay(self):
+        summary = replay(self.path, routes=self.routes, hours=0.1, latency_scale=0)
+        self.assertEqual(summary["simulated_seconds"], 360)
+        self.assertEqual(summary["recorded_clock_updates"], {"http://kitchen/api/custom?name=tram": 6})
+
+    def test_main_leaves_the_stop_cache_alone(self):
+        stop_cache_file = os.path.join(self.tmp_dir.name, "stop_refs.json")
+        with patch("tramtrix.replay.STOP_CACHE_FILE", stop_cache_file), \
+                patch("tramtrix.replay.configured_routes", return_value=self.routes), \
+                patch("tramtrix.replay.configure_logging"), redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(replay_main([self.path, "--quiet"]), 0)
+        self.assertIn("0 not in the recording", out.getvalue())
+        # The stops resolved from the recording were only cached for the replay
+        self.assertFalse(os.path.exists(stop_cache_file))
+
+
+class TestFetchVolume(unittest.TestCase):
+    """
+    How many requests the fetch policy sends for an hour of trams 9 and 14 every 7.5
+    minutes, as timetabled by the OJP stand-in.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "hour.jsonl.gz")
+        now = [T0]
+        stand_in = OJPStandIn(clock=lambda: now[0])
+        stand_in.server_close()
+        with Recorder(self.path) as recorder:
+            for name in STOP_REFS:
+                body = location_information_request(name, now=T0 - 5)[0]
+                recorder.write(entry(T0 - 5, body, stand_in.respond("POST", "/ojp20", body)[2].decode("utf-8")))
+            origin, destination = (OJPStandIn.stop_ref(name) for name in STOP_REFS)
+            # Departures as they were every 10 seconds
+            for t in range(int(T0), int(T0) + 3600 + 1, 10):
+                now[0] = t
+                body = trip_request(origin, destination, now=t)[0]
+                recorder.write(entry(t, body, stand_in.respond("POST", "/ojp20", body)[2].decode("utf-8")))
+        self.routes = RoutesConfig(
+            [Route("tram", "Zürich, Heuried", "Zürich, Stauffacher", mode="trip")],
+            [Clock("kitchen", "http://kitchen/api/custom?name=tram", "tram", ["9", "14"])],
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fetches(self, policy):
+        summary = replay(self.path, routes=self.routes, latency_scale=0, policy=policy)
+        self.assertEqual(summary["ojp_missed"], 0)
+        # Less the two stop lookups
+        return summary["ojp_requests"] - 2
+
+    def test_fewer_requests_than_fetching_every_minute(self):
+        baseline = self.fetches(FetchPolicy(interval=60, min_interval=60, max_interval=60))
+        self.assertAlmostEqual(baseline, 60, delta=1)
+        adaptive = self.fetches(FetchPolicy(interval=60, min_interval=20, max_interval=600, random=lambda: 0.5))
+        self.assertLess(adaptive, baseline * 0.8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+import unittest
+from tramtrix.routes import (
+    Clock, Route, RoutesConfig, default_routes_config, load_routes_config, parse_routes_config
+)
+
+CONFIG = {
+    "routes": {
+        "heuried": {"origin": "Zürich, Heuried", "destination": "Zürich, Stauffacher"},
+        "heuried-again": {"origin": "Zürich, Heuried", "destination": "Zürich, Stauffacher"},
+        "hardplatz": {"origin": "Zürich, Hardplatz", "destination": "Zürich, Stauffacher"},
+        "unused": {"origin": "Zürich, Bellevue", "destination": "Zürich, Central"},
+    },
+    "clocks": {
+        "kitchen": {"url": "http://kitchen/api/custom?name=tram", "route": "heuried", "lines": ["9", "14"]},
+        "office": {"url": "http://office/api/custom?name=tram", "route": "heuried-again", "lines": "14"},
+        "lobby": {"url": "http://lobby/api/custom?name=tram", "route": "hardplatz", "lines": ["2", "3"]},
+    },
+}
+
+STOP_REFS = {
+    "Zürich, Heuried": "8591190",
+    "Zürich, Stauffacher": "8591381",
+    "Zürich, Hardplatz": "8591175",
+}
+
+class TestRoutesConfig(unittest.TestCase):
+    def test_parse_routes_config(self):
+        config = parse_routes_config(CONFIG)
+        self.assertEqual(len(config.routes), 4)
+        self.assertEqual([clock.name for clock in config.clocks], ["kitchen", "office", "lobby"])
+        self.assertEqual(config.clocks[1].lines, ["14"])
+
+    def test_stop_names_only_include_routes_with_clocks(self):
+        config = parse_routes_config(CONFIG)
+        self.assertEqual(config.stop_names(), ["Zürich, Heuried", "Zürich, Stauffacher", "Zürich, Hardplatz"])
+
+    def test_queries_are_deduplicated(self):
+        queries = parse_routes_config(CONFIG).queries(STOP_REFS)
+
+        # Two routes with the same stops share one query, each clock keeps its own lines
+        self.assertEqual(len(queries), 2)
+        self.assertEqual((queries[0].stop_ref_origin, queries[0].stop_ref_destination), ("8591190", "8591381"))
+        self.assertEqual([clock.name for clock in queries[0].clocks], ["kitchen", "office"])
+        self.assertEqual(queries[0].lines, ["9", "14"])
+        self.assertEqual([clock.name for clock in queries[1].clocks], ["lobby"])
+
+    def test_queries_deduplicate_by_resolved_ref(self):
+        config = RoutesConfig(
+            [Route("a", "Heuried", "Stauffacher"), Route("b", "Zürich, Heuried", "Zürich, Stauffacher")],
+            [Clock("one", "http://one", "a", ["9"]), Clock("two", "http://two", "b", ["14"])],
+        )
+        stop_refs = {"Heuried": "8591190", "Zürich, Heuried": "8591190",
+                     "Stauffacher": "8591381", "Zürich, Stauffacher": "8591381"}
+        self.assertEqual(len(config.queries(stop_refs)), 1)
+
+    def test_fetch_mode(self):
+        config = parse_routes_config({
+            "routes": {
+                "trip": {"origin": "Zürich, Heuried", "destination": "Zürich, Stauffacher"},
+                "board": {"origin": "Zürich, Heuried", "destination": "Zürich, Stauffacher", "mode": "stop_event"},
+            },
+            "clocks": {
+                "one": {"url": "http://one", "route": "trip"},
+                "two": {"url": "http://two", "route": "board"},
+            },
+        })
+        self.assertEqual(config.routes["trip"].mode, "trip")
+        # The same stops fetched in different modes are separate queries
+        queries = config.queries(STOP_REFS)
+        self.assertEqual([query.mode for query in queries], ["trip", "stop_event"])
+
+        with self.assertRaises(ValueError):
+            parse_routes_config({
+                "routes": {"r": {"origin": "A", "destination": "B", "mode": "teleport"}},
+                "clocks": {"c": {"url": "http://c"}},
+            })
+
+    def test_route_can_be_omitted_with_single_route(self):
+        config = parse_routes_config({
+            "routes": {"home": {"origin": "A", "destination": "B"}},
+            "clocks": {"kitchen": {"url": "http://kitchen"}},
+        })
+        self.assertEqual(config.clocks[0].route, "home")
+        # Lines default to TRAM_LINES
+        self.assertTrue(config.clocks[0].lines)
+
+    def test_invalid_configs(self):
+        invalid = [
+            {},
+            {"routes": {"a": {"origin": "A"}}, "clocks": {}},
+            {"routes": {"a": {"origin": "A", "destination": "B"}}, "clocks": {"c": {"route": "a"}}},
+            {"routes": {"a": {"origin": "A", "destination": "B"}}, "clocks": {"c": {"url": "http://c", "route": "x"}}},
+            {"routes": {"a": {"origin": "A", "destination": "B"}, "b": {"origin": "A", "destination": "C"}},
+             "clocks": {"c": {"url": "http://c"}}},
+            {"routes": {"a": {"origin": "A", "destination": "B"}}, "clocks": {"c": {"url": "http://c", "lines": []}}},
+        ]
+        for data in invalid:
+            with self.assertRaises(ValueError):
+                parse_routes_config(data)
+
+    def test_load_routes_config(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "routes.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(CONFIG, f)
+            self.assertEqual(len(load_routes_config(path).clocks), 3)
+
+    def test_default_routes_config(self):
+        config = default_routes_config()
+        self.assertEqual(len(config.clocks), 1)
+        self.assertEqual(len(config.stop_names()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from tramtrix.main import run
+from tramtrix.routes import Clock, Query
+from tramtrix.scheduler import FetchPolicy, QuerySchedule
+from helpers import T0, FakeClock, FakeOJPClient, FakeTime, StopLoop, at
+
+class TestScheduler(unittest.TestCase):
+    def test_fetch_policy(self):
+        policy = FetchPolicy(interval=60, min_interval=20, max_interval=600, idle_horizon=1800, volatile_seconds=30)
+        # 20 seconds before the first colour change more than a minute away: a tram
+        # turning amber in 30 seconds and red in 90
+        self.assertEqual(policy.delay({"9": {at(3.5)}}, None, ["9"], T0), 70)
+        # Turning green at 12:04
+        self.assertEqual(policy.delay({"9": {at(10)}}, None, ["9"], T0), 220)
+        self.assertEqual(policy.delay({"9": {at(10)}, "14": {at(7.5)}}, None, ["9", "14"], T0), 70)
+        # Every change is within the next minute, or the tram is leaving
+        self.assertEqual(policy.delay({"9": {at(1.5)}}, None, ["9"], T0), 60)
+        # Never later than max_interval while a tram is due within the idle horizon
+        self.assertEqual(policy.delay({"9": {at(25)}}, None, ["9"], T0), 600)
+        # Nothing due soon
+        self.assertEqual(policy.delay({"9": {at(45)}}, None, ["9"], T0), 600)
+        self.assertEqual(policy.delay({"9": {at(-1)}}, None, ["9"], T0), 600)
+        self.assertEqual(policy.delay({}, None, ["9"], T0), 600)
+        # The estimate for a near tram moved by a minute since the last fetch
+        self.assertEqual(policy.delay({"9": {at(10)}}, {"9": {at(9)}}, ["9"], T0), 20)
+        # Small realtime adjustments are not volatile
+        self.assertEqual(policy.delay({"9": {at(10)}}, {"9": {at(9.9)}}, ["9"], T0), 220)
+
+    def test_query_schedule(self):
+        query = Query("A", "B", [Clock("kitchen", "http://kitchen", "r", ["9"])])
+        schedule = QuerySchedule(query, FetchPolicy(interval=600, min_interval=20, max_interval=600, random=lambda: 1.0))
+        self.assertTrue(schedule.fetch_due(T0))
+
+        schedule.fetched({"9": {at(15)}}, T0)
+        self.assertFalse(schedule.fetch_due(T0 + 30))
+        self.assertEqual(schedule.next_fetch_at, T0 + 600)
+
+        # Failed fetches back off exponentially from min_interval, keeping the last departures
+        self.assertEqual(schedule.fetch_failed(T0 + 600), 20)
+        self.assertEqual(schedule.results, {"9": {at(15)}})
+        self.assertEqual(schedule.next_fetch_at, T0 + 620)
+        self.assertEqual(schedule.fetch_failed(T0 + 620), 40)
+        # The API asked to wait longer
+        self.assertEqual(schedule.fetch_failed(T0 + 660, retry_after=300), 300)
+        schedule.fetched({"9": {at(15)}}, T0 + 960)
+        self.assertEqual(schedule.failures, 0)
+
+    def test_retry_delay_jitter(self):
+        policy = FetchPolicy(interval=60, min_interval=20, max_interval=600, random=lambda: 0.0)
+        self.assertEqual(policy.retry_delay(1), 10)
+        self.assertEqual(policy.retry_delay(3), 40)
+        self.assertEqual(policy.retry_delay(10), 300)
+
+    def test_run_pushes_only_at_colour_changes(self):
+        fake_time = FakeTime(T0, max_sleeps=7200)
+        client = FakeOJPClient({"9": {at(30)}})
+        clock = FakeClock(fake_time)
+        query = Query("A", "B", [Clock("kitchen", "http://kitchen", "r", ["9"])])
+        policy = FetchPolicy(interval=60, min_interval=20, max_interval=600, idle_horizon=1800)
+
+        with self.assertRaises(StopLoop):
+            run(client, {"kitchen": clock}, [query], policy, clock=fake_time.time, sleep=fake_time.sleep, background=False)
+
+        changes = clock.changes()
+        colours = [line_colors["9"] for _, line_colors in changes]
+        self.assertEqual(colours[:4], ["a83632", "03fc14", "fcca03", "a83632"])
+        # Pushed within a second of each boundary
+        self.assertAlmostEqual(changes[1][0], at(24).timestamp(), delta=1)
+        self.assertAlmostEqual(changes[2][0], at(27).timestamp(), delta=1)
+        # Far fewer fetches than once a minute over the simulated two hours
+        self.assertLess(client.calls, (fake_time.now - T0) / 60)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import http.client
+import json
+import threading
+import time
+import unittest
+from tramtrix.departures import Departure, Departures
+from tramtrix.ojp import OJPApiClient, OJPApiError, StopNotFoundError, TokenBucket
+from tramtrix.server import DepartureService, SingleFlight, TramtrixServer
+from tramtrix.standins import OJPStandIn
+from helpers import T0, FakeOJPClient, FakeTime
+
+STOP_REFS = dict({"Zürich, Heuried": "8591190", "Zürich, Stauffacher": "8591381"},
+                 **{f"Stop {number}": f"85{number}" for number in range(20)})
+
+def ojp_client(delay=0.0):
+    return FakeOJPClient(Departures([Departure("9", T0 + 300), Departure("14", T0 + 900)]), delay=delay,
+                         stop_refs=STOP_REFS)
+
+def concurrently(count, function):
+    results = [None] * count
+    def target(i):
+        results[i] = function()
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return len(calls)
+        self.assertEqual(concurrently(20, lambda: flight.do("k", slow)), [1] * 20)
+        self.assertEqual(len(calls), 1)
+        # Later calls run again
+        self.assertEqual(flight.do("k", slow), 2)
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+        def failing():
+            time.sleep(0.05)
+            raise ValueError("boom")
+        def call():
+            try:
+                flight.do("k", failing)
+            except ValueError as e:
+                return str(e)
+        self.assertEqual(concurrently(5, call), ["boom"] * 5)
+
+class TestDepartureService(unittest.TestCase):
+    def test_concurrent_requests_coalesce(self):
+        client = ojp_client(delay=0.1)
+        service = DepartureService(client, ttl=30)
+        results = concurrently(50, lambda: service.departures("8591190", "8591381", lines=["9"]))
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(results[0]["lines"]["9"]["departures"], [T0 + 300])
+        self.assertEqual(list(results[0]["lines"]), ["9"])
+
+    def test_ttl_and_stale_fallback(self):
+        client = ojp_client()
+        fake_time = FakeTime(T0)
+        service = DepartureService(client, ttl=30, stale_for=600, clock=fake_time)
+
+        body = service.departures("8591190", "8591381")
+        self.assertEqual(body["state"], "fresh")
+        self.assertEqual(body["lines"]["9"]["status"], "GREEN")
+        self.assertEqual(body["lines"]["14"]["status"], "RED")
+        fake_time.now += 20
+        service.departures("8591190", "8591381")
+        self.assertEqual(client.calls, 1)
+
+        # Expired from the cache, but the API fails: the last departures are served
+        fake_time.now += 20
+        client.error = OJPApiError("API call failed with status code 503", status_code=503)
+        body = service.departures("8591190", "8591381")
+        self.assertEqual(body["state"], "stale")
+        self.assertEqual(body["age"], 40)
+        self.assertEqual(client.calls, 2)
+
+        with self.assertRaises(OJPApiError):
+            service.departures("8591190", "8500000")
+
+    def test_handle_query(self):
+        client = ojp_client(delay=0.05)
+        service = DepartureService(client)
+        bodies = concurrently(10, lambda: service.handle_query(
+            "origin=Z%C3%BCrich,+Heuried&destination=Z%C3%BCrich,+Stauffacher&lines=9,14&mode=stop_event"
+        ))
+        self.assertEqual(bodies[0]["origin"], "8591190")
+        self.assertEqual(bodies[0]["mode"], "stop_event")
+        self.assertEqual(len(client.resolved), 2)
+        self.assertEqual(service.handle_query("origin_ref=8591190&destination_ref=8591381")["destination"], "8591381")
+        for query in ("origin_ref=8591190", "origin_ref=A&destination_ref=B&mode=teleport"):
+            with self.assertRaises(ValueError):
+                service.handle_query(query)
+
+    def test_bounded_caches(self):
+        client = ojp_client()
+        service = DepartureService(client, max_routes=2)
+        for number in range(10):
+            service.handle_query(f"origin=Stop+{number}&destination=Stop+{number + 1}")
+        # Twice as many stop names as routes, the least recently used are dropped
+        self.assertEqual(list(service._stop_refs), ["Stop 7", "Stop 8", "Stop 9", "Stop 10"])
+        self.assertEqual(service.cache.state(("858", "859", "trip")), "fresh")
+        self.assertEqual(service.cache.state(("857", "858", "trip")), "missing")
+
+    def test_bounded_client_caches(self):
+        # Clients choose the routes, the OJP client mustn't keep the departures of each one
+        with OJPStandIn() as stand_in, OJPApiClient(api_key="test", url=stand_in.url, max_routes=10,
+                                                    rate_limiter=TokenBucket(1000, 1000)) as client:
+            service = DepartureService(client, max_routes=10)
+            for number in range(30):
+                mode = "trip_incremental" if number % 2 else "trip"
+                service.handle_query(f"origin_ref=85{number:05d}&destination_ref=8591381&mode={mode}")
+        for routes in (client._last_results, client._last_digests, client._known_departures):
+            self.assertLessEqual(len(routes), 10)
+        self.assertIn(("trip_incremental", "8500029", "8591381"), client._known_departures)
+
+    def test_configured_routes_only(self):
+        client = ojp_client()
+        service = DepartureService(client, stop_refs={"Zürich, Heuried": "8591190", "Zürich, Stauffacher": "8591381"},
+                                   routes=[("8591190", "8591381")])
+        body = service.handle_query("origin=Z%C3%BCrich,+Heuried&destination=Z%C3%BCrich,+Stauffacher")
+        self.assertEqual(body["destination"], "8591381")
+        with self.assertRaises(StopNotFoundError):
+            service.handle_query("origin=Stop+1&destination=Z%C3%BCrich,+Stauffacher")
+        with self.assertRaises(LookupError):
+            service.handle_query("origin_ref=8591381&destination_ref=8591190")
+        self.assertEqual((client.resolved, client.calls), ([], 1))
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.client = ojp_client()
+        self.server = TramtrixServer(DepartureService(self.client), address=("127.0.0.1", 0))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, path, connection=None):
+        connection = connection or http.client.HTTPConnection(*self.server.server_address[:2], timeout=5)
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), json.loads(response.read())
+
+    def test_departures(self):
+        connection = http.client.HTTPConnection(*self.server.server_address[:2], timeout=5)
+        status, _, body = self.request("/departures?origin_ref=8591190&destination_ref=8591381&lines=9", connection)
+        self.assertEqual(status, 200)
+        self.assertEqual(body["lines"]["9"]["departures"], [T0 + 300])
+        # The connection is kept open for the next poll
+        status, _, _ = self.request("/health", connection)
+        self.assertEqual(status, 200)
+        connection.close()
+
+    def test_errors(self):
+        self.assertEqual(self.request("/departures?origin_ref=8591190")[0], 400)
+        self.assertEqual(self.request("/nothing")[0], 404)
+        self.assertEqual(self.request("/departures?origin=Nowhere&destination_ref=8591381")[0], 404)
+        self.client.error = OJPApiError("API call skipped, request quota used up", retry_after=9.5)
+        status, headers, body = self.request("/departures?origin_ref=A&destination_ref=B")
+        self.assertEqual(status, 503)
+        self.assertEqual(headers["Retry-After"], "10")
+        self.assertIn("quota", body["error"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import MagicMock
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.ojp import OJPApiClient
+from tramtrix.session import create_session
+
+class TestSession(unittest.TestCase):
+    def test_create_session_pool_and_retries(self):
+        session = create_session(pool_size=7, retries=3, retry_backoff=0.25)
+        adapter = session.get_adapter("https://api.opentransportdata.swiss/ojp20")
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.25)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertEqual(session.headers["Connection"], "keep-alive")
+        session.close()
+
+    def test_create_session_without_keep_alive(self):
+        session = create_session(keep_alive=False)
+        self.assertEqual(session.headers["Connection"], "close")
+        session.close()
+
+    def test_ojp_client_reuses_session_with_timeout(self):
+        session = MagicMock()
+        session.post.return_value.status_code = 200
+        session.post.return_value.content = b"<OJP></OJP>"
+
+        with OJPApiClient(api_key="test_key", url="http://test.url", session=session, timeout=(1, 2)) as client:
+            client.get_trip_results("REF_A", "REF_B")
+            client.get_trip_results("REF_A", "REF_B")
+
+        self.assertEqual(session.post.call_count, 2)
+        self.assertEqual(session.post.call_args.kwargs["timeout"], (1, 2))
+        self.assertIsInstance(session.post.call_args.kwargs["data"], bytes)
+        # Sessions passed in are owned by the caller
+        session.close.assert_not_called()
+
+    def test_ojp_client_session_does_not_retry(self):
+        # Retries would bypass the request quota and the circuit breaker
+        with OJPApiClient(api_key="test_key", url="http://test.url") as client:
+            self.assertEqual(client.session.get_adapter("https://test.url").max_retries.total, 0)
+
+    def test_clients_close_own_session(self):
+        client = OJPApiClient(api_key="test_key", url="http://test.url")
+        client.session = MagicMock()
+        client.close()
+        client.session.close.assert_called_once()
+
+        with AwtrixClient(url="http://clock/api/custom?name=test") as clock:
+            clock.session = MagicMock()
+        clock.session.close.assert_called_once()
+
+    def test_awtrix_client_posts_through_session(self):
+        session = MagicMock()
+        session.post.return_value.status_code = 200
+        clock = AwtrixClient(url="http://clock/api/custom?name=test", session=session, timeout=(1, 2))
+
+        clock.update_clock({"9": "03fc14"})
+
+        session.post.assert_called_once()
+        self.assertEqual(session.post.call_args.kwargs["json"]["text"], [{"t": "9 ", "c": "03fc14"}])
+        self.assertEqual(session.post.call_args.kwargs["timeout"], (1, 2))
+
+if __name__ == '__main__':
+    unittest.main()
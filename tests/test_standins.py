@@ -0,0 +1,159 @@
+import json
+import random
+import time
+import unittest
+import requests
+from tramtrix.awtrix import AwtrixClient
+from tramtrix.ojp import OJPApiClient, OJPApiError, OJPRateLimitError, CircuitBreaker, MODE_STOP_EVENT, MODE_TRIP_INCREMENTAL
+from tramtrix.session import create_session
+from tramtrix.standins import Faults, OJPStandIn, AwtrixStandIn, parse_latency
+from helpers import T0, FakeTime
+
+
+class TestFaults(unittest.TestCase):
+    def test_parse_latency(self):
+        rng = random.Random(1)
+        self.assertEqual(parse_latency("0.2")(rng), 0.2)
+        self.assertTrue(all(0.1 <= parse_latency("uniform:0.1:0.5")(rng) <= 0.5 for _ in range(100)))
+        samples = sorted(parse_latency("lognormal:0.3:0.5")(rng) for _ in range(1001))
+        self.assertAlmostEqual(samples[500], 0.3, delta=0.05)
+        self.assertGreater(parse_latency("exponential:0.3")(rng), 0)
+        for spec in ("-1", "uniform:0.5:0.1", "lognormal:0.3", "normal:1:2", "fast"):
+            with self.assertRaises(ValueError):
+                parse_latency(spec)
+
+    def test_error_and_drop_rates(self):
+        faults = Faults(latency="uniform:0:0.1", error_rate=0.2, drop_rate=0.1, seed=3)
+        decisions = [faults.decide() for _ in range(2000)]
+        self.assertTrue(all(0 <= latency <= 0.1 for latency, _ in decisions))
+        self.assertAlmostEqual(sum(fault == "error" for _, fault in decisions) / 2000, 0.2, delta=0.03)
+        self.assertAlmostEqual(sum(fault == "drop" for _, fault in decisions) / 2000, 0.1, delta=0.03)
+        # The same seed injects the same faults
+        again = Faults(latency="uniform:0:0.1", error_rate=0.2, drop_rate=0.1, seed=3)
+        self.assertEqual([again.decide() for _ in range(2000)], decisions)
+
+    def test_rate_limit(self):
+        clock = FakeTime(1000.0)
+        faults = Faults(rate_limit=2, burst=3, clock=clock)
+        self.assertEqual([faults.decide()[1] for _ in range(4)], [None, None, None, "throttle"])
+        clock.now += 1
+        self.assertEqual([faults.decide()[1] for _ in range(3)], [None, None, "throttle"])
+
+
+class TestOJPStandIn(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime(T0)
+        self.server = OJPStandIn(clock=self.time).start()
+        self.client = self.make_client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def make_client(self):
+        return OJPApiClient(api_key="test", url=self.server.url, session=create_session(retries=0),
+                            breaker=CircuitBreaker(failure_threshold=100), clock=self.time)
+
+    def test_resolves_names_to_stable_refs(self):
+        ref = self.client.resolve_stop_ref("Zürich, Heuried")
+        self.assertEqual(ref, OJPStandIn.stop_ref("zürich, heuried "))
+        self.assertRegex(ref, r"^85\d{5}$")
+        self.assertNotEqual(self.client.resolve_stop_ref("Zürich, Stauffacher"), ref)
+
+    def test_trip_departures(self):
+        departures = self.client.get_trip_results("8591190", "8591381")
+        self.assertEqual(set(departures), {"9", "14"})
+        times = sorted(t for line in departures for t in departures[line])
+        self.assertEqual(len(times), 10)
+        self.assertTrue(all(t >= T0 for t in times))
+        # Trams of a line come every headway, give or take their delays
+        nines = list(departures["9"])
+        self.assertTrue(all(450 - 140 <= b - a <= 450 + 140 for a, b in zip(nines, nines[1:])))
+        details = departures.details("9")[0]
+        self.assertTrue(details.journey_ref.startswith("ch:1:sjyid:100001:9-"))
+        self.assertEqual(details.operating_day, "2026-01-06")
+        # Another route gets other departures, the same route the same ones
+        self.assertNotEqual(list(self.client.get_trip_results("8591190", "8503000")["9"]), nines)
+        self.assertEqual(list(self.client.get_trip_results("8591190", "8591381")["9"]), nines)
+
+    def test_incremental_mode(self):
+        departures = self.client.get_departures("8591190", "8591381", mode=MODE_TRIP_INCREMENTAL)
+        self.assertGreaterEqual(max(t for line in departures for t in departures[line]), T0 + 3000)
+        self.time.now += 600
+        departures = self.client.get_departures("8591190", "8591381", mode=MODE_TRIP_INCREMENTAL)
+        self.assertTrue(all(t >= T0 + 600 for line in departures for t in departures[line]))
+        self.assertEqual(list(self.server.stats()["statuses"]), [200])
+
+    def test_stop_events(self):
+        origin, destination = self.client.resolve_stop_ref("Zürich, Heuried"), self.client.resolve_stop_ref("Zürich, Stauffacher")
+        board = self.client.get_stop_events(origin)
+        self.assertEqual(set(board), {"9", "14"})
+        times = sorted(t for line in board for t in board[line])
+        self.assertEqual(len(times), 20)
+        self.assertTrue(all(t >= T0 for t in times))
+        self.assertTrue(board.details("14")[0].journey_ref.startswith("ch:1:sjyid:100001:14-"))
+        # Every tram calls at the other stops seen
+        towards = self.client.get_departures(origin, destination, mode=MODE_STOP_EVENT)
+        self.assertEqual({line: list(times) for line, times in towards.items()},
+                         {line: list(times) for line, times in board.items()})
+        self.assertEqual(len(self.client.get_stop_events(origin, "8500000")), 0)
+        self.assertEqual(list(self.server.stats()["statuses"]), [200])
+
+    def test_unsupported_request(self):
+        response = requests.post(self.server.url, data=b"<OJP xmlns='http://www.vdv.de/ojp'/>")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(requests.post(self.server.url, data=b"not xml").status_code, 400)
+
+    def test_injected_faults(self):
+        self.server.faults = Faults(error_rate=1)
+        with self.assertRaises(OJPApiError) as context:
+            self.client.get_trip_results("8591190", "8591381", allow_stale=False)
+        self.assertEqual(context.exception.status_code, 503)
+
+        self.server.faults = Faults(drop_rate=1)
+        with self.assertRaises(OJPApiError) as context:
+            self.client.get_trip_results("8591190", "8591381", allow_stale=False)
+        self.assertIsNone(context.exception.status_code)
+
+        self.server.faults = Faults(rate_limit=1, burst=1)
+        self.client.get_trip_results("8591190", "8591381")
+        with self.assertRaises(OJPRateLimitError):
+            self.make_client().get_trip_results("8591190", "8591381", allow_stale=False)
+        self.assertEqual(self.server.stats(), {"requests": 4, "statuses": {503: 1, 200: 1, 429: 1}, "dropped": 1})
+
+    def test_latency(self):
+        self.server.faults = Faults(latency="0.1")
+        started = time.perf_counter()
+        self.client.get_trip_results("8591190", "8591381")
+        self.assertGreaterEqual(time.perf_counter() - started, 0.1)
+
+
+class TestAwtrixStandIn(unittest.TestCase):
+    def setUp(self):
+        self.server = AwtrixStandIn().start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_keeps_last_payload_per_app(self):
+        with AwtrixClient(self.server.clock_url("kitchen"), min_interval=0) as kitchen, \
+                AwtrixClient(self.server.clock_url("office"), min_interval=0) as office:
+            self.assertTrue(kitchen.update_clock({"9": "a83632"}))
+            self.assertTrue(kitchen.update_clock({"9": "03fc14"}))
+            self.assertTrue(office.update_clock({"14": "fcca03"}))
+        self.assertEqual(self.server.apps["kitchen"], {"text": [{"t": "9 ", "c": "03fc14"}], "repeat": 1})
+        self.assertEqual(self.server.updates, {"kitchen": 2, "office": 1})
+        stats = requests.get(self.server.url + "/api/stats").json()
+        self.assertEqual(stats, {"apps": 2, "updates": 3})
+
+    def test_injected_errors(self):
+        self.server.faults = Faults(error_rate=1)
+        with AwtrixClient(self.server.clock_url("kitchen"), session=create_session(retries=0)) as clock, \
+                self.assertLogs("tramtrix.awtrix", "WARNING"):
+            self.assertFalse(clock.update_clock({"9": "a83632"}))
+        self.assertEqual(self.server.apps, {})
+        self.assertEqual(requests.post(self.server.url + "/api/notify", data=json.dumps({})).status_code, 503)
+
+
+if __name__ == "__main__":
+    unittest.main()
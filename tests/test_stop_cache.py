@@ -0,0 +1,100 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+from tramtrix.ojp import OJPApiClient
+from tramtrix.stop_cache import StopRefCache, normalize_stop_name
+
+LOCATION_RESPONSE = """
+<OJP xmlns:siri="http://www.siri.org.uk/siri" xmlns:ojp="http://www.vdv.de/ojp">
+    <OJPResponse>
+        <siri:ServiceDelivery>
+            <OJPLocationInformationDelivery>
+                <PlaceResult>
+                    <Place>
+                        <StopPlace>
+                            <ojp:StopPlaceRef>8591190</ojp:StopPlaceRef>
+                        </StopPlace>
+                    </Place>
+                </PlaceResult>
+            </OJPLocationInformationDelivery>
+        </siri:ServiceDelivery>
+    </OJPResponse>
+</OJP>
+"""
+
+class TestStopRefCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "nested", "stop_refs.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_normalize_stop_name(self):
+        self.assertEqual(normalize_stop_name("  Zürich,   Heuried "), "zürich, heuried")
+        # Decomposed umlaut matches the composed form
+        self.assertEqual(normalize_stop_name("Zu\u0308rich, Heuried"), normalize_stop_name("Z\u00fcrich, Heuried"))
+
+    def test_set_and_get_persists_across_instances(self):
+        StopRefCache(self.path).set("http://ojp", "Zürich, Heuried", "8591190")
+
+        cache = StopRefCache(self.path)
+        self.assertEqual(cache.get("http://ojp", "zürich,  heuried"), "8591190")
+        # Keyed by URL as well as name
+        self.assertIsNone(cache.get("http://other", "Zürich, Heuried"))
+
+    def test_expired_entry_is_ignored(self):
+        cache = StopRefCache(self.path, ttl=60)
+        cache.set("http://ojp", "Heuried", "8591190")
+
+        with patch("tramtrix.stop_cache.time.time", return_value=time.time() + 120):
+            self.assertIsNone(cache.get("http://ojp", "Heuried"))
+
+    def test_invalidate(self):
+        cache = StopRefCache(self.path)
+        cache.set("http://ojp", "Heuried", "8591190")
+        cache.set("http://ojp", "Stauffacher", "8591381")
+        cache.set("http://other", "Heuried", "8591190")
+
+        self.assertEqual(cache.invalidate("http://ojp", "heuried"), 1)
+        self.assertIsNone(cache.get("http://ojp", "Heuried"))
+        self.assertEqual(cache.get("http://ojp", "Stauffacher"), "8591381")
+
+        self.assertEqual(cache.invalidate(stop_name="Heuried"), 1)
+        self.assertEqual(cache.clear(), 1)
+        self.assertIsNone(StopRefCache(self.path).get("http://ojp", "Stauffacher"))
+
+    def test_corrupt_file_is_treated_as_empty(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as f:
+            f.write("{not json")
+
+        cache = StopRefCache(self.path)
+        self.assertIsNone(cache.get("http://ojp", "Heuried"))
+        cache.set("http://ojp", "Heuried", "8591190")
+        self.assertEqual(StopRefCache(self.path).get("http://ojp", "Heuried"), "8591190")
+
+    @patch("requests.Session.post")
+    def test_resolve_stop_ref_uses_cache(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.text = LOCATION_RESPONSE
+        mock_post.return_value = mock_response
+
+        client = OJPApiClient(api_key="test_key", url="http://test.url", stop_cache=StopRefCache(self.path))
+        self.assertEqual(client.resolve_stop_ref("Zürich, Heuried"), "8591190")
+        mock_post.assert_called_once()
+
+        # A restarted client resolves from disk without any location request
+        client = OJPApiClient(api_key="test_key", url="http://test.url", stop_cache=StopRefCache(self.path))
+        self.assertEqual(client.resolve_stop_ref("Zürich, Heuried"), "8591190")
+        mock_post.assert_called_once()
+
+        # Bypassing the cache forces a fresh lookup
+        client.resolve_stop_ref("Zürich, Heuried", use_cache=False)
+        self.assertEqual(mock_post.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout, redirect_stderr
+from unittest.mock import MagicMock, patch
+from tramtrix.ojp import OJPApiClient
+from tramtrix.stop_index import StopIndex, build_stop_index, fold_stop_name, load_stop_index, read_stop_csv, main
+
+STOPS = [
+    ("Zürich, Heuried", "8591190"),
+    ("Zürich, Stauffacher", "8591381"),
+    ("Zürich, Hardplatz", "8591168"),
+    ("Zürich HB", "8503000"),
+    ("Zürich, Bahnhofplatz/HB", "8587349"),
+    ("Genève, Cornavin", "8587057"),
+    ("Bern, Hirschengraben", "8588782"),
+]
+
+SERVICE_POINT_CSV = """﻿number;sloid;designationOfficial;stopPoint
+8591190;ch:1:sloid:91190;Zürich, Heuried;true
+8591381;ch:1:sloid:91381;Zürich, Stauffacher;true
+8500000;ch:1:sloid:0;Betriebspunkt Irgendwo;false
+;ch:1:sloid:1;Ohne Nummer;true
+"""
+
+GTFS_CSV = """stop_id,stop_name,stop_lat,stop_lon
+8591190,"Zürich, Heuried",47.37,8.50
+"""
+
+
+class TestStopIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "nested", "stops.idx")
+        self.assertEqual(build_stop_index(STOPS, self.path), len(STOPS))
+        self.index = StopIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    def _write(self, name, text):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_fold_stop_name(self):
+        self.assertEqual(fold_stop_name("  Zürich,   Heuried "), "zurich heuried")
+        self.assertEqual(fold_stop_name("Zürich, Bahnhofplatz/HB"), "zurich bahnhofplatz hb")
+        self.assertEqual(fold_stop_name(",/ "), "")
+
+    def test_lookup_ignores_case_accents_and_punctuation(self):
+        self.assertEqual(len(self.index), len(STOPS))
+        self.assertEqual(self.index.lookup("Zürich, Heuried"), "8591190")
+        self.assertEqual(self.index.lookup("zurich heuried"), "8591190")
+        self.assertEqual(self.index.lookup("GENEVE - Cornavin"), "8587057")
+        self.assertIsNone(self.index.lookup("Zürich, Heur"))
+        self.assertIsNone(self.index.lookup("Basel SBB"))
+        self.assertIsNone(self.index.lookup(""))
+
+    def test_prefix(self):
+        self.assertEqual(
+            [name for name, _ in self.index.prefix("zürich, h")],
+            ["Zürich, Hardplatz", "Zürich HB", "Zürich, Heuried"]
+        )
+        self.assertEqual(len(self.index.prefix("Zürich", limit=2)), 2)
+        self.assertEqual(self.index.prefix("Lausanne"), [])
+
+    def test_search_finds_words_in_any_order(self):
+        self.assertEqual(self.index.search("heur zur"), [("Zürich, Heuried", "8591190")])
+        self.assertEqual(self.index.search("HB")[0], ("Zürich HB", "8503000"))
+        self.assertIn(("Zürich, Bahnhofplatz/HB", "8587349"), self.index.search("HB"))
+
+    def test_search_puts_prefix_matches_first(self):
+        results = self.index.search("Zürich", limit=3)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(name.startswith("Zürich") for name, _ in results))
+
+    def test_search_tolerates_typos(self):
+        self.assertEqual(self.index.search("Stauffacker")[0], ("Zürich, Stauffacher", "8591381"))
+        self.assertEqual(self.index.search("Hirschgraben")[0], ("Bern, Hirschengraben", "8588782"))
+        self.assertEqual(self.index.search("Lausanne"), [])
+
+    def test_rebuild_replaces_index(self):
+        build_stop_index([("Zürich, Heuried", "ch:1:sloid:91190"), ("Zürich, Heuried", "ch:1:sloid:91190")], self.path)
+        with StopIndex(self.path) as index:
+            self.assertEqual(len(index), 1)
+            self.assertEqual(index.lookup("Zürich, Heuried"), "ch:1:sloid:91190")
+
+    def test_read_service_point_csv(self):
+        path = self._write("service_points.csv", SERVICE_POINT_CSV)
+        self.assertEqual(
+            list(read_stop_csv(path)),
+            [("Zürich, Heuried", "8591190"), ("Zürich, Stauffacher", "8591381")]
+        )
+        self.assertEqual(list(read_stop_csv(path, ref_column="sloid"))[0], ("Zürich, Heuried", "ch:1:sloid:91190"))
+
+    def test_read_gtfs_csv(self):
+        path = self._write("stops.txt", GTFS_CSV)
+        self.assertEqual(list(read_stop_csv(path)), [("Zürich, Heuried", "8591190")])
+        with self.assertRaises(ValueError):
+            list(read_stop_csv(path, name_column="designationOfficial"))
+
+    def test_not_an_index(self):
+        path = self._write("stops.json", "{}")
+        with self.assertRaises(ValueError):
+            StopIndex(path)
+        with self.assertLogs("tramtrix.stop_index", "WARNING"):
+            self.assertIsNone(load_stop_index(path))
+        self.assertIsNone(load_stop_index(os.path.join(self.tmp_dir.name, "missing.idx")))
+        self.assertIsNone(load_stop_index(""))
+
+    def test_cli_builds_and_resolves(self):
+        csv_path = self._write("service_points.csv", SERVICE_POINT_CSV)
+        index_path = os.path.join(self.tmp_dir.name, "cli.idx")
+        out = io.StringIO()
+        with redirect_stdout(out), redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(main(["--index", index_path, "build", csv_path]), 0)
+            self.assertEqual(main(["--index", index_path, "resolve", "zurich heuried", "Stauffacher"]), 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1], "zurich heuried\t8591190")
+        self.assertTrue(lines[2].startswith("Stauffacher\t\tnot found (did you mean 'Zürich, Stauffacher'"))
+        self.assertIn("Resolved 1 of 2 names", err.getvalue())
+
+
+class TestClientStopIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = MagicMock()
+        self.client = OJPApiClient(api_key="test", url="http://ojp", stop_index=self.index)
+
+    @patch("requests.Session.post")
+    def test_resolve_uses_index_before_api(self, mock_post):
+        self.index.lookup.return_value = "8591190"
+        self.assertEqual(self.client.resolve_stop_ref("Zürich, Heuried"), "8591190")
+        mock_post.assert_not_called()
+
+    @patch("requests.Session.post")
+    def test_resolve_falls_back_to_api(self, mock_post):
+        self.index.lookup.return_value = None
+        mock_post.return_value = MagicMock(
+            status_code=200, text="<OJP xmlns:ojp='http://www.vdv.de/ojp'><ojp:StopPlaceRef>8591381</ojp:StopPlaceRef></OJP>"
+        )
+        self.assertEqual(self.client.resolve_stop_ref("Stauffacher"), "8591381")
+        mock_post.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
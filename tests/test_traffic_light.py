@@ -1,6 +1,11 @@
+import random
 import unittest
+from array import array
 from datetime import datetime, timedelta, timezone
-from tramtrix.traffic_light import calculate_traffic_light_colour, to_hex_color
+from tramtrix.traffic_light import (
+    calculate_traffic_light_colour, to_hex_color,
+    colour_boundaries, colour_timeline, colour_timelines
+)
 from tramtrix import config
 
 class TestTrafficLight(unittest.TestCase):
@@ -49,5 +54,76 @@ class TestTrafficLight(unittest.TestCase):
         t4 = self.now + timedelta(minutes=2.5)
         self.assertEqual(calculate_traffic_light_colour({t3, t4}), 'AMBER')
 
+    def test_calculate_traffic_light_colour_sorted_array(self):
+        # Departures arrays of epoch seconds are checked with bisect, same result as the scan
+        now = self.now.timestamp()
+        for minutes in ([10, 4], [1, 2.5], [1], [5], [-5, 30]):
+            times = [now + m * 60 for m in minutes]
+            self.assertEqual(
+                calculate_traffic_light_colour(array("d", sorted(times)), now=now),
+                calculate_traffic_light_colour(set(times), now=now),
+            )
+
+class TestColourTimeline(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2026, 1, 6, 12, 0, tzinfo=timezone.utc)
+        self.start = self.now.timestamp()
+
+    def at(self, minutes):
+        return self.now + timedelta(minutes=minutes)
+
+    def test_colour_changes_exactly_at_boundaries(self):
+        departure = self.at(10)
+        boundaries = colour_boundaries({departure})
+        # Red before the green window, then green, amber, red, and mirrored after the departure
+        self.assertEqual(len(boundaries), 6)
+        for boundary in boundaries:
+            before = datetime.fromtimestamp(boundary - 1, timezone.utc)
+            after = datetime.fromtimestamp(boundary + 1, timezone.utc)
+            self.assertNotEqual(
+                calculate_traffic_light_colour({departure}, now=before),
+                calculate_traffic_light_colour({departure}, now=after),
+            )
+
+    def test_single_departure_timeline(self):
+        timeline = colour_timeline([self.at(10)], self.now)
+        colours = [interval[2] for interval in timeline.intervals]
+        self.assertEqual(colours, ["RED", "GREEN", "AMBER", "RED", "AMBER", "GREEN", "RED"])
+        self.assertEqual(timeline.intervals[1][:2], (self.at(4).timestamp(), self.at(7).timestamp()))
+
+        self.assertEqual(timeline.colour_at(self.at(5)), "GREEN")
+        self.assertEqual(timeline.colour_at(self.at(7.5)), "AMBER")
+        self.assertEqual(timeline.next_change(self.now), self.at(4).timestamp())
+        self.assertEqual(timeline.next_change(self.at(5)), self.at(7).timestamp())
+        # No more changes after the last departure has left the windows
+        self.assertIsNone(timeline.next_change(self.at(17)))
+        self.assertEqual(timeline.colour_at(self.at(60)), "RED")
+
+    def test_matches_calculate_traffic_light_colour(self):
+        rng = random.Random(42)
+        departures = sorted(self.start + rng.uniform(-300, 3600) for _ in range(40))
+        timeline = colour_timeline(departures, self.start, horizon=3600)
+        for _ in range(2000):
+            t = self.start + rng.uniform(-600, 4200)
+            expected = calculate_traffic_light_colour(
+                {datetime.fromtimestamp(d, timezone.utc) for d in departures},
+                now=datetime.fromtimestamp(t, timezone.utc),
+            )
+            self.assertEqual(timeline.colour_at(t), expected)
+
+    def test_empty_departures_are_red(self):
+        timeline = colour_timeline([], self.now, horizon=600)
+        self.assertEqual(timeline.intervals, [(self.start, self.start + 600, "RED")])
+        self.assertIsNone(timeline.next_change(self.now))
+
+    def test_colour_timelines_batch(self):
+        results = {"9": {self.at(10)}, "14": {self.at(5), self.at(20)}}
+        timelines = colour_timelines(results, self.now, lines=["9", "14", "2"])
+        self.assertEqual(set(timelines), {"9", "14", "2"})
+        self.assertEqual(timelines["14"].colour_at(self.now), "GREEN")
+        self.assertEqual(timelines["9"].colour_at(self.now), "RED")
+        self.assertEqual(timelines["2"].colour_at(self.now), "RED")
+        self.assertEqual(set(colour_timelines(results, self.now)), {"9", "14"})
+
 if __name__ == '__main__':
     unittest.main()